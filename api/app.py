@@ -1,9 +1,10 @@
 from fastapi import FastAPI,Response,Request
 from library import sateval
+from library.jobs import JobManager
 from models.base_response import BaseResponse
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-import asyncio
+import json
  
 app = FastAPI()
 
@@ -16,6 +17,7 @@ app.add_middleware(
 )
 
 se = sateval.SatEval("dataset")
+jobs = JobManager(se)
  
 @app.get("/")
 def status(response:Response,request:Request):
@@ -81,9 +83,9 @@ def get_methods(module_name: str, response: Response, request: Request):
         return BaseResponse(False, 500, f"Get Methods for {module_name} Failed", data=str(ex)).respond(response=response)
     
 @app.get("/list_directories")
-def list_directories(response: Response, request: Request):
+def list_directories(response: Response, request: Request, page: int = 0, page_size: int = 0, pattern: str = "", folder: str = ""):
     try:
-        result = se.dataset_loader.list()
+        result = se.dataset_loader.list(page,page_size,pattern,folder)
         return BaseResponse(True, 200, f"List Directories Success", data=result).respond(response=response)
     except Exception as ex:
         return BaseResponse(False, 500, f"List Directories Failed", data=str(ex)).respond(response=response)
@@ -96,17 +98,91 @@ def get_evalauation_fields(response: Response, request: Request):
     except Exception as ex:
         return BaseResponse(False, 500, f"Get Evaluation Fields Failed", data=str(ex)).respond(response=response)
 
+@app.get("/get_metrics")
+def get_metrics(response: Response, request: Request):
+    try:
+        result = se.evaluator.get_metrics()
+        return BaseResponse(True, 200, f"Get Metrics Success", data=result).respond(response=response)
+    except Exception as ex:
+        return BaseResponse(False, 500, f"Get Metrics Failed", data=str(ex)).respond(response=response)
+
 
 
 @app.post("/run_pipeline")
-def run_pipeline(response: Response, request: Request, run_id: str):
+async def run_pipeline(response: Response, request: Request, run_id: str, fused: bool = False, scheduled: bool = False, cached: bool = False, resume: bool = False):
  
     try:
-        config = asyncio.run(request.json())
-                
-        return StreamingResponse(se.configurables.run(run_id,config=config,clf=se))
+        config = await request.json()
+        job_id = jobs.submit(run_id,config,fused,scheduled,cached,resume)
+        # the run is a background job, a client that disconnects only stops following it
+        return StreamingResponse(message for _, message in jobs.events(job_id))
     except Exception as ex:
-        return BaseResponse(False, 500, "Get Config Template Failed", data=str(ex)).respond(response=response)
+        return BaseResponse(False, 500, "Run Pipeline Failed", data=str(ex)).respond(response=response)
+
+@app.post("/jobs")
+async def submit_job(response: Response, request: Request, run_id: str, fused: bool = False, scheduled: bool = False, cached: bool = False, resume: bool = False):
+    try:
+        config = await request.json()
+        result = {"job_id":jobs.submit(run_id,config,fused,scheduled,cached,resume)}
+        return BaseResponse(True, 200, "Submit Job Success", data=result).respond(response=response)
+    except Exception as ex:
+        return BaseResponse(False, 500, "Submit Job Failed", data=str(ex)).respond(response=response)
+
+@app.get("/jobs")
+def list_jobs(response: Response, request: Request, status: str = "", limit: int = 50):
+    try:
+        result = jobs.list(status,limit)
+        return BaseResponse(True, 200, "List Jobs Success", data=result).respond(response=response)
+    except Exception as ex:
+        return BaseResponse(False, 500, "List Jobs Failed", data=str(ex)).respond(response=response)
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str, response: Response, request: Request):
+    try:
+        result = jobs.get(job_id)
+        return BaseResponse(True, 200, "Get Job Success", data=result).respond(response=response)
+    except Exception as ex:
+        return BaseResponse(False, 500, "Get Job Failed", data=str(ex)).respond(response=response)
+
+@app.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str, response: Response, request: Request):
+    try:
+        result = {"status":jobs.cancel(job_id)}
+        return BaseResponse(True, 200, "Cancel Job Success", data=result).respond(response=response)
+    except Exception as ex:
+        return BaseResponse(False, 500, "Cancel Job Failed", data=str(ex)).respond(response=response)
+
+@app.post("/jobs/{job_id}/resume")
+def resume_job(job_id: str, response: Response, request: Request, fused: bool = False, scheduled: bool = False, cached: bool = False):
+    try:
+        result = {"job_id":jobs.resume(job_id,fused,scheduled,cached)}
+        return BaseResponse(True, 200, "Resume Job Success", data=result).respond(response=response)
+    except Exception as ex:
+        return BaseResponse(False, 500, "Resume Job Failed", data=str(ex)).respond(response=response)
+
+@app.post("/cancel_run")
+def cancel_run(response: Response, request: Request, run_id: str):
+    try:
+        result = jobs.cancel_run(run_id)
+        return BaseResponse(True, 200, "Cancel Run Success", data=result).respond(response=response)
+    except Exception as ex:
+        return BaseResponse(False, 500, "Cancel Run Failed", data=str(ex)).respond(response=response)
+
+@app.get("/jobs/{job_id}/events")
+def job_events(job_id: str, response: Response, request: Request, after: int = 0):
+    try:
+        jobs.get(job_id)
+        # a reconnecting EventSource sends the id of the last event it received
+        after = int(request.headers.get("last-event-id",after))
+
+        def stream():
+            for seq, message in jobs.events(job_id,after):
+                yield f"id: {seq}\ndata: {json.dumps(message)}\n\n"
+            yield "event: end\ndata: {}\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+    except Exception as ex:
+        return BaseResponse(False, 500, "Get Job Events Failed", data=str(ex)).respond(response=response)
 
 @app.get("/get_run_ids")
 def get_run_ids(response: Response, request: Request):
@@ -137,11 +213,11 @@ def get_results_by_run_id(response: Response, request: Request,run_id:str):
         return BaseResponse(False, 500, "Get Result by Run IDs Failed", data=str(ex)).respond(response=response)
     
 @app.post("/get_image_by_path")
-async def get_image_by_path(response: Response, request: Request):
+async def get_image_by_path(response: Response, request: Request, max_size: int = 0):
  
     try:
         paths = await request.json()
-        result = se.evaluator.get_image_by_path(paths[0])
+        result = se.evaluator.get_image_by_path(paths[0],max_size)
         return BaseResponse(True, 200, "Get Image By Path Success", data=result).respond(response=response)
     except Exception as ex:    
         return BaseResponse(False, 500, "Get Image By Path Failed", data=str(ex)).respond(response=response)
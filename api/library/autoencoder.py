@@ -0,0 +1,104 @@
+import os
+import time
+import numpy as np
+from PIL import Image
+from .model_registry import model_registry
+
+TILE_SIZE = (256,256)
+TILE_SHAPE = (256,256,3)
+
+# upper bound for the input + output float32 tensors of one forward pass
+MAX_BATCH_BYTES = 512 * 1024 * 1024
+
+
+def bounded_batch_size(batch_size:int):
+    """
+    Clamp the requested batch size to what fits in MAX_BATCH_BYTES.
+    """
+    tile_bytes = int(np.prod(TILE_SHAPE)) * np.dtype(np.float32).itemsize
+    limit = max(1, MAX_BATCH_BYTES // (2 * tile_bytes))
+    return max(1, min(int(batch_size), limit))
+
+
+def to_tile(img:Image.Image):
+    """
+    Resize a PIL image to the autoencoder input size and scale it to [0, 1].
+    """
+    img = img.convert("RGB").resize(TILE_SIZE)
+    tile = np.asarray(img, dtype=np.float32)
+    tile /= 255.0
+    return tile
+
+
+def predict_tiles(model, tiles:list):
+    """
+    Run a single forward pass over a list of tiles.
+
+    Parameters:
+        model: keras.Model - Encoder or decoder model.
+        tiles: list - Arrays of shape TILE_SHAPE produced by to_tile.
+
+    Returns:
+        images: list - One PIL image per input tile, in the same order.
+    """
+    batch = np.stack(tiles).reshape(len(tiles),*TILE_SHAPE)
+    output = model.predict(batch,batch_size=len(tiles),verbose=0)
+    output = output.reshape(len(tiles),*TILE_SHAPE) * 255
+    return [Image.fromarray(tile.astype('uint8')) for tile in output]
+
+
+def run_batch(model_path:str,input_paths:list,output_folder:str,open_image,keys:tuple,describe=None):
+    """
+    Load a batch of images, run them through one forward pass of a model and save the outputs as JPEG.
+
+    Parameters:
+        model_path: str - Model to run, looked up in the model registry.
+        input_paths: list - Images of the batch.
+        output_folder: str - Folder the outputs are written to, named after their input with a .jpg extension.
+        open_image: callable - Opens an input path as a PIL image.
+        keys: tuple - (path, size, time) keys of the output path, output size and elapsed microseconds in a result.
+        describe: callable - describe(input_path, img) returns fields added to the result, read while the image is open.
+
+    Returns:
+        (results, errors): tuple - Results of the tiles that were written and exceptions of
+            the ones that failed, keyed by input path.
+    """
+    path_key, size_key, time_key = keys
+    results = {}
+    errors = {}
+    tiles = []
+    timings = {}
+    for input_path in input_paths:
+        try:
+            start_time = time.perf_counter()
+            with open_image(input_path) as img:
+                results[input_path] = {} if describe is None else describe(input_path,img)
+                tiles.append((input_path,to_tile(img)))
+            timings[input_path] = time.perf_counter() - start_time
+        except Exception as e:
+            errors[input_path] = e
+
+    if len(tiles) == 0:
+        return {}, errors
+
+    model = model_registry.get(model_path)
+    start_time = time.perf_counter()
+    images = predict_tiles(model,[tile for _, tile in tiles])
+    # the forward pass is shared, so each tile is charged an equal slice of it
+    predict_time = (time.perf_counter() - start_time) / len(tiles)
+
+    for (input_path, _), image in zip(tiles,images):
+        try:
+            file_name = input_path.split("/")[-1]
+            output_path = f"{output_folder}/{file_name.replace('.tif', '')}.jpg"
+            start_time = time.perf_counter()
+            image.save(output_path, "JPEG")
+            elapsed = timings[input_path] + predict_time + time.perf_counter() - start_time
+            result = results[input_path]
+            result[path_key] = output_path
+            result[size_key] = os.path.getsize(output_path)
+            result[time_key] = elapsed * 1_000_000
+        except Exception as e:
+            errors[input_path] = e
+
+    return {path:result for path, result in results.items() if path not in errors}, errors
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+import numpy as np
+from .executor import executor
+from .image_data_writer import ImageDataWriter
+from . import sources
+
+CACHE_DIR = "data/cache"
+MAX_CACHE_SIZE = 10 * 1024 ** 3
+# bump when the output of a cached worker changes, so older entries are not reused
+CACHE_VERSION = 1
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# per process content hashes of files on disk, keyed by path, size and mtime
+_HASHES = {}
+
+
+def _content_hash(path:str):
+    stat = None if path.startswith(sources.ZIP_PREFIX) else os.stat(path)
+    memo = None if stat is None else (path,stat.st_size,stat.st_mtime_ns)
+    if memo is not None and memo in _HASHES:
+        return _HASHES[memo]
+    digest = hashlib.sha256()
+    with sources.open_file(path) as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    if memo is not None:
+        _HASHES[memo] = digest.hexdigest()
+    return digest.hexdigest()
+
+
+def _fingerprint(value):
+    # arrays such as lookup tables are hashed by content, str() would elide them
+    if isinstance(value,np.ndarray):
+        return hashlib.sha256(value.tobytes()).hexdigest()
+    return str(value)
+
+
+def _cache_key(input_path:str,worker,params:dict):
+    """
+    Hash of the input content, the worker and its parameters, the output folder excluded.
+    The file name is part of the key as the workers name their outputs after it.
+    """
+    stage = f"{worker.__module__}.{worker.__name__}"
+    description = json.dumps([CACHE_VERSION,stage,input_path.split("/")[-1],params],sort_keys=True,default=_fingerprint)
+    return hashlib.sha256(f"{_content_hash(input_path)}:{description}".encode()).hexdigest()
+
+
+def _copy(source:str,destination:str):
+    """
+    Copy source to destination, replacing it.
+
+    Entries are private copies, not links: the workers write their outputs in place, so an
+    output sharing its inode with an entry would rewrite the entry the next time it is written.
+    """
+    temp = f"{destination}.{uuid.uuid4().hex}.tmp"
+    shutil.copyfile(source,temp)
+    os.replace(temp,destination)
+
+
+def _cached_call(input_path:str,worker,output_folder:str,cache_dir:str,**params):
+    """
+    Run worker(input_path, output_folder, **params) unless an entry with the same key exists,
+    in which case its artifact is copied into output_folder and its recorded result returned.
+
+    Returns:
+        (result, entry): tuple - Result of the worker with its paths in output_folder, and
+            the cache entry {"key","stage","size","hit"}.
+    """
+    key = _cache_key(input_path,worker,params)
+    stage = worker.__name__.strip("_")
+    entry_path = os.path.join(cache_dir,key[:2],key)
+    meta_path = os.path.join(entry_path,"result.json")
+
+    if os.path.exists(meta_path):
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            result = dict(meta["result"])
+            for field, name in meta["artifacts"].items():
+                result[field] = f"{output_folder}/{name}"
+                _copy(os.path.join(entry_path,name),result[field])
+            return result, {"key":key,"stage":stage,"size":meta["size"],"hit":True}
+        except (OSError, ValueError, KeyError):
+            # a damaged or partly evicted entry is rebuilt below
+            shutil.rmtree(entry_path,ignore_errors=True)
+
+    result = worker(input_path,output_folder,**params)
+
+    # the artifacts are the files the worker reports in output_folder
+    artifacts = {
+        field:value.split("/")[-1] for field, value in result.items()
+        if field.endswith("_path") and isinstance(value,str) and value.startswith(f"{output_folder}/")
+    }
+    temp_path = f"{entry_path}.{uuid.uuid4().hex}.tmp"
+    size = 0
+    try:
+        os.makedirs(temp_path)
+        for field, name in artifacts.items():
+            _copy(result[field],os.path.join(temp_path,name))
+            size += os.path.getsize(result[field])
+        with open(os.path.join(temp_path,"result.json"),"w") as f:
+            json.dump({"result":result,"artifacts":artifacts,"size":size},f)
+        os.rename(temp_path,entry_path)
+    except OSError:
+        # another worker stored the same key first, or the cache is not writable
+        shutil.rmtree(temp_path,ignore_errors=True)
+    return result, {"key":key,"stage":stage,"size":size,"hit":False}
+
+
+class StageCache:
+    """
+    Content addressed cache of per file stage results, shared by every run.
+
+    An entry is keyed by the hash of the input file content, the worker and its parameters,
+    and holds copies of the produced artifacts with the recorded result, sizes and
+    timings included. A run opted in with Configurables.run(..., cached=True) copies the
+    artifacts of a hit into its output folder instead of running the worker again. The
+    stage_cache table tracks the size and last use of every entry, the least recently
+    used entries are evicted once the cache grows over max_size bytes.
+    """
+
+    def __init__(self,cache_dir:str = CACHE_DIR,max_size:int = MAX_CACHE_SIZE):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.__runs = {}
+        self.__lock = threading.Lock()
+
+    def open(self,run_id:str):
+        with self.__lock:
+            self.__runs[run_id] = self.__runs.get(run_id,0) + 1
+
+    def release(self,run_id:str):
+        with self.__lock:
+            if run_id in self.__runs:
+                self.__runs[run_id] -= 1
+                if self.__runs[run_id] <= 0:
+                    del self.__runs[run_id]
+
+    def enabled(self,run_id:str):
+        with self.__lock:
+            return run_id in self.__runs
+
+    def map(self,func,items,workers:int,connection:sqlite3.Connection,writer:ImageDataWriter,run_id:str,output_folder:str,**kwargs):
+        """
+        executor.map for a stage worker, going through the cache when the run opted in.
+        Once the stage is done the cache is evicted down to max_size.
+
+        Yields:
+            (item, result, error): tuple - As executor.map.
+        """
+        if not self.enabled(run_id):
+            for res in executor.map(func,items,workers,output_folder=output_folder,**kwargs):
+                yield res
+            return
+
+        os.makedirs(self.cache_dir,exist_ok=True)
+        try:
+            for item, result, error in executor.map(_cached_call,items,workers,worker=func,output_folder=output_folder,cache_dir=self.cache_dir,**kwargs):
+                if error is not None:
+                    yield item, None, error
+                    continue
+                result, entry = result
+                now = time.time()
+                writer.execute(
+                    """INSERT INTO stage_cache (key, stage, size, hits, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET hits = hits + excluded.hits, last_used = excluded.last_used""",
+                    (entry["key"], entry["stage"], entry["size"], 1 if entry["hit"] else 0, now, now)
+                )
+                yield item, result, None
+        finally:
+            self.evict(connection,writer)
+
+    def evict(self,connection:sqlite3.Connection,writer:ImageDataWriter):
+        """
+        Remove the least recently used entries until the cache fits in max_size bytes.
+        """
+        writer.flush()
+        with writer.locked():
+            total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM stage_cache").fetchone()[0]
+            if total <= self.max_size:
+                return
+            entries = connection.execute("SELECT key, size FROM stage_cache ORDER BY last_used").fetchall()
+        evicted = []
+        for key, size in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(os.path.join(self.cache_dir,key[:2],key),ignore_errors=True)
+            evicted.append((key,))
+            total -= size
+        for key in evicted:
+            writer.execute("DELETE FROM stage_cache WHERE key = ?",key)
+        writer.flush()
+
+
+stage_cache = StageCache()
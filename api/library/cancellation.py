@@ -0,0 +1,90 @@
+import threading
+
+
+class Cancelled(Exception):
+    """
+    Raised inside a stage when its run has been cancelled.
+    """
+
+
+class CancellationToken:
+    """
+    Cooperative cancellation flag shared by everything working for one run.
+    """
+
+    def __init__(self,run_id:str = ""):
+        self.run_id = run_id
+        self.__event = threading.Event()
+
+    def cancel(self):
+        self.__event.set()
+
+    @property
+    def cancelled(self):
+        return self.__event.is_set()
+
+    def check(self):
+        """
+        Raise Cancelled when the run has been cancelled, called between files by the per-file loops.
+        """
+        if self.__event.is_set():
+            raise Cancelled(f"Run {self.run_id} cancelled")
+
+
+class Cancellation:
+    """
+    Cancellation tokens of the active runs, keyed by run_id.
+
+    Configurables.run opens the token of its run and releases it when it ends, the
+    stages look it up by the run_id they were given and check it between files.
+    """
+
+    def __init__(self):
+        self.__tokens = {}
+        self.__lock = threading.Lock()
+
+    def open(self,run_id:str):
+        """
+        Get the token of a run that starts, runs sharing a run_id share the token.
+        """
+        with self.__lock:
+            if run_id not in self.__tokens:
+                self.__tokens[run_id] = [CancellationToken(run_id),0]
+            self.__tokens[run_id][1] += 1
+            return self.__tokens[run_id][0]
+
+    def release(self,run_id:str):
+        with self.__lock:
+            if run_id in self.__tokens:
+                self.__tokens[run_id][1] -= 1
+                if self.__tokens[run_id][1] <= 0:
+                    del self.__tokens[run_id]
+
+    def token(self,run_id:str):
+        """
+        Get the token of a run, a method called outside of a run gets a token that is never cancelled.
+        """
+        with self.__lock:
+            if run_id in self.__tokens:
+                return self.__tokens[run_id][0]
+        return CancellationToken(run_id)
+
+    def cancel(self,run_id:str):
+        """
+        Cancel a run.
+
+        Returns:
+            cancelled: bool - False when no run with this run_id is active.
+        """
+        with self.__lock:
+            if run_id not in self.__tokens:
+                return False
+            self.__tokens[run_id][0].cancel()
+            return True
+
+    def active(self):
+        with self.__lock:
+            return list(self.__tokens)
+
+
+cancellation = Cancellation()
@@ -0,0 +1,84 @@
+import sqlite3
+import threading
+import time
+from .image_data_writer import ImageDataWriter
+from .streams import streams
+
+
+class Checkpoints:
+    """
+    Per file completion of the stages of a run, so a run that stopped can be resumed.
+
+    Every file stage records the files it finished in stage_checkpoints, inside the writer
+    transaction of the image_data statement of the file, so a file is either logged and
+    checkpointed or neither. A run started again with Configurables.run(..., resume=True)
+    and the same run_id skips the files already checkpointed for each stage, the rows and
+    outputs they left are kept as they are.
+    """
+
+    def __init__(self):
+        self.__runs = {}
+        self.__lock = threading.Lock()
+
+    def open(self,run_id:str):
+        with self.__lock:
+            self.__runs[run_id] = self.__runs.get(run_id,0) + 1
+
+    def release(self,run_id:str):
+        with self.__lock:
+            if run_id in self.__runs:
+                self.__runs[run_id] -= 1
+                if self.__runs[run_id] <= 0:
+                    del self.__runs[run_id]
+
+    def resuming(self,run_id:str):
+        with self.__lock:
+            return run_id in self.__runs
+
+    def record(self,writer:ImageDataWriter,run_id:str,stage:str,output_folder:str,input_path:str,output_path:str):
+        """
+        Mark input_path done for a stage, called inside writer.transaction() with the stage's own statement.
+        """
+        if run_id == "":
+            return
+        writer.execute(
+            """INSERT OR REPLACE INTO stage_checkpoints (run_id, stage, output_folder, input_path, output_path, completed_at)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            (run_id, stage, output_folder, input_path, output_path, time.time())
+        )
+
+    def pending(self,connection:sqlite3.Connection,writer:ImageDataWriter,run_id:str,stage:str,output_folder:str,files):
+        """
+        Filter the files of a stage down to the ones not completed yet when the run is resumed.
+
+        Parameters:
+            stage: str - Name of the stage, as given to record.
+            files: iterable - Input files of the stage.
+
+        Yields:
+            path: str - Files left to process. The outputs of the skipped files are published
+                to the readers of output_folder, as if they were written again.
+        """
+        if not self.resuming(run_id):
+            for path in files:
+                yield path
+            return
+
+        writer.flush()
+        with writer.locked(), connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT input_path, output_path FROM stage_checkpoints WHERE run_id = ? AND stage = ? AND output_folder = ?",
+                (run_id, stage, output_folder)
+            )
+            completed = dict(cursor.fetchall())
+            cursor.close()
+
+        for path in files:
+            if path in completed:
+                streams.publish(run_id,output_folder,completed[path])
+                continue
+            yield path
+
+
+checkpoints = Checkpoints()
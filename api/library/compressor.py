@@ -1,199 +1,158 @@
-import glob
 import os
 import sqlite3
-from tqdm import tqdm
-from PIL import Image
 import time
-import json
-import numpy as np
-from tensorflow import keras
+from .image_data_writer import ImageDataWriter
+from .autoencoder import bounded_batch_size, run_batch
+from .stage_runner import StageRunner
+from . import sources
+
+ENCODER_MODEL_PATH = 'encoder_input.h5'
+
+
+def _compress_png(input_path:str, output_folder:str,quality:int):
+    file_name = input_path.split("/")[-1]
+    output_path = f"{output_folder}/{file_name.replace('.tif', '')}.png"
+    input_file_size = sources.get_size(input_path)
+    # start time
+    start_time = time.perf_counter()
+    with sources.open_image(input_path) as img:     
+        img.save(output_path, "PNG", optimize=True, quality=quality)
+        end_time = time.perf_counter()
+        return {
+            "height":img.height,
+            "width":img.width,
+            "input_image_size":input_file_size,
+            "compressed_image_path":output_path,
+            "compressed_image_size":os.path.getsize(output_path),
+            "compression_time":(end_time - start_time) * 1_000_000
+        }
+
+
+def _compress_jpeg(input_path:str, output_folder:str,quality:int):
+    file_name = input_path.split("/")[-1]
+    output_path = f"{output_folder}/{file_name.replace('.tif', '')}.jpg"
+    input_file_size = sources.get_size(input_path)
+    start_time = time.perf_counter()
+    with sources.open_image(input_path) as img:   
+        img.save(output_path, "JPEG", quality=quality)
+        end_time = time.perf_counter()
+        return {
+            "height":img.height,
+            "width":img.width,
+            "input_image_size":input_file_size,
+            "compressed_image_path":output_path,
+            "compressed_image_size":os.path.getsize(output_path),
+            "compression_time":(end_time - start_time) * 1_000_000
+        }
+
+
+def _describe(input_path:str, img):
+    return {
+        "height":img.height,
+        "width":img.width,
+        "input_image_size":sources.get_size(input_path)
+    }
+
 
 class Compressor:
     
-    def __init__(self,connection:sqlite3.Connection):
+    def __init__(self,connection:sqlite3.Connection,writer:ImageDataWriter):
         self.__connection = connection
-
-
-    def __compress_png(self,input_path:str, output_folder:str,quality:int,run_id:str):
-        file_name = input_path.split("/")[-1]
-        input_file_size = os.path.getsize(input_path)
-        # start time
-        start_time = time.perf_counter()
-        with Image.open(input_path) as img:     
-            with self.__connection:      
-                self.__connection.execute(
-                    """INSERT INTO image_data (run_id, height,width,input_image_path, input_image_size) VALUES (?, ?,?,?, ?)""",
-                    (run_id, img.height,img.width,input_path,input_file_size )
-                )                
-            img.save(f"{output_folder}/{file_name.replace('.tif','')}.png", "PNG", optimize=True, quality=quality)
-            end_time = time.perf_counter()
-            # Update the compressed image path and size in the database
-            with self.__connection:   
-                self.__connection.execute(
-                    """UPDATE image_data 
-                    SET compressed_image_path = ?,
-                    compressed_image_size = ?,
-                    compression_time = ? 
-                    WHERE input_image_path = ? AND run_id = ?""",
-                    (f"{output_folder}/{file_name.replace('.tif', '')}.png", 
-                     os.path.getsize(f"{output_folder}/{file_name.replace('.tif', '')}.png"), 
-                     (end_time - start_time) * 1_000_000,
-                     input_path, 
-                     run_id)
-                )
-
-    def __compress_jpeg(self,input_path:str, output_folder:str,quality:int,run_id:str):
-        file_name = input_path.split("/")[-1]
-        input_file_size = os.path.getsize(input_path)
-        start_time = time.perf_counter()
-        with Image.open(input_path) as img:   
-            print(img.height,img.width)  
-            with self.__connection:      
-                self.__connection.execute(
-                    """INSERT INTO image_data (run_id, height,width,input_image_path, input_image_size) VALUES (?,?,?, ?, ?)""",
-                    (run_id,img.height,img.width, input_path,input_file_size )
-                )                
-            img.save(f"{output_folder}/{file_name.replace('.tif','')}.jpg", "JPEG", quality=quality)
-            # Update the compressed image path and size in the database
-            end_time = time.perf_counter()
-            with self.__connection:   
-                self.__connection.execute(
-                    """UPDATE image_data 
-                    SET compressed_image_path = ?, 
-                    compressed_image_size = ?,
-                    compression_time = ? 
-                    WHERE input_image_path = ? AND run_id = ?""",
-                    (f"{output_folder}/{file_name.replace('.tif', '')}.jpg", 
-                     os.path.getsize(f"{output_folder}/{file_name.replace('.tif', '')}.jpg"), 
-                     (end_time - start_time) * 1_000_000,
-                     input_path, 
-                     run_id)
-                )
-
-    def __compress_dl_encoder(self,input_path:str, output_folder:str,run_id:str):
-        file_name = input_path.split("/")[-1]
-        input_file_size = os.path.getsize(input_path)
-        start_time = time.perf_counter()
-        with Image.open(input_path) as img:   
-            print(img.height,img.width)  
-            with self.__connection:      
-                self.__connection.execute(
-                    """INSERT INTO image_data (run_id, height,width,input_image_path, input_image_size) VALUES (?,?,?, ?, ?)""",
-                    (run_id,img.height,img.width, input_path,input_file_size )
-                )                            
-            
-
-            model = keras.models.load_model('encoder_input.h5')
-            img = img.resize((256,256))
-            img_array = np.array(img)
-            img_array = img_array/255.0
-            img_array = img_array.reshape(1,256,256,3)
-            img_array = model.predict(img_array)
-            img_array = img_array*255
-            img_array = img_array.reshape(256,256,3)
-            img_array = Image.fromarray(img_array.astype('uint8'))
-            img_array.save(f"{output_folder}/{file_name.replace('.tif','')}.jpg", "JPEG")
-            end_time = time.perf_counter()
-            with self.__connection:   
-                self.__connection.execute(
-                    """UPDATE image_data 
-                    SET compressed_image_path = ?, 
-                    compressed_image_size = ?,
-                    compression_time = ? 
-                    WHERE input_image_path = ? AND run_id = ?""",
-                    (f"{output_folder}/{file_name.replace('.tif', '')}.jpg", 
-                     os.path.getsize(f"{output_folder}/{file_name.replace('.tif', '')}.jpg"), 
-                     (end_time - start_time) * 1_000_000,
-                     input_path, 
-                     run_id)
-                )
+        self.__writer = writer
+        self.__runner = StageRunner(connection,writer)
+
+
+    def __log(self,input_path:str,result:dict,run_id:str):
+        # Insert the input and compressed image details in the database
+        self.__writer.execute(
+            """INSERT INTO image_data (run_id, height,width,input_image_path, input_image_size, compressed_image_path, compressed_image_size, compression_time) VALUES (?,?,?,?,?,?,?,?)""",
+            (run_id,
+             result["height"],
+             result["width"],
+             input_path,
+             result["input_image_size"],
+             result["compressed_image_path"],
+             result["compressed_image_size"],
+             result["compression_time"])
+        )
+
+    def __compress(self,worker,input_path:str, output_folder:str,run_id:str,workers:int,**params):
+        return self.__runner.run(
+            worker,
+            dict(params,output_folder=output_folder),
+            input_path,
+            "tif",
+            run_id,
+            workers,
+            output_folder=output_folder,
+            stage=worker.__name__.strip("_"),
+            log=lambda path, result: self.__log(path,result,run_id),
+            output_of=lambda path, result: result["compressed_image_path"],
+            cached=True
+        )
+
+    def __compress_dl_encoder(self,input_paths:list, output_folder:str):
+        """
+        Encode a batch of images with one forward pass of the encoder.
+
+        Returns:
+            (results, errors): tuple - As run_batch, keyed by input path.
+        """
+        return run_batch(
+            ENCODER_MODEL_PATH,
+            input_paths,
+            output_folder,
+            sources.open_image,
+            ("compressed_image_path","compressed_image_size","compression_time"),
+            describe=_describe
+        )
         
-    def compress_png(self,input_path:str, output_folder:str,quality:int,run_id:str):
+    def compress_png(self,input_path:str, output_folder:str,quality:int,run_id:str,workers:int = 1):
         
-        # if the input path is a file, convert that file
-        if os.path.isfile(input_path):
-            self.__compress_png(input_path,output_folder,quality,run_id)
+        # if the input path is a file or an archive member, convert that file
+        if sources.is_file(input_path):
+            with self.__writer.transaction() as unit:
+                self.__log(input_path,_compress_png(input_path,output_folder,quality),run_id)
+            self.__writer.commit(unit)
             return
-        # Get all tiff files in the folder even in subdirectories
-        tiff_files = glob.glob(f"{input_path}/**/*.tif", recursive=True)
-
-        # Create the output folder if it does not exist
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder, exist_ok=True)
 
-        to_return = {
-            "success":0,
-            "failed":0,
-            "total":len(tiff_files)
-        }
+        for res in self.__compress(_compress_png,input_path,output_folder,run_id,workers,quality=quality):
+            yield res
 
-        for tiff_file in tqdm(tiff_files):
-            try:
-                self.__compress_png(tiff_file,output_folder,quality,run_id)
-                to_return["success"] += 1
-                yield json.dumps(to_return)
-            except Exception as e:
-                to_return["failed"] += 1
-                yield json.dumps(to_return)
-                yield str(e)
-                continue
-
-    def compress_jpeg(self,input_path:str, output_folder:str,quality:int,run_id:str):
+    def compress_jpeg(self,input_path:str, output_folder:str,quality:int,run_id:str,workers:int = 1):
         
-        # if the input path is a file, convert that file
-        if os.path.isfile(input_path):
-            self.__compress_jpeg(input_path,output_folder,quality,run_id)
+        # if the input path is a file or an archive member, convert that file
+        if sources.is_file(input_path):
+            with self.__writer.transaction() as unit:
+                self.__log(input_path,_compress_jpeg(input_path,output_folder,quality),run_id)
+            self.__writer.commit(unit)
             return
-        # Get all tiff files in the folder even in subdirectories
-        tiff_files = glob.glob(f"{input_path}/**/*.tif", recursive=True)
-
-        # Create the output folder if it does not exist
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder, exist_ok=True)
 
-        to_return = {
-            "success":0,
-            "failed":0,
-            "total":len(tiff_files)
-        }
+        for res in self.__compress(_compress_jpeg,input_path,output_folder,run_id,workers,quality=quality):
+            yield res
 
-        for tiff_file in tqdm(tiff_files):
-            try:
-                self.__compress_jpeg(tiff_file,output_folder,quality,run_id)
-                to_return["success"] += 1
-                yield json.dumps(to_return)
-            except Exception as e:
-                to_return["failed"] += 1
-                yield json.dumps(to_return)
-                yield str(e)
-                continue
-
-    def compress_dl_encoder(self,input_path:str, output_folder:str,run_id:str):
+    def compress_dl_encoder(self,input_path:str, output_folder:str,run_id:str,batch_size:int = 16):
         
-        # if the input path is a file, convert that file
-        if os.path.isfile(input_path):
-            self.__compress_dl_encoder(input_path,output_folder,run_id)
+        # if the input path is a file or an archive member, convert that file
+        if sources.is_file(input_path):
+            results, errors = self.__compress_dl_encoder([input_path],output_folder)
+            if input_path in errors:
+                raise errors[input_path]
+            with self.__writer.transaction() as unit:
+                self.__log(input_path,results[input_path],run_id)
+            self.__writer.commit(unit)
             return
-        # Get all tiff files in the folder even in subdirectories
-        tiff_files = glob.glob(f"{input_path}/**/*.tif", recursive=True)
-
-        # Create the output folder if it does not exist
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder, exist_ok=True)
-
-        to_return = {
-            "success":0,
-            "failed":0,
-            "total":len(tiff_files)
-        }
 
-        for tiff_file in tqdm(tiff_files):
-            try:
-                self.__compress_dl_encoder(tiff_file,output_folder,run_id)
-                to_return["success"] += 1
-                yield json.dumps(to_return)
-            except Exception as e:
-                to_return["failed"] += 1
-                yield json.dumps(to_return)
-                yield str(e)
-                continue
+        for res in self.__runner.run(
+            self.__compress_dl_encoder,
+            {"output_folder":output_folder},
+            input_path,
+            "tif",
+            run_id,
+            output_folder=output_folder,
+            stage="compress_dl_encoder",
+            log=lambda path, result: self.__log(path,result,run_id),
+            output_of=lambda path, result: result["compressed_image_path"],
+            batch_size=bounded_batch_size(batch_size)
+        ):
+            yield res
@@ -1,11 +1,15 @@
 import copy
 import inspect
+from .cancellation import Cancelled, cancellation
+from .cache import stage_cache
+from .checkpoints import checkpoints
+from .scheduler import scheduler
 
 
 class Configurables:
 
-    def __init__(self):
-        pass
+    def __init__(self,fusion = None):
+        self.__fusion = fusion
 
 
     def get_config_template(self):
@@ -143,7 +147,23 @@ class Configurables:
         return methods
 
 
-    def run(self,run_id:str,config:dict,clf):
+    def run(self,run_id:str,config:dict,clf,fused:bool = False,scheduled:bool = False,cached:bool = False,resume:bool = False):
+        """
+        Run every item of a pipeline config in order.
+
+        Parameters:
+            run_id: str - Unique identifier for the current run.
+            config: list - Items with an execution_path and its params.
+            clf: SatEval - Object holding the modules.
+            fused: bool - Stream every tile through chains of file stages in memory instead of
+                writing and reading a folder per stage, see Fusion.
+            scheduled: bool - Run the steps as a DAG, overlapping the stages and running the
+                evaluations at the same time, see Scheduler.
+            cached: bool - Reuse the outputs of earlier runs for files whose content, stage and
+                params match instead of processing them again, see StageCache.
+            resume: bool - Continue a run that stopped, with the same run_id and config, skipping
+                the files and rows every stage already finished, see Checkpoints.
+        """
 
         try:
             for item in config:
@@ -152,17 +172,54 @@ class Configurables:
         except Exception as ex:
             yield "Exception: Pipeline config validation failed: {}".format(str(ex))
 
+        token = cancellation.open(run_id)
+        if cached:
+            stage_cache.open(run_id)
+        if resume:
+            checkpoints.open(run_id)
         try:
             yield "Pipeline with Run ID: {} Started".format(run_id)   
-            for item in config:            
-                for res in self.run_item(run_id,item,clf):
+            if fused and self.__fusion is None:
+                raise ValueError("Fused execution is not available")
+            # without fusion every item is a step of its own
+            steps = self.__fusion.plan(config) if fused else [[item] for item in config]
+            if scheduled:
+                for res in scheduler.run(run_id,steps,lambda step: self.__run_step(run_id,step,config,clf)):
                     yield res
+            else:
+                for step in steps:            
+                    token.check()
+                    for res in self.__run_step(run_id,step,config,clf):
+                        yield res
+        except Cancelled:
+            yield "Pipeline with Run ID: {} cancelled".format(run_id)
+            return
         except Exception as ex:
             yield "Exception: Error running pipeline: {}".format(str(ex))
+        finally:
+            cancellation.release(run_id)
+            if cached:
+                stage_cache.release(run_id)
+            if resume:
+                checkpoints.release(run_id)
 
         yield "Pipeline with Run ID: {} completed".format(run_id)
         return
 
+    def __run_step(self,run_id:str,step:list,config:list,clf):
+        if len(step) == 1:
+            for res in self.run_item(run_id,step[0],clf):
+                yield res
+            return
+        try:
+            yield "Running fused chain: {}".format(" -> ".join(self.get_execution_path(item) for item in step))
+            for res in self.__fusion.run_chain(run_id,step,config):
+                yield res
+        except Cancelled:
+            raise
+        except Exception as ex:
+            yield str(ValueError("Error running fused chain: {}".format(str(ex))))
+
     def run_item(self,run_id:str,config:dict,clf):
         execution_path = self.get_execution_path(config)
         params = self.get_params(config)        
@@ -187,5 +244,8 @@ class Configurables:
             yield "Running module: {} method: {} with params: {}".format(module_name,method_name,params)
             for res in method(**params):
                 yield res            
+        except Cancelled:
+            # a cancelled run stops here instead of moving on to its next item
+            raise
         except Exception as ex:
             yield str(ValueError("Error running method: {}".format(str(ex))))
@@ -5,90 +5,446 @@ from tqdm import tqdm
 import zipfile
 import json
 import time
+import hashlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import zlib
+from requests.adapters import HTTPAdapter
+from .executor import executor
+from .cancellation import Cancelled, cancellation
+from .sources import open_archive
+from .image_data_writer import ImageDataWriter
+
+DOWNLOAD_CHUNK_SIZE = 2048000
+# smaller reads per range so an interrupted range keeps most of what it received
+RANGE_CHUNK_SIZE = 512 * 1024
+MAX_CONNECTIONS = 16
+STATE_SAVE_INTERVAL = 1
+
+
+def _sha256(path:str):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _member_path(destination_path:str, name:str):
+    # same sanitising as ZipFile.extract, so the skip check looks where the member would be written
+    name = name.replace('/', os.path.sep)
+    if os.path.altsep:
+        name = name.replace(os.path.altsep, os.path.sep)
+    name = os.path.splitdrive(name)[1]
+    parts = [part for part in name.split(os.path.sep) if part not in ('', os.path.curdir, os.path.pardir)]
+    return os.path.join(destination_path, *parts)
+
+
+def _is_extracted(info:zipfile.ZipInfo, path:str):
+    if not os.path.isfile(path) or os.path.getsize(path) != info.file_size:
+        return False
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+    return crc == info.CRC
+
+
+def _extract_member(name:str, zip_file_path:str, destination_path:str):
+    """
+    Extract one file member unless a file with the same size and CRC is already on disk.
+
+    Its folder must already exist, unzip_file creates the folders before the members are extracted.
+
+    Returns:
+        skipped: bool - True when the member was already extracted.
+    """
+    zip_ref = open_archive(zip_file_path)
+    info = zip_ref.getinfo(name)
+    if _is_extracted(info, _member_path(destination_path, name)):
+        return True
+    zip_ref.extract(info, destination_path)
+    return False
+
 
 class DatasetLoader:
     base_dir:str
 
-    def __init__(self, base_dir:str,connection:sqlite3.Connection):
+    def __init__(self, base_dir:str,connection:sqlite3.Connection,writer:ImageDataWriter):
         # get current working directory
         cwd = os.getcwd()
         # set the base directory to the current working directory        
         self.base_dir = os.path.join(cwd, base_dir)
         self.__connection = connection
+        self.__writer = writer
+        self.__index_lock = threading.Lock()
+        # pooled session so range requests reuse their connections
+        self.__session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=MAX_CONNECTIONS,pool_maxsize=MAX_CONNECTIONS)
+        self.__session.mount("http://",adapter)
+        self.__session.mount("https://",adapter)
 
-    def load_by_url(self, url: str, file_name: str):
-    # Disable SSL certificate verification (for SSL errors)
-        destination_path = os.path.join(self.base_dir, file_name)
-        
-        # Create the directory if it does not exist
-        os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+    def __probe(self, url:str):
+        """
+        Ask the server for the size of the file and whether it serves byte ranges.
 
-        # Check if the file already exists
-        if os.path.exists(destination_path):
-            yield str(f"File {file_name} already exists")
+        Returns:
+            (size, ranges): tuple - Size in bytes or None when unknown, True when ranges are supported.
+        """
+        try:
+            response = self.__session.head(url, allow_redirects=True, verify=False)
+        except requests.RequestException:
+            return None, False
+        if response.status_code != 200 or 'content-length' not in response.headers:
+            return None, False
+        return int(response.headers['content-length']), response.headers.get('accept-ranges', '').lower() == 'bytes'
+
+    def __plan(self, url:str, part_path:str, state_path:str, size:int, connections:int):
+        """
+        Split the download into ranges, continuing the ones recorded next to the partial file.
+
+        Returns:
+            segments: list - {"start","end","done"} dictionaries, done counts the bytes already on disk.
+        """
+        if os.path.exists(part_path) and os.path.exists(state_path):
+            try:
+                with open(state_path) as f:
+                    state = json.load(f)
+                if state["url"] == url and state["size"] == size and os.path.getsize(part_path) == size:
+                    return state["segments"]
+            except (ValueError, KeyError, OSError):
+                pass
+
+        # a partial file without state is a truncated single stream, its prefix is kept
+        existing = os.path.getsize(part_path) if os.path.exists(part_path) and not os.path.exists(state_path) else 0
+        if existing > size:
+            existing = 0
+        step = max(1, -(-size // connections))
+        segments = [
+            {"start":start, "end":min(size, start + step), "done":max(0, min(existing - start, step))}
+            for start in range(0, size, step)
+        ]
+        with open(part_path, 'r+b' if existing > 0 else 'wb') as f:
+            f.truncate(size)
+        return segments
+
+    def __save_state(self, url:str, state_path:str, size:int, segments:list):
+        with open(f"{state_path}.tmp", 'w') as f:
+            json.dump({"url":url, "size":size, "segments":segments}, f)
+        os.replace(f"{state_path}.tmp", state_path)
+
+    def __fetch_segment(self, url:str, part_path:str, segment:dict, progress:queue.Queue, stop:threading.Event):
+        start = segment["start"] + segment["done"]
+        if start >= segment["end"]:
             return
+        headers = {"Range":f"bytes={start}-{segment['end'] - 1}"}
+        with self.__session.get(url, headers=headers, stream=True, verify=False) as response:
+            if response.status_code != 206:
+                raise ValueError(f"Range request failed. Status code: {response.status_code}")
+            fd = os.open(part_path, os.O_WRONLY)
+            try:
+                for chunk in response.iter_content(chunk_size=RANGE_CHUNK_SIZE):
+                    if stop.is_set():
+                        return
+                    if chunk:
+                        chunk = chunk[:segment["end"] - segment["start"] - segment["done"]]
+                        os.pwrite(fd, chunk, segment["start"] + segment["done"])
+                        segment["done"] += len(chunk)
+                        progress.put(len(chunk))
+            finally:
+                os.close(fd)
+        if segment["start"] + segment["done"] < segment["end"]:
+            raise ValueError(f"Connection closed after {segment['done']} bytes of range {segment['start']}-{segment['end'] - 1}")
+
+    def __download_ranges(self, url:str, file_name:str, part_path:str, state_path:str, size:int, connections:int):
+        segments = self.__plan(url, part_path, state_path, size, connections)
+        self.__save_state(url, state_path, size, segments)
+
+        to_return = {
+            "success":sum(segment["done"] for segment in segments),
+            "failed":0,
+            "total":size
+        }
+        yield json.dumps(to_return)
 
+        progress = queue.Queue()
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=max(1, len(segments))) as pool, tqdm(
+            desc=file_name,
+            total=size,
+            initial=to_return["success"],
+            unit='B',
+            unit_scale=True,
+            unit_divisor=1024,
+        ) as bar:
+            futures = [pool.submit(self.__fetch_segment, url, part_path, segment, progress, stop) for segment in segments]
+            saved_at = time.monotonic()
+            try:
+                while True:
+                    try:
+                        received = progress.get(timeout=0.5)
+                    except queue.Empty:
+                        if all(future.done() for future in futures) and progress.empty():
+                            break
+                        continue
+                    # report everything the ranges received since the last line at once
+                    while not progress.empty():
+                        received += progress.get_nowait()
+                    bar.update(received)
+                    to_return["success"] += received
+                    yield json.dumps(to_return)
+                    if time.monotonic() - saved_at >= STATE_SAVE_INTERVAL:
+                        self.__save_state(url, state_path, size, segments)
+                        saved_at = time.monotonic()
+            finally:
+                # stop the ranges and record how far each got, so the next call resumes from there
+                stop.set()
+                self.__save_state(url, state_path, size, segments)
+
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if len(errors) > 0:
+            raise errors[0]
+
+    def __download_stream(self, url:str, file_name:str, part_path:str):
         # Get the response with streaming enabled
-        response = requests.get(url, stream=True, verify=False)
-                
+        response = self.__session.get(url, stream=True, verify=False)
 
         # Check if the request was successful
-        if response.status_code == 200:
-            total_size = int(response.headers.get('content-length', 0))  # Total size in bytes
-            to_return = {
+        if response.status_code != 200:
+            raise ValueError(f"Status code: {response.status_code}")
+
+        total_size = int(response.headers.get('content-length', 0))  # Total size in bytes
+        to_return = {
             "success":0,
             "failed":0,
             "total":total_size
         }
-            
-            yield json.dumps(to_return)
+        yield json.dumps(to_return)
 
-            
-            # Use tqdm to show a progress bar
-            with open(destination_path, 'wb') as f, tqdm(
-                desc=file_name,
-                total=total_size,
-                unit='B',
-                unit_scale=True,
-                unit_divisor=1024,
-            ) as bar:
-                for chunk in response.iter_content(chunk_size=2048000):
-                    if chunk:  # Filter out keep-alive chunks
-                        f.write(chunk)
-                        bar.update(len(chunk))
-                        to_return["success"] += len(chunk)
-                        yield json.dumps(to_return)
-
-            yield "{} File Downloaded".format(file_name)
+        # Use tqdm to show a progress bar
+        with open(part_path, 'wb') as f, tqdm(
+            desc=file_name,
+            total=total_size,
+            unit='B',
+            unit_scale=True,
+            unit_divisor=1024,
+        ) as bar:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if chunk:  # Filter out keep-alive chunks
+                    f.write(chunk)
+                    bar.update(len(chunk))
+                    to_return["success"] += len(chunk)
+                    yield json.dumps(to_return)
 
-            # Create a sqlite table if not exists and insert metadata of the downloaded file into the table
-            with self.__connection:                
-                self.__connection.execute(
-                    "INSERT INTO datasets (name, path) VALUES (?, ?)", (file_name, destination_path)
-                )            
-
-        else:
-            yield str(f"Error in downloading file. Status code: {response.status_code}")
-
-    def list(self):
-        datasets = []
-        # list all the folders recursively in the base directory
-        for root, dirs, files in os.walk(self.base_dir):
-            # only directories with files are considered
-            if len(files) > 0:
-                # add the directory to the list of datasets create hirearchy in the form of a dictionary
-                if "__MACOSX" not in root:
-                    datasets.append(
-                        {
-                            "name": os.path.basename(root),
-                            "path": root,
-                            "files": files
-                        }
-                    )
-
-        return datasets
+    def load_by_url(self, url: str, file_name: str,connections:int = 1,checksum:str = ""):
+        """
+        Download a dataset archive, resuming an interrupted download when the server supports ranges.
+
+        Parameters:
+            url: str - Address of the file.
+            file_name: str - Name of the file in the dataset directory.
+            connections: int - Number of byte ranges fetched in parallel.
+            checksum: str - Expected sha256 hex digest, verified before the dataset is recorded.
+        """
+        destination_path = os.path.join(self.base_dir, file_name)
+        # bytes are written here and only renamed to destination_path once verified
+        part_path = f"{destination_path}.part"
+        state_path = f"{part_path}.json"
+
+        # Create the directory if it does not exist
+        os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+
+        size, ranges = self.__probe(url)
+
+        # Check if the file already exists
+        if os.path.exists(destination_path):
+            if size is None or os.path.getsize(destination_path) == size:
+                yield str(f"File {file_name} already exists")
+                return
+            # an earlier download stopped short, continue it as a partial file
+            os.replace(destination_path, part_path)
+
+        try:
+            if size is not None and ranges:
+                connections = max(1, min(connections, MAX_CONNECTIONS))
+                for res in self.__download_ranges(url, file_name, part_path, state_path, size, connections):
+                    yield res
+            else:
+                for res in self.__download_stream(url, file_name, part_path):
+                    yield res
+        except Exception as e:
+            yield str(f"Error in downloading file. {str(e)}")
+            return
+
+        # Verify the download before it is recorded
+        if size is not None and os.path.getsize(part_path) != size:
+            yield str(f"Error in downloading file. Expected {size} bytes, got {os.path.getsize(part_path)}")
+            return
+        if checksum != "" and _sha256(part_path) != checksum.lower():
+            os.remove(part_path)
+            if os.path.exists(state_path):
+                os.remove(state_path)
+            yield str(f"Error in downloading file. Checksum mismatch for {file_name}")
+            return
+
+        os.replace(part_path, destination_path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+
+        yield "{} File Downloaded".format(file_name)
+
+        # Create a sqlite table if not exists and insert metadata of the downloaded file into the table
+        self.__writer.commit(self.__writer.execute(
+            "INSERT INTO datasets (name, path) VALUES (?, ?)", (file_name, destination_path)
+        ))
+
+    def __remove_directory(self, path:str):
+        # drop a folder that disappeared together with everything indexed below it
+        for table, column in [("file_index","folder"),("directory_index","path")]:
+            self.__writer.execute(
+                f"DELETE FROM {table} WHERE {column} = ? OR substr({column}, 1, ?) = ?",
+                (path, len(path) + 1, f"{path}/")
+            )
+
+    def __refresh_directory(self, path:str, parent:str):
+        """
+        Bring the index of one folder up to date, rescanning it only when its mtime changed.
+
+        A folder's mtime changes when entries are added, removed or renamed in it, so an
+        unchanged folder keeps its indexed files and only its known subfolders are visited.
+        """
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self.__remove_directory(path)
+            return
+
+        with self.__writer.locked():
+            row = self.__connection.execute("SELECT mtime FROM directory_index WHERE path = ?", (path,)).fetchone()
+            children = [child for child, in self.__connection.execute("SELECT path FROM directory_index WHERE parent = ?", (path,))]
+        if row is not None and row[0] == mtime:
+            for child in children:
+                self.__refresh_directory(child, path)
+            return
+
+        with self.__writer.locked():
+            indexed = {name for name, in self.__connection.execute("SELECT name FROM file_index WHERE folder = ?", (path,))}
+        files = []
+        folders = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name != "__MACOSX":
+                        folders.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry)
+
+        for entry in files:
+            stat = entry.stat()
+            self.__writer.execute(
+                "INSERT OR REPLACE INTO file_index (path, folder, name, size, mtime, format) VALUES (?, ?, ?, ?, ?, ?)",
+                (entry.path, path, entry.name, stat.st_size, stat.st_mtime_ns, os.path.splitext(entry.name)[1].lstrip(".").lower())
+            )
+        for name in indexed - {entry.name for entry in files}:
+            self.__writer.execute("DELETE FROM file_index WHERE path = ?", (os.path.join(path, name),))
+        for child in set(children) - set(folders):
+            self.__remove_directory(child)
+        for folder in folders:
+            self.__refresh_directory(folder, path)
+
+        self.__writer.execute(
+            "INSERT OR REPLACE INTO directory_index (path, parent, mtime) VALUES (?, ?, ?)",
+            (path, parent, mtime)
+        )
+
+    def refresh_index(self):
+        """
+        Update the file index of the dataset directory, rescanning only the folders that changed.
+        """
+        with self.__index_lock:
+            try:
+                if os.path.isdir(self.base_dir):
+                    self.__refresh_directory(self.base_dir, None)
+                else:
+                    self.__remove_directory(self.base_dir)
+            finally:
+                self.__writer.flush()
+
+    def list(self, page:int = 0, page_size:int = 0, pattern:str = "", folder:str = ""):
+        """
+        List the indexed dataset files, refreshing the index first.
+
+        Parameters:
+            page: int - Page of files to return when page_size is set, starting at 0.
+            page_size: int - Number of files per page, 0 returns every folder with its file names.
+            pattern: str - Glob matched against the file names, e.g. '*.tif'.
+            folder: str - Only list below this folder, absolute or relative to the dataset directory.
+
+        Returns:
+            datasets: list - {"name","path","files"} for every folder with files when page_size is 0,
+                otherwise a dictionary with the per folder counts of the whole selection and one page of files.
+        """
+        self.refresh_index()
+
+        conditions = []
+        params = []
+        if pattern != "":
+            conditions.append("name GLOB ?")
+            params.append(pattern)
+        if folder != "":
+            root = folder if os.path.isabs(folder) else os.path.join(self.base_dir, folder)
+            root = root.rstrip("/")
+            conditions.append("(folder = ? OR substr(folder, 1, ?) = ?)")
+            params.extend([root, len(root) + 1, f"{root}/"])
+        where = f"WHERE {' AND '.join(conditions)}" if len(conditions) > 0 else ""
+
+        with self.__writer.locked():
+            if page_size <= 0:
+                datasets = []
+                for path, name in self.__connection.execute(f"SELECT folder, name FROM file_index {where} ORDER BY folder, name", params):
+                    # only directories with files are considered
+                    if len(datasets) == 0 or datasets[-1]["path"] != path:
+                        datasets.append(
+                            {
+                                "name": os.path.basename(path),
+                                "path": path,
+                                "files": []
+                            }
+                        )
+                    datasets[-1]["files"].append(name)
+                return datasets
+
+            folders = [
+                {"name":os.path.basename(path), "path":path, "count":count}
+                for path, count in self.__connection.execute(f"SELECT folder, COUNT(*) FROM file_index {where} GROUP BY folder ORDER BY folder", params)
+            ]
+            cursor = self.__connection.execute(
+                f"SELECT path, folder, name, size, mtime, format FROM file_index {where} ORDER BY folder, name LIMIT ? OFFSET ?",
+                params + [page_size, max(0, page) * page_size]
+            )
+            columns = [column[0] for column in cursor.description]
+            return {
+                "page":page,
+                "page_size":page_size,
+                "total":sum(item["count"] for item in folders),
+                "folders":folders,
+                "files":[dict(zip(columns, row)) for row in cursor.fetchall()]
+            }
     
-    def unzip_file(self, zip_file_path_or_name: str,destination_folder:str):               
+    def unzip_file(self, zip_file_path_or_name: str,destination_folder:str,workers:int = 1,run_id:str = ""):
+        """
+        Extract an archive member by member, yielding progress after every member.
+
+        Members already on disk with the same size and CRC are skipped and __MACOSX
+        entries are left out.
+
+        Parameters:
+            zip_file_path_or_name: str - Archive path, or its name in the dataset directory.
+            destination_folder: str - Folder in the dataset directory to extract to.
+            workers: int - Number of processes extracting members, 0 uses every core.
+            run_id: str - Run whose cancellation stops the extraction, members already extracted are skipped when it runs again.
+        """
 
         cwd = os.getcwd()
         try:
@@ -109,18 +465,45 @@ class DatasetLoader:
                 os.makedirs(destination_path, exist_ok=True)
 
             with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                zip_ref.extractall(destination_path)
-                yield str(f"Unzipped {file_path} to {destination_path}")
+                infos = [info for info in zip_ref.infolist() if "__MACOSX" not in info.filename.split("/")]
+
+            # create the folders up front, ZipFile.extract creates them without exist_ok and
+            # workers extracting members of the same folder would race to create it
+            for info in infos:
+                path = _member_path(destination_path, info.filename)
+                os.makedirs(path if info.is_dir() else os.path.dirname(path), exist_ok=True)
+            members = [info.filename for info in infos if not info.is_dir()]
+
+            to_return = {
+                "success":0,
+                "failed":0,
+                "skipped":0,
+                "total":len(members)
+            }
+
+            for _, skipped, error in tqdm(executor.map(_extract_member,members,workers,token=cancellation.token(run_id),zip_file_path=file_path,destination_path=destination_path),total=len(members)):
+                if error is not None:
+                    to_return["failed"] += 1
+                    yield json.dumps(to_return)
+                    yield str(error)
+                    continue
+                to_return["success"] += 1
+                if skipped:
+                    to_return["skipped"] += 1
+                yield json.dumps(to_return)
+
+            if to_return["failed"] > 0:
+                yield str(f"Unzipped {file_path} to {destination_path} with {to_return['failed']} failed members")
+                return
+
+            yield str(f"Unzipped {file_path} to {destination_path}")
             
             # Create a sqlite table if not exists and insert metadata of the downloaded file into the table
-            with self.__connection:            
-                self.__connection.execute(
-                    "INSERT INTO extracted_datasets (zip_file_path, destination_folder) VALUES (?, ?)", (file_path, destination_path)
-                )
+            self.__writer.commit(self.__writer.execute(
+                "INSERT INTO extracted_datasets (zip_file_path, destination_folder) VALUES (?, ?)", (file_path, destination_path)
+            ))
 
+        except Cancelled:
+            raise
         except Exception as e:
-            return f"Exception: {str(e)}"
-        
-
-        
-
+            yield f"Exception: {str(e)}"
@@ -1,169 +1,145 @@
-import glob
 import os
 import sqlite3
-import numpy as np
-from tqdm import tqdm
 from PIL import Image
 import time
-import json
-from tensorflow import keras
+from .image_data_writer import ImageDataWriter
+from .autoencoder import bounded_batch_size, run_batch
+from .stage_runner import StageRunner
+
+DECODER_MODEL_PATH = 'decoder_output.h5'
+
+
+def _decompress_png(input_path:str, output_folder:str):
+    file_name = input_path.split("/")[-1]
+    output_path = f"{output_folder}/{file_name}"
+    start_time = time.perf_counter()
+    with Image.open(input_path) as img:
+        img.save(output_path, "PNG")
+        end_time = time.perf_counter()
+        return {
+            "decompressed_image_path":output_path,
+            "decompressed_image_size":os.path.getsize(output_path),
+            "decompression_time":(end_time - start_time) * 1_000_000
+        }
 
 
-class Decompressor:
-    
-    def __init__(self,connection:sqlite3.Connection):
-        self.__connection = connection
+def _decompress_jpeg(input_path:str, output_folder:str):
+    file_name = input_path.split("/")[-1]
+    # the decoded pixels are stored losslessly so the evaluation sees exactly what the decoder produced
+    output_path = f"{output_folder}/{file_name.replace('.jpg','')}.png"
+    start_time = time.perf_counter()
+    with Image.open(input_path) as img:
+        img.save(output_path, "PNG")
+        end_time = time.perf_counter()
+        return {
+            "decompressed_image_path":output_path,
+            "decompressed_image_size":os.path.getsize(output_path),
+            "decompression_time":(end_time - start_time) * 1_000_000
+        }
 
 
-    def __decompress_png(self,input_path:str, output_folder:str,run_id:str):
-        file_name = input_path.split("/")[-1]
-        start_time = time.perf_counter()
-        with Image.open(input_path) as img:
-            img.save(f"{output_folder}/{file_name}", "PNG")
-            # self.__connection.execute(
-            #     "CREATE TABLE IF NOT EXISTS image_data (id INTEGER PRIMARY KEY AUTOINCREMENT,run_id TEXT,input_image_path TEXT, compressed_image_path TEXT, noisy_image_path TEXT,decompressed_image_path TEXT, input_image_size INTEGER, compressed_image_size INTEGER, noisy_image_size INTEGER, decompressed_image_size INTEGER)"
-            # )
-            # Update the decompressed image path and size in the database
-            end_time = time.perf_counter()
-            with self.__connection:   
-                self.__connection.execute(
-                """UPDATE image_data 
-                SET decompressed_image_path = ?, 
-                    decompressed_image_size = ?,
-                    decompression_time = ? 
-                WHERE run_id = ? 
-                AND (compressed_image_path = ? OR noisy_image_path = ?)""",
-                (f"{output_folder}/{file_name}", 
-                os.path.getsize(f"{output_folder}/{file_name}"), 
-                (end_time - start_time) * 1_000_000,
-                run_id, 
-                input_path, 
-                input_path)
-            )
-                
+class Decompressor:
     
-    def __decompress_dl_decoder(self,input_path:str, output_folder:str,run_id:str):
-        file_name = input_path.split("/")[-1]
-        start_time = time.perf_counter()
-        with Image.open(input_path) as img:
-            model = keras.models.load_model('decoder_output.h5')
-            img = img.resize((256,256))
-            img_array = np.array(img)
-            img_array = img_array/255.0
-            img_array = img_array.reshape(1,256,256,3)
-            img_array = model.predict(img_array)
-            img_array = img_array*255
-            img_array = img_array.reshape(256,256,3)
-            img_array = Image.fromarray(img_array.astype('uint8'))
-            img_array.save(f"{output_folder}/{file_name.replace('.tif','')}.jpg", "JPEG")
-            # self.__connection.execute(
-            #     "CREATE TABLE IF NOT EXISTS image_data (id INTEGER PRIMARY KEY AUTOINCREMENT,run_id TEXT,input_image_path TEXT, compressed_image_path TEXT, noisy_image_path TEXT,decompressed_image_path TEXT, input_image_size INTEGER, compressed_image_size INTEGER, noisy_image_size INTEGER, decompressed_image_size INTEGER)"
-            # )
-            # Update the decompressed image path and size in the database
-            end_time = time.perf_counter()
-            with self.__connection:   
-                self.__connection.execute(
-                """UPDATE image_data 
-                SET decompressed_image_path = ?, 
-                    decompressed_image_size = ? ,
-                    decompression_time = ? 
-                WHERE run_id = ? 
-                AND (compressed_image_path = ? OR noisy_image_path = ?)""",
-                (f"{output_folder}/{file_name.replace('.jpg','')}.tif", 
-                os.path.getsize(f"{output_folder}/{file_name.replace('.jpg','')}.tif"), 
-                (end_time - start_time) * 1_000_000,
-                run_id, 
-                input_path, 
-                input_path)
-            )
+    def __init__(self,connection:sqlite3.Connection,writer:ImageDataWriter):
+        self.__connection = connection
+        self.__writer = writer
+        self.__runner = StageRunner(connection,writer)
+
+
+    def __log(self,input_path:str,result:dict,run_id:str):
+        # Update the decompressed image path and size in the database
+        self.__writer.execute(
+            """UPDATE image_data 
+            SET decompressed_image_path = ?, 
+                decompressed_image_size = ?,
+                decompression_time = ? 
+            WHERE run_id = ? 
+            AND (compressed_image_path = ? OR noisy_image_path = ?)""",
+            (result["decompressed_image_path"], 
+            result["decompressed_image_size"], 
+            result["decompression_time"],
+            run_id, 
+            input_path, 
+            input_path)
+        )
+
+    def __decompress(self,worker,input_path:str, output_folder:str,file_type:str,run_id:str,workers:int):
+        return self.__runner.run(
+            worker,
+            {"output_folder":output_folder},
+            input_path,
+            file_type,
+            run_id,
+            workers,
+            output_folder=output_folder,
+            stage=worker.__name__.strip("_"),
+            log=lambda path, result: self.__log(path,result,run_id),
+            output_of=lambda path, result: result["decompressed_image_path"],
+            cached=True
+        )
+
+    def __decompress_dl_decoder(self,input_paths:list, output_folder:str):
+        """
+        Decode a batch of images with one forward pass of the decoder.
+
+        Returns:
+            (results, errors): tuple - As run_batch, keyed by input path.
+        """
+        return run_batch(
+            DECODER_MODEL_PATH,
+            input_paths,
+            output_folder,
+            Image.open,
+            ("decompressed_image_path","decompressed_image_size","decompression_time")
+        )
         
 
-    def decompress_jpeg(self, input_path:str, output_folder:str,run_id:str):
+    def decompress_jpeg(self, input_path:str, output_folder:str,run_id:str,workers:int = 1):
         
         # if the input path is a file, convert that file
         if os.path.isfile(input_path):
-            self.__decompress_jpeg(input_path,output_folder,run_id)
+            with self.__writer.transaction() as unit:
+                self.__log(input_path,_decompress_jpeg(input_path,output_folder),run_id)
+            self.__writer.commit(unit)
             return
 
-        # Get all tiff files in the folder even in subdirectories
-        tiff_files = glob.glob(f"{input_path}/**/*.jpg", recursive=True)
-
-        # Create the output folder if it does not exist
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder, exist_ok=True)
-
-        to_return = {
-            "success":0,
-            "failed":0,
-            "total":len(tiff_files)
-        }
+        for res in self.__decompress(_decompress_jpeg,input_path,output_folder,"jpg",run_id,workers):
+            yield res
 
-        for tiff_file in tqdm(tiff_files):
-            try:
-                self.__decompress_jpeg(tiff_file,output_folder,run_id)
-                to_return["success"] += 1
-                yield json.dumps(to_return)
-            except Exception as e:
-                to_return["failed"] += 1
-                yield json.dumps(to_return)
-                continue
-
-    def decompress_png(self, input_path:str, output_folder:str,run_id:str):
+    def decompress_png(self, input_path:str, output_folder:str,run_id:str,workers:int = 1):
         
         # if the input path is a file, convert that file
         if os.path.isfile(input_path):
-            self.__decompress_png(input_path,output_folder,run_id)
+            with self.__writer.transaction() as unit:
+                self.__log(input_path,_decompress_png(input_path,output_folder),run_id)
+            self.__writer.commit(unit)
             return
 
-        # Get all tiff files in the folder even in subdirectories
-        tiff_files = glob.glob(f"{input_path}/**/*.png", recursive=True)
-
-        # Create the output folder if it does not exist
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder, exist_ok=True)
-
-        to_return = {
-            "success":0,
-            "failed":0,
-            "total":len(tiff_files)
-        }
-
-        for tiff_file in tqdm(tiff_files):
-            try:
-                self.__decompress_png(tiff_file,output_folder,run_id)
-                to_return["success"] += 1
-                yield json.dumps(to_return)
-            except Exception as e:
-                to_return["failed"] += 1
-                yield json.dumps(to_return)
-                continue
+        for res in self.__decompress(_decompress_png,input_path,output_folder,"png",run_id,workers):
+            yield res
         
-    def decompress_dl_decoder(self, input_path:str, output_folder:str,run_id:str):
+    def decompress_dl_decoder(self, input_path:str, output_folder:str,run_id:str,batch_size:int = 16):
         
         # if the input path is a file, convert that file
         if os.path.isfile(input_path):
-            self.__decompress_dl_decoder(input_path,output_folder,run_id)
+            results, errors = self.__decompress_dl_decoder([input_path],output_folder)
+            if input_path in errors:
+                raise errors[input_path]
+            with self.__writer.transaction() as unit:
+                self.__log(input_path,results[input_path],run_id)
+            self.__writer.commit(unit)
             return
 
-        # Get all tiff files in the folder even in subdirectories
-        tiff_files = glob.glob(f"{input_path}/**/*.jpg", recursive=True)
-
-        # Create the output folder if it does not exist
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder, exist_ok=True)
-
-        to_return = {
-            "success":0,
-            "failed":0,
-            "total":len(tiff_files)
-        }
-
-        for tiff_file in tqdm(tiff_files):
-            try:
-                self.__decompress_dl_decoder(tiff_file,output_folder,run_id)
-                to_return["success"] += 1
-                yield json.dumps(to_return)
-            except Exception as e:
-                to_return["failed"] += 1
-                yield json.dumps(to_return)
-                continue
\ No newline at end of file
+        for res in self.__runner.run(
+            self.__decompress_dl_decoder,
+            {"output_folder":output_folder},
+            input_path,
+            "jpg",
+            run_id,
+            output_folder=output_folder,
+            stage="decompress_dl_decoder",
+            log=lambda path, result: self.__log(path,result,run_id),
+            output_of=lambda path, result: result["decompressed_image_path"],
+            batch_size=bounded_batch_size(batch_size)
+        ):
+            yield res
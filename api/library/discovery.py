@@ -0,0 +1,143 @@
+import fnmatch
+import os
+import threading
+from . import sources
+from .cancellation import cancellation
+from .streams import streams
+
+# entry names never worth processing, matched against every file and folder name
+DEFAULT_EXCLUDE = ["__MACOSX", ".*"]
+# number of runs whose listings are kept
+MAX_CACHED_RUNS = 8
+
+
+class Discovery:
+    """
+    Shared file discovery for the pipeline stages.
+
+    Files are streamed with os.scandir in a deterministic order, sorted by name and
+    depth first, so a stage can start on the first file before the tree is walked.
+    A complete listing is cached per run, so later stages of the same run that read
+    the same folder do not walk it again.
+    """
+
+    def __init__(self):
+        self.__cache = {}
+        self.__lock = threading.Lock()
+
+    def __walk(self, path:str, include:list, exclude:list):
+        try:
+            with os.scandir(path) as iterator:
+                entries = sorted(iterator, key=lambda entry: entry.name)
+        except (FileNotFoundError, NotADirectoryError):
+            return
+
+        for entry in entries:
+            if any(fnmatch.fnmatchcase(entry.name, pattern) for pattern in exclude):
+                continue
+            if entry.is_dir():
+                yield from self.__walk(entry.path, include, exclude)
+            elif any(fnmatch.fnmatchcase(entry.name, pattern) for pattern in include):
+                yield entry.path
+
+    def __members(self, path:str, include:list, exclude:list):
+        archive, _ = sources.split_archive_path(path)
+        # patterns apply to the path inside the archive, not to the folders holding it
+        base = f"{sources.ZIP_PREFIX}{os.path.abspath(archive)}/"
+        for member in sorted(sources.list_members(path)):
+            names = member[len(base):].split("/")
+            if any(fnmatch.fnmatchcase(name, pattern) for name in names for pattern in exclude):
+                continue
+            if any(fnmatch.fnmatchcase(names[-1], pattern) for pattern in include):
+                yield member
+
+    def files(self, input_path:str, extension:str = "", include:list = None, exclude:list = None, run_id:str = ""):
+        """
+        Yield the files below input_path, a folder or an archive, one at a time.
+
+        Parameters:
+            input_path: str - Folder, archive or folder inside an archive to search.
+            extension: str - Only yield files with this extension, e.g. 'tif'.
+            include: list - Glob patterns, a file is yielded when its name matches one of them.
+            exclude: list - Glob patterns, matching files and folders are skipped. Defaults to DEFAULT_EXCLUDE.
+            run_id: str - Listings are cached per run, an empty run_id disables the cache.
+                The run's cancellation token is checked before every file, so the per-file
+                loops of the stages stop with Cancelled once the run is cancelled. When the
+                folder is written by an earlier stage of a scheduled run, its files are
+                yielded as that stage publishes them.
+
+        Yields:
+            path: str - File path, or virtual zip path for archive members.
+        """
+        include = list(include) if include else []
+        if extension != "":
+            include.append(f"*.{extension}")
+        if len(include) == 0:
+            include = ["*"]
+        exclude = DEFAULT_EXCLUDE if exclude is None else list(exclude)
+
+        token = cancellation.token(run_id)
+        published = streams.subscribe(run_id, input_path)
+        if published is not None:
+            for path in published:
+                name = os.path.basename(path)
+                if any(fnmatch.fnmatchcase(name, pattern) for pattern in exclude):
+                    continue
+                if any(fnmatch.fnmatchcase(name, pattern) for pattern in include):
+                    token.check()
+                    yield path
+            return
+
+        key = (os.path.abspath(input_path), tuple(include), tuple(exclude))
+        if run_id != "":
+            with self.__lock:
+                cached = self.__cache.get(run_id, {}).get(key)
+            if cached is not None:
+                for path in cached:
+                    token.check()
+                    yield path
+                return
+
+        if sources.is_archive(input_path):
+            walker = self.__members(input_path, include, exclude)
+        else:
+            walker = self.__walk(input_path, include, exclude)
+
+        found = []
+        for path in walker:
+            token.check()
+            found.append(path)
+            yield path
+
+        # only complete listings are cached, a stage that stopped early leaves no partial entry
+        if run_id != "":
+            with self.__lock:
+                if run_id not in self.__cache and len(self.__cache) >= MAX_CACHED_RUNS:
+                    self.__cache.pop(next(iter(self.__cache)))
+                self.__cache.setdefault(run_id, {})[key] = found
+
+    def counted(self, files, to_return:dict, state:dict):
+        """
+        Pass files through, counting them into to_return["total"] as they are discovered.
+
+        state["complete"] turns true once the input is fully walked, until then the total is
+        the number of files found so far.
+        """
+        state["complete"] = False
+        for path in files:
+            to_return["total"] += 1
+            yield path
+        state["complete"] = True
+
+    def invalidate(self, path:str):
+        """
+        Drop every cached listing that covers path, called by the stages before they write into it.
+        """
+        path = os.path.abspath(path)
+        with self.__lock:
+            for listings in self.__cache.values():
+                for key in [key for key in listings if path == key[0] or path.startswith(f"{key[0]}{os.sep}")]:
+                    del listings[key]
+
+
+discovery = Discovery()
@@ -2,169 +2,81 @@ import base64
 from io import BytesIO
 import sqlite3
 import numpy as np
-from skimage.metrics import peak_signal_noise_ratio as psnr
-from skimage.metrics import structural_similarity as ssim
-from sklearn.metrics import mean_squared_error
 import lpips
 import torch
 from torchvision import transforms
 from PIL import Image
 from tqdm import tqdm
 import json
+import threading
 import pandas as pd
+import rasterio
+from rasterio.enums import Resampling
+from .image_data_writer import ImageDataWriter
+from .executor import executor
+from .cancellation import cancellation
+from .checkpoints import checkpoints
+from .streams import streams
+from . import sources
+from .metrics import BATCHED, CHEAP, POOLED, compute_metrics, resolve_metrics
 
-class Evaluator:
+LPIPS_NETS = ["alex","vgg","squeeze"]
 
-    def __init__(self,connection:sqlite3.Connection):
-        self.__connection = connection
 
-    def __calculate_psnr(self,img1, img2):
-        """
-        Calculate the Peak Signal-to-Noise Ratio (PSNR) between two images.
-
-        PSNR is a metric used to measure the quality of reconstructed images compared to original images, 
-        particularly in image compression and video encoding applications. It is defined as the ratio 
-        between the maximum possible power of a signal (the original image) and the power of corrupting 
-        noise (the difference between the original and reconstructed images).
-
-        PSNR Formula:
-            PSNR = 10 * log10(MAX_I^2 / MSE)
-
-        Where:
-            - MAX_I: Maximum possible pixel value of the image (255 for 8-bit images).
-            - MSE: Mean Squared Error calculated as:
-                MSE = (1/N) * sum((I(i) - K(i))^2)
-                Where:
-                - I: Original image.
-                - K: Reconstructed image.
-                - N: Number of pixels in the image.
-
-        Interpreting PSNR Values:
-            - Higher values indicate better quality.
-            - Common thresholds:
-                - Below 20 dB: Poor quality; noticeable distortion.
-                - 20-30 dB: Fair to good quality; noticeable artifacts may be present.
-                - 30-40 dB: Good quality; generally acceptable for most applications.
-                - Above 40 dB: Excellent quality; often indistinguishable from the original image.
+def _result_key(evaluation_id:str):
+    # json path of an evaluation in the results column, quoted so any id is a single key
+    return '$."{}"'.format(evaluation_id.replace('"','\\"'))
 
-        Limitations:
-            - PSNR may not correlate well with perceived visual quality.
-            - It does not account for how humans perceive images; two images with the same PSNR might look 
-                different to the human eye.
-        
-        Parameters:
-            img1: np.ndarray - First image (original image).
-            img2: np.ndarray - Second image (compressed or decompressed image).
-        
-        Returns:
-            psnr_value: float - PSNR value.
-        """
 
-        if np.array_equal(img1, img2):
-            return 50
-        psnr_value = psnr(img1, img2,data_range=255)
+def _evaluated(results:str,evaluation_id:str):
+    # failed evaluations are not stored, but rows written by older versions of evaluate_many
+    # may hold an error message instead of the metrics dict, those are evaluated again
+    return results is not None and isinstance(json.loads(results).get(evaluation_id),dict)
 
-        return psnr_value
-    
-    def __calculate_ssim(self,img1, img2):
-        """
-        Calculate the Structural Similarity Index (SSIM) between two images.
-
-        SSIM is a perceptual metric that quantifies the similarity between two images. 
-        It is based on the idea that the human visual system is highly sensitive to structural information 
-        in an image. SSIM considers changes in structural information, luminance, and contrast, 
-        providing a more accurate measure of perceived image quality than metrics like PSNR.
-
-        SSIM Formula:
-            SSIM(x, y) = (2 * μ_x * μ_y + C1) * (2 * σ_xy + C2) / ((μ_x^2 + μ_y^2 + C1) * (σ_x^2 + σ_y^2 + C2))
-
-        Where:
-            - μ_x and μ_y: Mean values of the two images.
-            - σ_x^2 and σ_y^2: Variances of the two images.
-            - σ_xy: Covariance between the two images.
-            - C1 and C2: Constants to stabilize the division; typically C1 = (K1 * L)^2 and C2 = (K2 * L)^2, where K1 and K2 are small constants, and L is the dynamic range of the pixel values.
-
-        Interpreting SSIM Values:
-            - SSIM values range from -1 to 1.
-            - A value of 1 indicates perfect structural similarity.
-            - Values closer to 1 indicate higher similarity, while values closer to -1 indicate lower similarity.
-            - Typical ranges:
-                - 0.9 to 1.0: Excellent quality; very similar images.
-                - 0.7 to 0.9: Good quality; noticeable but acceptable differences.
-                - 0.5 to 0.7: Fair quality; significant differences.
-                - Below 0.5: Poor quality; very different images.
-
-        Limitations:
-            - SSIM can be sensitive to alignment; images must be properly aligned to obtain accurate results.
-            - It may not capture all perceptual differences, especially for images with significant variations in lighting or content.
 
-        Parameters:
-        img1: np.ndarray - First image (original image).
-        img2: np.ndarray - Second image (compressed or decompressed image).
-        
-        Returns:
-            ssim_value: float - SSIM value.
-        """
-        min_size = min(img1.shape[:2])  # Get the minimum dimension of the image (height or width)
-    
-        # Set win_size to a smaller odd value if the image is too small
-        if min_size < 7:
-            win_size = min_size if min_size % 2 != 0 else min_size - 1  # Make sure win_size is odd
-            print(f"Image size is small. Using win_size = {win_size} for SSIM calculation.")
-        else:
-            win_size = 7  # Default win_size
-
-
-        # Calculate SSIM
-        ssim_value, _ = ssim(img1, img2, win_size=win_size, channel_axis=-1, full=True)
+class Evaluator:
 
-        return ssim_value
-        
+    def __init__(self,connection:sqlite3.Connection,writer:ImageDataWriter):
+        self.__connection = connection
+        self.__writer = writer
+        self.__to_tensor = transforms.ToTensor()
+        self.__lpips_models = {}
+        self.__lpips_lock = threading.Lock()
 
-    def __calculate_mse(self,img1, img2):
+    def __get_lpips_model(self,net:str):
         """
+        Return the LPIPS network for the given backbone, building it on first use.
 
-        Calculate the Mean Squared Error (MSE) between two images.
-
-        MSE is a measure of the average squared differences between the original and 
-        reconstructed images. It quantifies the error introduced by the compression or 
-        reconstruction process, providing a numerical value that indicates how closely 
-        the two images match.
-
-        MSE Formula:
-            MSE = (1/N) * sum((I(i) - K(i))^2)
-
-        Where:
-            - I(i): Pixel value of the original image at position i.
-            - K(i): Pixel value of the reconstructed/compressed image at position i.
-            - N: Total number of pixels in the image.
-
-        Interpreting MSE Values:
-            - Lower MSE values indicate better quality, as they represent less deviation 
-                from the original image.
-            - An MSE of 0 indicates perfect reconstruction, meaning the two images are identical.
-            - Common interpretation ranges:
-                - 0 to 10: Excellent quality; minimal differences.
-                - 10 to 20: Good quality; slight differences may be noticeable.
-                - 20 to 30: Fair quality; noticeable differences.
-                - Above 30: Poor quality; significant differences.
-
-        Limitations:
-            - MSE does not account for perceptual differences; it treats all pixel differences 
-                equally, which may not align with human visual perception.
-            - It can be overly sensitive to noise and outliers.
-        
         Parameters:
-            img1: np.ndarray - First image (original image).
-            img2: np.ndarray - Second image (compressed or decompressed image).
-        
+            net: str - One of LPIPS_NETS, an empty string or 'none' disables LPIPS.
+
         Returns:
-            mse_value: float - MSE value.
+            model: lpips.LPIPS - Cached network in eval mode, or None when disabled.
+        """
+        if net is None or net == "" or net.lower() == "none":
+            return None
+        if net not in LPIPS_NETS:
+            raise ValueError(f"Unknown LPIPS backbone {net}, expected one of {LPIPS_NETS}")
+        with self.__lpips_lock:
+            if net not in self.__lpips_models:
+                self.__lpips_models[net] = lpips.LPIPS(net=net).eval()
+            return self.__lpips_models[net]
+
+    def __resolve(self,names:list,lpips_net:str):
         """
-        mse_value = mean_squared_error(img1.flatten(), img2.flatten())
+        Resolve the requested metric names, loading the LPIPS network only when LPIPS is requested.
 
-        return mse_value
-            
+        Returns:
+            metrics: list - Metric registry entries to compute.
+            lpips_model: lpips.LPIPS - LPIPS network, or None when LPIPS is not computed.
+        """
+        metrics = resolve_metrics(names)
+        if "LPIPS" not in [metric.name for metric in metrics]:
+            return metrics, None
+        lpips_model = self.__get_lpips_model(lpips_net)
+        if lpips_model is None:
+            metrics = [metric for metric in metrics if metric.name != "LPIPS"]
+        return metrics, lpips_model
 
     def __calculate_lpips(self,img1, img2,model=lpips.LPIPS):
         """
@@ -208,53 +120,204 @@ class Evaluator:
             lpips_value: float - LPIPS distance (lower means more perceptually similar).
         """        
         # Convert images to torch tensors
-        transform = transforms.ToTensor()
-        
-        img1_tensor = transform(img1).unsqueeze(0)
-        img2_tensor = transform(img2).unsqueeze(0)
+        img1_tensor = self.__to_tensor(img1).unsqueeze(0)
+        img2_tensor = self.__to_tensor(img2).unsqueeze(0)
         
         # Calculate LPIPS
-        lpips_value = model(img1_tensor, img2_tensor)
+        with torch.inference_mode():
+            lpips_value = model(img1_tensor, img2_tensor)
 
         return lpips_value.item()
+
+    def __calculate_lpips_batch(self,pairs:list,model:lpips.LPIPS):
+        """
+        Calculate LPIPS for many image pairs with one forward pass per shape bucket.
+
+        Pairs are bucketed by image shape so they can be stacked without padding, which
+        would change the score. Pairs whose two images differ in shape, and buckets that
+        fail as a whole, fall back to __calculate_lpips so the error is reported per pair.
+
+        Parameters:
+            pairs: list - (img1, img2) tuples, None entries are skipped.
+            model: lpips.LPIPS - Pre-trained LPIPS model.
+
+        Returns:
+            lpips_values: list - LPIPS distance or Exception for every pair, None for skipped entries.
+        """
+        lpips_values = [None] * len(pairs)
+        buckets = {}
+        for index, pair in enumerate(pairs):
+            if pair is None:
+                continue
+            if pair[0].shape == pair[1].shape:
+                buckets.setdefault(pair[0].shape,[]).append(index)
+            else:
+                buckets.setdefault(None,[]).append(index)
+
+        for shape, indexes in buckets.items():
+            if shape is not None and len(indexes) > 1:
+                try:
+                    img1_tensor = torch.stack([self.__to_tensor(pairs[index][0]) for index in indexes])
+                    img2_tensor = torch.stack([self.__to_tensor(pairs[index][1]) for index in indexes])
+                    with torch.inference_mode():
+                        values = model(img1_tensor, img2_tensor).flatten().tolist()
+                    for index, value in zip(indexes,values):
+                        lpips_values[index] = value
+                    continue
+                except Exception:
+                    pass
+
+            for index in indexes:
+                try:
+                    lpips_values[index] = self.__calculate_lpips(pairs[index][0],pairs[index][1],model)
+                except Exception as e:
+                    lpips_values[index] = e
+
+        return lpips_values
     
-    def __evaluate(self,input_file_path:str,output_file_path:str,lpips_model:lpips.LPIPS = None):
+    def __load_image(self,path:str,images:dict):
         """
-        Evaluate the compressed image using various metrics.
-        
+        Decode the image at path once, returning the cached array on later calls.
+        """
+        if path not in images:
+            with sources.open_image(path) as img:
+                images[path] = np.array(img)
+        return images[path]
+
+    def __evaluate_pairs(self,pairs:list,metrics:list,lpips_model:lpips.LPIPS = None,workers:int = 1):
+        """
+        Evaluate decoded image pairs using the requested metrics.
+
+        Cheap metrics are computed inline, pooled metrics are sent to the shared process
+        pool and LPIPS is computed in batches when a model is given.
+
         Parameters:
-            run_id: str - Unique identifier for the current run.
-            evaluation_id: str - Unique identifier for the evaluation.
-            input_file: str - Path to the original image file.
-            output_file: str - Path to the output image file.
-            lpips_model: lpips.LPIPS - Pre-trained LPIPS model (default: AlexNet backbone).
-        
+            pairs: list - (original_image, output_image) tuples, or the Exception raised while loading them.
+            metrics: list - Metric registry entries, as returned by metrics.resolve_metrics.
+            lpips_model: lpips.LPIPS - Pre-trained LPIPS model, LPIPS is skipped when None.
+            workers: int - Number of processes used for the pooled metrics, 0 uses every core.
+
         Returns:
-            results: dict - Dictionary containing evaluation results.
+            results: list - Dictionary of evaluation results, or the Exception raised, for every pair.
         """
-        # Load the original and decompressed images
+        cheap = [metric for metric in metrics if metric.cost == CHEAP]
+        pooled = [metric.name for metric in metrics if metric.cost == POOLED]
+        batched = [metric.name for metric in metrics if metric.cost == BATCHED]
+
+        results = []
+        for pair in pairs:
+            try:
+                if isinstance(pair,Exception):
+                    raise pair
+                original_image, output_image = pair
 
-        original_image = np.array(Image.open(input_file_path))
-        output_image = np.array(Image.open(output_file_path))        
+                # metrics requested together share intermediate values such as the squared error
+                cache = {}
+                results.append({metric.name:metric.compute(original_image,output_image,cache) for metric in cheap})
+            except Exception as e:
+                results.append(e)
+
+        if len(pooled) > 0:
+            items = [(index,pairs[index]) for index, value in enumerate(results) if not isinstance(value,Exception)]
+            for (index, _), values, error in executor.map(compute_metrics,items,workers,names=pooled):
+                if error is not None:
+                    results[index] = error
+                elif not isinstance(results[index],Exception):
+                    results[index].update(values)
+
+        if "LPIPS" in batched and lpips_model is not None:
+            lpips_pairs = [None if isinstance(value,Exception) else pair for pair, value in zip(pairs,results)]
+            lpips_values = self.__calculate_lpips_batch(lpips_pairs,lpips_model)
+            for index, lpips_value in enumerate(lpips_values):
+                if isinstance(lpips_value,Exception):
+                    results[index] = lpips_value
+                elif lpips_value is not None:
+                    results[index]['LPIPS'] = lpips_value
+
+        # report the metrics in registry order whatever the cost class they were computed in
+        order = [metric.name for metric in metrics]
+        return [value if isinstance(value,Exception) else {name:value[name] for name in order if name in value} for value in results]
+
+    def __evaluate(self,file_paths:list,metrics:list,lpips_model:lpips.LPIPS = None,workers:int = 1):
+        """
+        Evaluate a batch of image pairs using the requested metrics.
         
-        # Calculate evaluation metrics
-        psnr_value = self.__calculate_psnr(original_image, output_image)
-        ssim_value = self.__calculate_ssim(original_image, output_image)
-        mse_value = self.__calculate_mse(original_image, output_image)
-        lpips_value = self.__calculate_lpips(original_image, output_image,lpips_model)
-                
-        # Return the evaluation results
-        results = {
-            'PSNR': psnr_value,
-            'SSIM': ssim_value,
-            'MSE': mse_value,
-            'LPIPS': lpips_value
-        }
+        Parameters:
+            file_paths: list - (input_file_path, output_file_path) tuples.
+            metrics: list - Metric registry entries, as returned by metrics.resolve_metrics.
+            lpips_model: lpips.LPIPS - Pre-trained LPIPS model, LPIPS is skipped when None.
+            workers: int - Number of processes used for the pooled metrics.
         
-        return results
+        Returns:
+            results: list - Dictionary of evaluation results, or the Exception raised, for every pair.
+        """
+        pairs = []
+        for input_file_path, output_file_path in file_paths:
+            # Load the original and decompressed images
+            images = {}
+            try:
+                pairs.append((self.__load_image(input_file_path,images),self.__load_image(output_file_path,images)))
+            except Exception as e:
+                pairs.append(e)
+
+        return self.__evaluate_pairs(pairs,metrics,lpips_model,workers)
     
 
-    def evaluate(self,run_id:str,evaluation_id:str,input_type:str,output_type:str):
+    def __store_results(self,id:int,results:dict):
+        # json_set only replaces the given evaluations, so evaluations running at the same time keep each other's results
+        self.__writer.execute(
+            f"""UPDATE image_data
+            SET results = json_set(COALESCE(results, '{{}}'), {", ".join(["?, json(?)"] * len(results))})
+            WHERE id = ?""",
+            tuple(value for evaluation_id, result in results.items() for value in (_result_key(evaluation_id),json.dumps(result))) + (id,)
+        )
+
+    def __row_batches(self,query:str,params:tuple,key:int,run_id:str,batch_size:int,ready):
+        """
+        Read the image_data rows of a run in batches.
+
+        While stages of a scheduled run are still producing, rows are picked up as soon as
+        ready(row) is true for them, so evaluation overlaps the stages. Otherwise every row is
+        read once.
+
+        Yields:
+            (batch, total): tuple - Rows not yielded before and the number of rows of the run so far.
+        """
+        done = set()
+        # rows up to floor are all yielded, only the rows after it are read again
+        floor = 0
+        settled = 0
+        while True:
+            producing = streams.producing(run_id)
+            # rows of the stages may still be queued in the shared writer
+            self.__writer.flush()
+            with self.__writer.locked(), self.__connection:
+                cursor = self.__connection.cursor()
+                cursor.execute(f"{query} AND id > ? ORDER BY id",params + (floor,))
+                result = cursor.fetchall()
+                cursor.close()
+
+            if len(result) == 0 and settled == 0 and not producing:
+                raise ValueError("No images found for the specified run and evaluation.")
+
+            rows = [row for row in result if row[key] not in done and (not producing or ready(row))]
+            for start in range(0,len(rows),batch_size):
+                batch = rows[start:start + batch_size]
+                done.update(row[key] for row in batch)
+                yield batch, settled + len(result)
+
+            if not producing:
+                return
+
+            waiting = [row[key] for row in result if row[key] not in done]
+            if len(result) > 0:
+                floor = min(waiting) - 1 if len(waiting) > 0 else result[-1][key]
+                settled += len([id for id in done if id <= floor])
+                done = {id for id in done if id > floor}
+            if len(rows) == 0:
+                streams.wait()
+
+    def evaluate(self,run_id:str,evaluation_id:str,input_type:str,output_type:str,batch_size:int = 16,lpips_net:str = "alex",metrics:list = None,workers:int = 1):
         """
         Evaluate the compressed images using various metrics.
         
@@ -263,59 +326,162 @@ class Evaluator:
             evaluation_id: str - Unique identifier for the evaluation.
             input_type: str - Type of input images ('original' or 'noisy').
             output_type: str - Type of output images ('compressed' or 'decompressed').        
+            batch_size: int - Number of image pairs loaded and sent through LPIPS together.
+            lpips_net: str - LPIPS backbone ('alex', 'vgg' or 'squeeze'), 'none' skips LPIPS.
+            metrics: list - Names of the metrics to compute (see get_metrics), every metric when empty.
+            workers: int - Number of processes used for the pooled metrics such as SSIM, 0 uses every core.
         """
+        # the field names are put in the query, so only known columns are accepted
+        fields = self.get_evalauation_fields()
+        if input_type not in fields or output_type not in fields:
+            raise ValueError(f"Evaluation {evaluation_id} uses an unknown field, expected one of {fields}")
+
+        metrics, lpips_model = self.__resolve(metrics,lpips_net)
         # Get the input and output file paths
-        lpips_model = lpips.LPIPS(net='alex')  # 'alex', 'vgg', or 'squeeze' are valid options
-        with self.__connection:
-            cursor = self.__connection.cursor()
-            cursor.execute(
-                f"""SELECT {input_type} as input_file, {output_type} as output_file, results, id
+        query = f"""SELECT {input_type} as input_file, {output_type} as output_file, results, id
                 FROM image_data
-                WHERE run_id = '{run_id}'"""
-            )
-            result = cursor.fetchall()
-            cursor.close()
-
-        if len(result) == 0:
-            raise ValueError("No images found for the specified run and evaluation.")
+                WHERE run_id = ?"""
         
         to_return = {
             "success":0,
             "failed":0,
-            "total":len(result)
+            "total":0
         }
+
+        batch_size = max(1,batch_size)
+        token = cancellation.token(run_id)
+        # the results column is the checkpoint of an evaluation, a resumed run keeps what it holds
+        resume = checkpoints.resuming(run_id)
+        if resume:
+            to_return["skipped"] = 0
         
-        for row in tqdm(result):
-            input_file_path = row[0]
-            output_file_path = row[1]            
+        try:
+            with tqdm() as bar:
+                for batch, total in self.__row_batches(query,(run_id,),3,run_id,batch_size,lambda row: row[0] is not None and row[1] is not None):
+                    token.check()
+                    to_return["total"] = total
+                    batch = [row for row in batch if row[0] is not None and row[1] is not None]
+                    if resume:
+                        pending = [row for row in batch if not _evaluated(row[2],evaluation_id)]
+                        to_return["skipped"] += len(batch) - len(pending)
+                        bar.update(len(batch) - len(pending))
+                        batch = pending
+                    evaluated = self.__evaluate([(row[0],row[1]) for row in batch],metrics,lpips_model,workers)
+
+                    for row, value in zip(batch,evaluated):
+                        bar.update(1)
+                        id = row[3]
+
+                        if isinstance(value,Exception):
+                            to_return["failed"] += 1
+                            yield json.dumps(to_return)
+                            yield str(value)
+                            continue
+
+                        to_return["success"] += 1
+                        yield json.dumps(to_return)
+
+                        self.__store_results(id,{evaluation_id:value})
+            if resume:
+                # rows skipped after the last evaluated one are not counted in any earlier message
+                yield json.dumps(to_return)
+        finally:
+            self.__writer.flush()
 
-            if input_file_path is None or output_file_path is None:
-                continue
+    def evaluate_many(self,run_id:str,evaluations:list,batch_size:int = 16,lpips_net:str = "alex",metrics:list = None,workers:int = 1):
+        """
+        Run several evaluations over a run while decoding every image only once.
 
-            id = row[3]
-            
-            if row[2] is None:
-                results = {}            
-            else:
-                results = json.loads(row[2])
-                    
-            try:
-                results[evaluation_id] = self.__evaluate(input_file_path,output_file_path,lpips_model)
-                to_return["success"] += 1
-                yield json.dumps(to_return)
-            except Exception as e:
-                results[evaluation_id] = str(e)
-                to_return["failed"] += 1
-                yield json.dumps(to_return)
-                continue
+        Each row is read once, every image it references is decoded once and shared by all
+        requested comparisons, and the merged results are written with one update per row.
+        
+        Parameters:
+            run_id: str - Unique identifier for the current run.
+            evaluations: list - (evaluation_id, input_type, output_type) triples, as accepted by evaluate.
+            batch_size: int - Number of rows loaded and sent through LPIPS together.
+            lpips_net: str - LPIPS backbone ('alex', 'vgg' or 'squeeze'), 'none' skips LPIPS.
+            metrics: list - Names of the metrics to compute (see get_metrics), every metric when empty.
+            workers: int - Number of processes used for the pooled metrics such as SSIM, 0 uses every core.
+        """
+        fields = self.get_evalauation_fields()
+        evaluations = [tuple(evaluation) for evaluation in evaluations]
+        for evaluation in evaluations:
+            if len(evaluation) != 3:
+                raise ValueError(f"Evaluation {evaluation} must be an (evaluation_id, input_type, output_type) triple")
+            if evaluation[1] not in fields or evaluation[2] not in fields:
+                raise ValueError(f"Evaluation {evaluation[0]} uses an unknown field, expected one of {fields}")
+
+        metrics, lpips_model = self.__resolve(metrics,lpips_net)
+        columns = sorted({evaluation[1] for evaluation in evaluations} | {evaluation[2] for evaluation in evaluations})
+        query = f"""SELECT id, results, {", ".join(columns)}
+                FROM image_data
+                WHERE run_id = ?"""
 
-            with self.__connection:
-                self.__connection.execute(
-                    """UPDATE image_data
-                    SET results = ?
-                    WHERE id = ?""",
-                    (json.dumps(results), id)
-                )
+        to_return = {
+            "success":0,
+            "failed":0,
+            "total":0
+        }
+        batch_size = max(1,batch_size)
+        token = cancellation.token(run_id)
+        resume = checkpoints.resuming(run_id)
+        if resume:
+            to_return["skipped"] = 0
+
+        try:
+            with tqdm() as bar:
+                for batch, total in self.__row_batches(query,(run_id,),0,run_id,batch_size,lambda row: None not in row[2:]):
+                    token.check()
+                    to_return["total"] = total * len(evaluations)
+                    pairs = []
+                    owners = []
+                    for row_index, row in enumerate(batch):
+                        paths = dict(zip(columns,row[2:]))
+                        # every image of the row is decoded at most once, whatever the number of evaluations
+                        images = {}
+                        for evaluation_id, input_type, output_type in evaluations:
+                            if paths[input_type] is None or paths[output_type] is None:
+                                continue
+                            if resume and _evaluated(row[1],evaluation_id):
+                                to_return["skipped"] += 1
+                                continue
+                            try:
+                                pairs.append((self.__load_image(paths[input_type],images),self.__load_image(paths[output_type],images)))
+                            except Exception as e:
+                                pairs.append(e)
+                            owners.append((row_index,evaluation_id))
+
+                    evaluated = self.__evaluate_pairs(pairs,metrics,lpips_model,workers)
+
+                    merged = {}
+                    for (row_index, evaluation_id), value in zip(owners,evaluated):
+                        merged.setdefault(row_index,{})[evaluation_id] = value
+
+                    for row_index, row in enumerate(batch):
+                        bar.update(1)
+                        if row_index not in merged:
+                            continue
+
+                        results = {}
+                        errors = []
+                        for evaluation_id, value in merged[row_index].items():
+                            # failed evaluations are reported but not stored, as evaluate does
+                            if isinstance(value,Exception):
+                                errors.append(str(value))
+                                to_return["failed"] += 1
+                            else:
+                                results[evaluation_id] = value
+                                to_return["success"] += 1
+
+                        if len(results) > 0:
+                            self.__store_results(row[0],results)
+                        yield json.dumps(to_return)
+                        for error in errors:
+                            yield error
+            if resume:
+                yield json.dumps(to_return)
+        finally:
+            self.__writer.flush()
 
 
     def get_run_ids(self):
@@ -325,7 +491,7 @@ class Evaluator:
         Returns:
             run_ids: list - List of unique run IDs.
         """
-        with self.__connection:
+        with self.__writer.locked(), self.__connection:
             cursor = self.__connection.cursor()
             cursor.execute(
                 """SELECT DISTINCT run_id
@@ -347,7 +513,7 @@ class Evaluator:
         Returns:
             evaluation_ids: list - List of unique evaluation IDs.
         """
-        with self.__connection:
+        with self.__writer.locked(), self.__connection:
             cursor = self.__connection.cursor()
             cursor.execute(
                 """SELECT results
@@ -377,7 +543,7 @@ class Evaluator:
         Returns:
             results: dict - Dictionary containing evaluation results for the run.
         """
-        with self.__connection:
+        with self.__writer.locked(), self.__connection:
             df = pd.read_sql_query(f"""SELECT *
             FROM image_data
             WHERE run_id = '{run_id}'""", self.__connection)
@@ -397,20 +563,33 @@ class Evaluator:
             "decompressed_image_path",            
             "noisy_image_path"
         ]
+
+    def get_metrics(self):
+        """
+        Get the metrics that can be requested from evaluate.
+
+        Returns:
+            metrics: list - Name, cost class and description of every registered metric.
+        """
+        return [metric.to_dict() for metric in resolve_metrics()]
         
 
-    def get_image_by_path(self,path:str):
+    def get_image_by_path(self,path:str,max_size:int = 0):
         """
         Get the image data from the database based on the file path.
         
         Parameters:
             path: str - File path of the image.
+            max_size: int - Longest side of the returned preview, 0 returns the full image.
+                Tiled GeoTIFFs with overviews are read from the smallest overview that fits.
 
         """
 
         # get image from and return base64 no need to use database
-        try:                                
-            with open(path, "rb") as image_file:
+        try:
+            if max_size > 0:
+                return self.__get_preview(path,max_size)
+            with sources.open_file(path) as image_file:
                 if path.lower().endswith('.tiff') or path.lower().endswith('.tif'):
                     image = Image.open(image_file)
                     with BytesIO() as buffer:
@@ -422,6 +601,24 @@ class Evaluator:
                 return base64_string
         except Exception as e:
             raise ValueError(f"Error reading image file: {str(e)}")            
-            
 
-            
\ No newline at end of file
+    def __get_preview(self,path:str,max_size:int):
+        """
+        Encode a downscaled PNG preview of the image at path as base64.
+        """
+        if path.lower().endswith('.tiff') or path.lower().endswith('.tif'):
+            with rasterio.open(path) as src:
+                scale = max(1,max(src.width,src.height) / max_size)
+                out_shape = (min(src.count,3),max(1,int(src.height / scale)),max(1,int(src.width / scale)))
+                # a decimated read is served from the closest overview level when the file has them
+                data = src.read(list(range(1,out_shape[0] + 1)),out_shape=out_shape,resampling=Resampling.average)
+            image = Image.fromarray(data[0] if data.shape[0] == 1 else np.moveaxis(data,0,-1))
+        else:
+            with sources.open_image(path) as image:
+                # lets the JPEG decoder skip work at reduced scales
+                image.draft("RGB",(max_size,max_size))
+                image.thumbnail((max_size,max_size))
+                image.load()
+        with BytesIO() as buffer:
+            image.save(buffer, format="PNG")
+            return base64.b64encode(buffer.getvalue()).decode('utf-8')
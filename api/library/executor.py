@@ -0,0 +1,158 @@
+import os
+import threading
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from .cancellation import Cancelled, CancellationToken
+
+# stages run on several threads, a worker forked from them can inherit a lock another thread
+# holds (the import lock, GDAL's) and block forever, the fork server forks from a clean process
+_CONTEXT = multiprocessing.get_context("forkserver") if "forkserver" in multiprocessing.get_all_start_methods() else None
+
+
+def _init_worker():
+    # forked workers inherit the parent's RNG state, reseed so noise differs per process
+    np.random.seed()
+
+
+class Executor:
+    """
+    Process pool shared by the folder-level pipeline methods.
+
+    The per-file work (decode, transform, encode) runs in worker processes while the
+    caller keeps the sqlite writes and the progress stream, so the generators exposed
+    to /run_pipeline behave exactly as the serial loops did.
+    """
+
+    def __init__(self):
+        self.__pool = None
+        self.__size = 0
+        # number of maps using each pool, a replaced pool is shut down once its last map ends
+        self.__users = {}
+        self.__lock = threading.Lock()
+
+    def __acquire(self,workers:int):
+        with self.__lock:
+            if self.__pool is None or self.__size < workers:
+                previous = self.__pool
+                self.__pool = ProcessPoolExecutor(max_workers=workers,mp_context=_CONTEXT,initializer=_init_worker)
+                self.__size = workers
+                self.__users[self.__pool] = 0
+                if previous is not None and self.__users[previous] == 0:
+                    del self.__users[previous]
+                    previous.shutdown(wait=False)
+            self.__users[self.__pool] += 1
+            return self.__pool
+
+    def __release(self,pool:ProcessPoolExecutor):
+        with self.__lock:
+            self.__users[pool] -= 1
+            if self.__users[pool] == 0 and pool is not self.__pool:
+                del self.__users[pool]
+                pool.shutdown(wait=False)
+
+    def __replace(self,pool:ProcessPoolExecutor,workers:int):
+        """
+        Swap a pool whose worker died for a new one, a broken pool refuses every later task.
+        """
+        with self.__lock:
+            if pool is self.__pool:
+                self.__pool = None
+                self.__size = 0
+        self.__release(pool)
+        return self.__acquire(workers)
+
+    def map(self,func,items,workers:int = 1,token:CancellationToken = None,**kwargs):
+        """
+        Apply func(item, **kwargs) to every item.
+
+        Parameters:
+            func: callable - Module level function, it must be picklable.
+            items: iterable - Work items, usually file paths.
+            workers: int - Number of processes, 1 runs inline, 0 uses every core.
+            token: CancellationToken - Checked before every item. Items may also raise Cancelled
+                themselves, as the files of a cancelled run do.
+
+        Yields:
+            (item, result, error): tuple - error is None when func succeeded.
+                Results are yielded in completion order. On cancellation the items already
+                running are still yielded before Cancelled is raised. When a worker dies the
+                items in flight fail with BrokenProcessPool and the rest run on a new pool.
+        """
+        if token is None:
+            token = CancellationToken()
+        if workers is None or workers < 0:
+            workers = 1
+        if workers == 0:
+            workers = os.cpu_count() or 1
+
+        if workers == 1:
+            for item in items:
+                token.check()
+                try:
+                    yield item, func(item,**kwargs), None
+                except Exception as e:
+                    yield item, None, e
+            return
+
+        pool = self.__acquire(workers)
+        # keep a bounded number of tasks in flight so huge folders do not queue everything at once
+        limit = workers * 2
+        pending = {}
+        items = iter(items)
+        exhausted = False
+        cancelled = None
+        try:
+            while True:
+                while not exhausted and len(pending) < limit:
+                    try:
+                        token.check()
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    except Cancelled as e:
+                        # tasks that have not started are dropped, the running ones are drained below
+                        cancelled = e
+                        exhausted = True
+                        for future in [future for future in pending if future.cancel()]:
+                            del pending[future]
+                        break
+                    try:
+                        future = pool.submit(func,item,**kwargs)
+                    except BrokenProcessPool:
+                        pool = self.__replace(pool,workers)
+                        future = pool.submit(func,item,**kwargs)
+                    pending[future] = (item, pool)
+
+                if len(pending) == 0:
+                    if cancelled is not None:
+                        raise cancelled
+                    return
+
+                done, _ = wait(pending,return_when=FIRST_COMPLETED)
+                for future in done:
+                    item, submitted_to = pending.pop(future)
+                    error = future.exception()
+                    if isinstance(error,BrokenProcessPool) and submitted_to is pool:
+                        pool = self.__replace(pool,workers)
+                    if error is None:
+                        yield item, future.result(), None
+                    else:
+                        yield item, None, error
+        finally:
+            for future in pending:
+                future.cancel()
+            self.__release(pool)
+
+    def shutdown(self):
+        with self.__lock:
+            if self.__pool is not None:
+                self.__pool.shutdown(wait=True,cancel_futures=True)
+                self.__users.pop(self.__pool,None)
+                self.__pool = None
+                self.__size = 0
+
+
+executor = Executor()
@@ -0,0 +1,360 @@
+import os
+import sqlite3
+import time
+from io import BytesIO
+import numpy as np
+import rasterio
+from PIL import Image
+from .image_data_writer import ImageDataWriter
+from .stage_runner import StageRunner
+from .discovery import discovery
+from .preprocessor import _read_bands, _normalize
+from .simulated_noise_injector import NOISE_KERNELS, _pil2cv, _cv2pil
+from . import sources
+
+# order the fused stages must follow, noise may repeat
+STAGE_ORDER = ["preprocess","compress","noise","decompress"]
+
+# image_data columns in the order of the row insert
+ROW_COLUMNS = [
+    "height",
+    "width",
+    "input_image_path",
+    "input_image_size",
+    "compressed_image_path",
+    "compressed_image_size",
+    "compression_time",
+    "noisy_image_path",
+    "noisy_image_size",
+    "decompressed_image_path",
+    "decompressed_image_size",
+    "decompression_time"
+]
+
+
+def _encode(image:Image.Image,format:str,**params):
+    buffer = BytesIO()
+    image.save(buffer,format,**params)
+    return buffer.getvalue()
+
+
+def _decode(tile:dict):
+    """
+    Decoded image of the tile, from the bytes of the previous stage or from the source file.
+    """
+    if tile["image"] is None:
+        if tile["data"] is None:
+            tile["image"] = sources.open_image(tile["path"])
+        else:
+            tile["image"] = Image.open(BytesIO(tile["data"]))
+    return tile["image"]
+
+
+def _emit(tile:dict,column:str,path:str,data:bytes,image:Image.Image = None):
+    # the bytes become the input of the next stage, the artifact is written only if it is needed
+    tile["path"] = path
+    tile["data"] = data
+    tile["image"] = image
+    tile["artifacts"].append((column,path,data))
+
+
+def _fused_convert_ms_to_rgb(tile:dict,output_folder:str,bands:list):
+    """
+    In memory counterpart of preprocessor._convert_ms_to_rgb, per file min/max into an RGB tiff.
+    """
+    file_name = tile["path"].split("/")[-1]
+    with rasterio.open(tile["path"]) as src:
+        composite = _read_bands(src,bands)
+        # not a shared buffer, the image is used by the next stage
+        rgb = np.empty((src.height,src.width,len(bands)),dtype=np.uint8)
+        _normalize(composite,composite.min(),composite.max(),rgb)
+    image = Image.fromarray(rgb)
+    _emit(tile,"input_image_path",f"{output_folder}/{file_name}",_encode(image,"TIFF"),image)
+
+
+def _fused_compress(tile:dict,output_folder:str,extension:str,format:str,params:dict):
+    """
+    In memory counterpart of compressor._compress_png and compressor._compress_jpeg.
+    """
+    file_name = tile["path"].split("/")[-1]
+    input_size = sources.get_size(tile["path"]) if tile["data"] is None else len(tile["data"])
+    start_time = time.perf_counter()
+    image = _decode(tile)
+    data = _encode(image,format,**params)
+    end_time = time.perf_counter()
+    tile["row"].update(
+        height=image.height,
+        width=image.width,
+        input_image_path=tile["path"],
+        input_image_size=input_size,
+        compressed_image_size=len(data),
+        compression_time=(end_time - start_time) * 1_000_000
+    )
+    output_path = f"{output_folder}/{file_name.replace('.tif', '')}.{extension}"
+    tile["row"]["compressed_image_path"] = output_path
+    # the next stage decodes the compressed bytes, so it sees the codec artifacts
+    _emit(tile,"compressed_image_path",output_path,data)
+
+
+def _fused_add_noise(tile:dict,output_folder:str,file_type:str,noise:str,params:dict):
+    """
+    In memory counterpart of simulated_noise_injector._add_noise.
+    """
+    file_name = tile["path"].split("/")[-1]
+    opencv_image = _pil2cv(_decode(tile))
+    noisy_image = _cv2pil(NOISE_KERNELS[noise](opencv_image,**params))
+    # saved in the format of the file type, as PIL picks it from the extension on disk
+    data = _encode(noisy_image,Image.registered_extensions()[f".{file_type}"])
+    output_path = f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}"
+    tile["row"].update(noisy_image_path=output_path,noisy_image_size=len(data))
+    _emit(tile,"noisy_image_path",output_path,data)
+
+
+def _fused_decompress(tile:dict,output_folder:str,extension:str):
+    """
+    In memory counterpart of decompressor._decompress_png and decompressor._decompress_jpeg.
+    """
+    file_name = tile["path"].split("/")[-1]
+    start_time = time.perf_counter()
+    image = _decode(tile)
+    data = _encode(image,"PNG")
+    end_time = time.perf_counter()
+    output_path = f"{output_folder}/{file_name.replace(f'.{extension}','')}.png"
+    tile["row"].update(
+        decompressed_image_path=output_path,
+        decompressed_image_size=len(data),
+        decompression_time=(end_time - start_time) * 1_000_000
+    )
+    _emit(tile,"decompressed_image_path",output_path,data)
+
+
+def _run_chain(input_path:str,stages:list,write:list):
+    """
+    Stream one tile through every stage of a chain and write the artifacts that are kept.
+
+    Parameters:
+        input_path: str - Source tile, on disk or inside an archive.
+        stages: list - (adapter, kwargs) pairs applied in order.
+        write: list - One flag per stage, True when its output is written to disk.
+
+    Returns:
+        (row, output_path): tuple - image_data columns of the tile, paths of artifacts not
+            written are None, and the output of the last stage.
+    """
+    tile = {"path":input_path,"data":None,"image":None,"row":{},"artifacts":[]}
+    for adapter, kwargs in stages:
+        adapter(tile,**kwargs)
+
+    row = tile["row"]
+    for (column, path, data), keep in zip(tile["artifacts"],write):
+        if keep:
+            with open(path,'wb') as f:
+                f.write(data)
+        elif row.get(column) == path:
+            row[column] = None
+    return row, tile["path"]
+
+
+def _noise_stage(params:dict,noise:str):
+    names = [name for name in params if name not in ["input_path","file_type","output_folder","workers","run_id"]]
+    return {
+        "kind":"noise",
+        "adapter":_fused_add_noise,
+        "kwargs":{
+            "output_folder":params["output_folder"],
+            "file_type":params["file_type"],
+            "noise":noise,
+            "params":{name:params[name] for name in names}
+        },
+        "input_extension":params["file_type"],
+        "output_extension":params["file_type"]
+    }
+
+
+def _preprocess_stage(params:dict):
+    # windowed, COG and dataset statistics conversions keep running as their own stage
+    if params.get("windowed",False) or params.get("output_format","tiff") != "tiff" or params.get("statistics","") != "":
+        return None
+    return {
+        "kind":"preprocess",
+        "adapter":_fused_convert_ms_to_rgb,
+        "kwargs":{"output_folder":params["output_folder"],"bands":params.get("bands",[3,2,1])},
+        "input_extension":"tif",
+        "output_extension":"tif"
+    }
+
+
+def _compress_stage(params:dict,extension:str,format:str,options:dict):
+    return {
+        "kind":"compress",
+        "adapter":_fused_compress,
+        "kwargs":{"output_folder":params["output_folder"],"extension":extension,"format":format,"params":options},
+        "input_extension":"tif",
+        "output_extension":extension
+    }
+
+
+def _decompress_stage(params:dict,extension:str):
+    return {
+        "kind":"decompress",
+        "adapter":_fused_decompress,
+        "kwargs":{"output_folder":params["output_folder"],"extension":extension},
+        "input_extension":extension,
+        "output_extension":"png"
+    }
+
+
+FUSED_STAGES = {
+    "pre_processor:convert_ms_to_rgb":_preprocess_stage,
+    "compressor:compress_png":lambda params: _compress_stage(params,"png","PNG",{"optimize":True,"quality":params["quality"]}),
+    "compressor:compress_jpeg":lambda params: _compress_stage(params,"jpg","JPEG",{"quality":params["quality"]}),
+    "decompressor:decompress_png":lambda params: _decompress_stage(params,"png"),
+    "decompressor:decompress_jpeg":lambda params: _decompress_stage(params,"jpg")
+}
+for _noise in NOISE_KERNELS:
+    FUSED_STAGES[f"simulated_noise_injector:add_{_noise}_noise"] = lambda params, noise=_noise: _noise_stage(params,noise)
+
+
+class Fusion:
+    """
+    Fused execution of consecutive file stages of a pipeline config.
+
+    A chain is an optional convert_ms_to_rgb, one compress, any number of noise stages and
+    an optional decompress, each reading the output folder of the one before. Instead of
+    every stage writing a folder that the next one walks and decodes again, each tile goes
+    through the whole chain in memory and only the outputs that are needed are written:
+    the folders evaluated by the evaluator items of the config, the folders read by other
+    items, and the output of the last stage. The image_data row of a tile is inserted once
+    with every column filled.
+    """
+
+    def __init__(self,connection:sqlite3.Connection,writer:ImageDataWriter):
+        self.__connection = connection
+        self.__writer = writer
+        self.__runner = StageRunner(connection,writer)
+
+    def __stage(self,item:dict):
+        builder = FUSED_STAGES.get(item["execution_path"])
+        if builder is None:
+            return None
+        try:
+            stage = builder(item["params"])
+        except KeyError:
+            return None
+        if stage is not None:
+            stage["input_path"] = os.path.abspath(item["params"]["input_path"])
+            stage["output_folder"] = os.path.abspath(item["params"]["output_folder"])
+        return stage
+
+    def __extends(self,chain:list,stage:dict):
+        if len(chain) == 0:
+            return stage["kind"] in ["preprocess","compress"]
+        previous = chain[-1][1]
+        if stage["input_path"] != previous["output_folder"] or stage["input_extension"] != previous["output_extension"]:
+            return False
+        if previous["kind"] == "preprocess":
+            return stage["kind"] == "compress"
+        if stage["kind"] == "noise":
+            return previous["kind"] in ["compress","noise"]
+        return STAGE_ORDER.index(stage["kind"]) > STAGE_ORDER.index(previous["kind"])
+
+    def plan(self,config:list):
+        """
+        Group the items of a pipeline config into the steps of a fused run.
+
+        Returns:
+            steps: list - Lists of items, a list with several items is one fused chain.
+        """
+        steps = []
+        chain = []
+
+        def close():
+            if len(chain) > 1 and any(stage["kind"] == "compress" for _, stage in chain):
+                steps.append([item for item, _ in chain])
+            else:
+                steps.extend([[item] for item, _ in chain])
+            chain.clear()
+
+        for item in config:
+            stage = self.__stage(item)
+            if stage is not None and self.__extends(chain,stage):
+                chain.append((item,stage))
+                continue
+            close()
+            if stage is not None and self.__extends(chain,stage):
+                chain.append((item,stage))
+            else:
+                steps.append([item])
+        close()
+        return steps
+
+    def __needed(self,config:list,chain:list):
+        """
+        Columns compared by the evaluator items of the config, None when it has none,
+        and the folders read by items outside of the chain.
+        """
+        columns = None
+        folders = set()
+        for item in config:
+            params = item["params"]
+            if item["execution_path"] == "evaluator:evaluate":
+                columns = (columns or set()) | {params.get("input_type"),params.get("output_type")}
+            elif item["execution_path"] == "evaluator:evaluate_many":
+                columns = columns or set()
+                for evaluation in params.get("evaluations",[]):
+                    columns |= set(evaluation[1:])
+            if item not in chain and "input_path" in params:
+                folders.add(os.path.abspath(params["input_path"]))
+        return columns, folders
+
+    def __column(self,stages:list,index:int):
+        # a noise stage followed by another one is overwritten in the row, like the unfused updates
+        column = {"preprocess":"input_image_path","compress":"compressed_image_path","noise":"noisy_image_path","decompress":"decompressed_image_path"}[stages[index]["kind"]]
+        if stages[index]["kind"] == "noise" and any(stage["kind"] == "noise" for stage in stages[index + 1:]):
+            return None
+        return column
+
+    def run_chain(self,run_id:str,chain:list,config:list):
+        """
+        Run a chain returned by plan tile by tile.
+
+        Parameters:
+            run_id: str - Unique identifier for the current run.
+            chain: list - Items of the chain, in order.
+            config: list - Whole pipeline config, used to find the outputs that must be written.
+        """
+        stages = [self.__stage(item) for item in chain]
+        columns, folders = self.__needed(config,chain)
+        write = [
+            index == len(stages) - 1 or columns is None or stage["output_folder"] in folders or self.__column(stages,index) in columns
+            for index, stage in enumerate(stages)
+        ]
+
+        workers = [item["params"].get("workers",1) for item in chain]
+        workers = 0 if 0 in workers else max(workers)
+
+        for stage, keep in zip(stages,write):
+            if keep and not os.path.exists(stage["output_folder"]):
+                os.makedirs(stage["output_folder"], exist_ok=True)
+            discovery.invalidate(stage["output_folder"])
+
+        # a chain is checkpointed as one stage, a tile is done once its row is inserted
+        for res in self.__runner.run(
+            _run_chain,
+            {"stages":[(stage["adapter"],stage["kwargs"]) for stage in stages],"write":write},
+            chain[0]["params"]["input_path"],
+            "tif",
+            run_id,
+            workers,
+            output_folder=chain[-1]["params"]["output_folder"],
+            stage=" -> ".join(item["execution_path"] for item in chain),
+            log=lambda tiff_file, result: self.__log(result[0],run_id),
+            output_of=lambda tiff_file, result: result[1]
+        ):
+            yield res
+
+    def __log(self,row:dict,run_id:str):
+        self.__writer.execute(
+            f"""INSERT INTO image_data (run_id, {', '.join(ROW_COLUMNS)}) VALUES ({', '.join(['?'] * (len(ROW_COLUMNS) + 1))})""",
+            tuple([run_id] + [row.get(column) for column in ROW_COLUMNS])
+        )
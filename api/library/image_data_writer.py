@@ -0,0 +1,220 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+MAX_ERRORS = 1000
+
+
+def _is_transient(error:Exception):
+    # the database is locked or busy, the same statements succeed once the other writer is done
+    code = getattr(error,"sqlite_errorcode",None)
+    return isinstance(error,sqlite3.OperationalError) and code is not None and code & 0xff in (sqlite3.SQLITE_BUSY,sqlite3.SQLITE_LOCKED)
+
+
+class ImageDataWriter:
+    """
+    Write-behind buffer for the per-file image_data statements.
+
+    Statements are queued in order and flushed inside a single transaction once
+    max_rows are pending or the oldest pending statement is older than max_delay_ms.
+    Consecutive statements with the same SQL are sent with one executemany, so an
+    INSERT followed by UPDATEs keyed on it still apply in the order they were queued.
+    A transaction that fails because the database is locked puts its statements back at the
+    head of the queue, so the rows of files already reported are written by a later flush
+    instead of being lost. Any other failure is isolated by writing the statements one unit
+    at a time, the failing units are dropped and the rest are committed. The error of a
+    dropped unit is kept for its owner, see settled and error, and never raised to the
+    caller whose statement happened to trigger the flush.
+    """
+
+    def __init__(self,connection:sqlite3.Connection,max_rows:int = 500,max_delay_ms:int = 250):
+        self.__connection = connection
+        self.__max_rows = max_rows
+        self.__max_delay = max_delay_ms / 1000
+        self.__pending = []
+        self.__first_pending_at = None
+        self.__lock = threading.RLock()
+        self.__depth = 0
+        # statements queued inside one transaction() block share a unit and are dropped together
+        self.__unit = 0
+        # errors of the dropped units, until their owner takes them
+        self.__errors = {}
+        # no automatic flush before this time, set when the database was locked
+        self.__retry_at = 0
+
+    def execute(self,sql:str,params:tuple):
+        """
+        Queue a statement, flushing when the row or time threshold is reached.
+
+        Returns:
+            unit: int - Unit of the statement, the one of the enclosing transaction() block.
+        """
+        with self.__lock:
+            if len(self.__pending) == 0:
+                self.__first_pending_at = time.monotonic()
+            if self.__depth == 0:
+                self.__unit += 1
+            unit = self.__unit
+            self.__pending.append((sql,params,unit))
+            if self.__depth == 0:
+                self.__flush_due()
+            return unit
+
+    def __flush_due(self):
+        now = time.monotonic()
+        if now < self.__retry_at:
+            return
+        if len(self.__pending) >= self.__max_rows or now - self.__first_pending_at >= self.__max_delay:
+            try:
+                self.flush()
+            except sqlite3.OperationalError as e:
+                if not _is_transient(e):
+                    raise
+                # the database is locked by another writer, the statements stay queued for the next flush
+                self.__retry_at = time.monotonic() + self.__max_delay
+
+    @contextmanager
+    def transaction(self):
+        """
+        Queue the statements executed inside the block so they are flushed in the same transaction,
+        such as a stage's image_data row and the checkpoint of its file.
+
+        Yields:
+            unit: int - Unit of the block's statements, to look up with settled and error.
+        """
+        with self.__lock:
+            if self.__depth == 0:
+                self.__unit += 1
+            self.__depth += 1
+            try:
+                yield self.__unit
+            finally:
+                self.__depth -= 1
+                if self.__depth == 0 and len(self.__pending) > 0:
+                    self.__flush_due()
+
+    @contextmanager
+    def locked(self):
+        """
+        Hold the writer's lock while statements run directly on the connection it shares,
+        so they never land inside, or read from, a transaction the writer has open.
+        """
+        with self.__lock:
+            yield self.__connection
+
+    def settled(self,unit:int):
+        """
+        True once the statements of the unit are committed or dropped.
+        """
+        with self.__lock:
+            # the queue is in unit order, a unit is settled once none of its statements is left
+            return len(self.__pending) == 0 or self.__pending[0][2] > unit
+
+    def error(self,unit:int):
+        """
+        Take the error of a dropped unit, None when the unit was committed or is still queued.
+        """
+        with self.__lock:
+            return self.__errors.pop(unit,None)
+
+    def commit(self,unit:int):
+        """
+        Flush the queue and raise the error of the unit when its statements were dropped.
+        """
+        self.flush()
+        error = self.error(unit)
+        if error is not None:
+            raise error
+
+    def flush(self):
+        """
+        Write every queued statement in one transaction.
+
+        When the database is locked the statements are queued again and the error is raised.
+        When a statement fails for any other reason the units without errors are committed,
+        the failing ones are dropped and their errors are kept for error(unit).
+
+        Returns:
+            errors: dict - Errors of the units dropped by this flush, keyed by unit.
+        """
+        with self.__lock:
+            if len(self.__pending) == 0:
+                return {}
+            pending = self.__pending
+            self.__pending = []
+            self.__first_pending_at = None
+
+            # group consecutive statements with the same sql so each group is one executemany
+            groups = []
+            for sql, params, _ in pending:
+                if len(groups) > 0 and groups[-1][0] == sql:
+                    groups[-1][1].append(params)
+                else:
+                    groups.append((sql,[params]))
+
+            cursor = self.__connection.cursor()
+            try:
+                cursor.execute("BEGIN")
+                for sql, rows in groups:
+                    cursor.executemany(sql,rows)
+                cursor.execute("COMMIT")
+                return {}
+            except Exception as e:
+                if self.__connection.in_transaction:
+                    cursor.execute("ROLLBACK")
+                if _is_transient(e):
+                    self.__requeue(pending)
+                    raise
+            finally:
+                cursor.close()
+
+            errors = self.__write_units(pending)
+            self.__errors.update(errors)
+            # errors nobody asks for, such as the ones of single statements, are not kept forever
+            while len(self.__errors) > MAX_ERRORS:
+                self.__errors.pop(next(iter(self.__errors)))
+            return errors
+
+    def __requeue(self,pending:list):
+        self.__pending = pending + self.__pending
+        self.__first_pending_at = time.monotonic()
+
+    def __write_units(self,pending:list):
+        """
+        Write the statements one unit at a time, each under its own savepoint.
+
+        Returns:
+            errors: dict - Errors of the dropped units, keyed by unit.
+        """
+        units = []
+        for sql, params, unit in pending:
+            if len(units) == 0 or units[-1][0] != unit:
+                units.append((unit,[]))
+            units[-1][1].append((sql,params))
+
+        errors = {}
+        cursor = self.__connection.cursor()
+        try:
+            cursor.execute("BEGIN")
+            for unit, statements in units:
+                cursor.execute("SAVEPOINT unit")
+                try:
+                    for sql, params in statements:
+                        cursor.execute(sql,params)
+                    cursor.execute("RELEASE unit")
+                except Exception as e:
+                    if _is_transient(e):
+                        raise
+                    cursor.execute("ROLLBACK TO unit")
+                    cursor.execute("RELEASE unit")
+                    errors[unit] = e
+            cursor.execute("COMMIT")
+        except Exception:
+            if self.__connection.in_transaction:
+                cursor.execute("ROLLBACK")
+            self.__requeue(pending)
+            raise
+        finally:
+            cursor.close()
+        return errors
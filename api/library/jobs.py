@@ -0,0 +1,258 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from .image_data_writer import ImageDataWriter
+from .cancellation import cancellation
+
+FINISHED_STATUSES = ["completed","failed","cancelled","interrupted"]
+
+
+def _is_progress(message:str):
+    if not message.startswith("{"):
+        return False
+    try:
+        progress = json.loads(message)
+    except ValueError:
+        return False
+    return isinstance(progress,dict) and "success" in progress and "total" in progress
+
+
+def _coalesce(rows:list):
+    """
+    Drop every progress message that is directly followed by another one, its counts are superseded.
+    """
+    coalesced = []
+    previous = False
+    for seq, message in rows:
+        progress = _is_progress(message)
+        if progress and previous:
+            coalesced[-1] = (seq, message)
+            continue
+        coalesced.append((seq, message))
+        previous = progress
+    return coalesced
+
+
+class JobManager:
+    """
+    Runs pipeline configs as background jobs.
+
+    A submitted config runs Configurables.run on a worker thread, every message it
+    yields is persisted to job_events with a per job sequence number, and clients
+    follow a job by reading the events after the last sequence number they saw, so
+    a client that disconnects can re-attach without affecting the run. Cancelling a
+    job cancels its run, the stages stop at their next file.
+    """
+
+    def __init__(self,clf,database:str = 'sateval.db',max_workers:int = 2):
+        self.__clf = clf
+        # own connection, so job bookkeeping never joins a transaction of the pipeline writer
+        self.__connection = sqlite3.connect(database,check_same_thread=False,autocommit=True,timeout=30)
+        self.__writer = ImageDataWriter(self.__connection)
+        self.__pool = ThreadPoolExecutor(max_workers=max_workers,thread_name_prefix="job")
+        self.__lock = threading.Lock()
+        self.__changed = threading.Condition()
+        self.__cancelled = set()
+
+        # jobs of a previous process can not continue, mark them so clients stop waiting
+        self.__connection.execute(
+            "UPDATE jobs SET status = 'interrupted', finished_at = ? WHERE status IN ('queued', 'running')",
+            (time.time(),)
+        )
+
+    def __notify(self):
+        with self.__changed:
+            self.__changed.notify_all()
+
+    def __set_status(self,job_id:str,status:str,column:str,error:str = None):
+        unit = self.__writer.execute(
+            f"UPDATE jobs SET status = ?, error = ?, {column} = ? WHERE id = ?",
+            (status, error, time.time(), job_id)
+        )
+        self.__writer.commit(unit)
+        self.__notify()
+
+    def __status(self,job_id:str):
+        with self.__writer.locked():
+            row = self.__connection.execute("SELECT status FROM jobs WHERE id = ?",(job_id,)).fetchone()
+        if row is None:
+            raise ValueError(f"Job {job_id} not found")
+        return row[0]
+
+    def __execute(self,job_id:str,run_id:str,config:list,fused:bool,scheduled:bool,cached:bool,resume:bool):
+        with self.__lock:
+            if job_id in self.__cancelled:
+                return
+            # the token is open before the job shows as running, so a cancel always reaches the run,
+            # Configurables.run shares it once the generator starts
+            cancellation.open(run_id)
+            self.__set_status(job_id,"running","started_at")
+
+        status = "completed"
+        error = None
+        seq = 0
+        cancelled_message = "Pipeline with Run ID: {} cancelled".format(run_id)
+        messages = self.__clf.configurables.run(run_id,config=config,clf=self.__clf,fused=fused,scheduled=scheduled,cached=cached,resume=resume)
+        try:
+            for message in messages:
+                seq += 1
+                self.__writer.execute(
+                    "INSERT INTO job_events (job_id, seq, message, created_at) VALUES (?, ?, ?, ?)",
+                    (job_id, seq, str(message), time.time())
+                )
+                self.__notify()
+                # a cancel that arrives after the last step leaves the run completed
+                if message == cancelled_message:
+                    status = "cancelled"
+        except Exception as e:
+            status = "failed"
+            error = str(e)
+        finally:
+            # closing the generator runs the finally blocks of the stages, flushing their rows
+            messages.close()
+            cancellation.release(run_id)
+            self.__set_status(job_id,status,"finished_at",error)
+            self.__cancelled.discard(job_id)
+
+    def submit(self,run_id:str,config:list,fused:bool = False,scheduled:bool = False,cached:bool = False,resume:bool = False):
+        """
+        Queue a pipeline config and return its job id right away, fused, scheduled, cached and resume are passed on to Configurables.run.
+        """
+        job_id = uuid.uuid4().hex
+        unit = self.__writer.execute(
+            "INSERT INTO jobs (id, run_id, status, config, created_at) VALUES (?, ?, 'queued', ?, ?)",
+            (job_id, run_id, json.dumps(config), time.time())
+        )
+        self.__writer.commit(unit)
+        self.__pool.submit(self.__execute,job_id,run_id,config,fused,scheduled,cached,resume)
+        return job_id
+
+    def cancel(self,job_id:str):
+        """
+        Cancel a job. A queued job never starts, a running one stops at its next message.
+
+        Returns:
+            status: str - Status of the job after the request.
+        """
+        with self.__lock:
+            status = self.__status(job_id)
+            if status in FINISHED_STATUSES:
+                return status
+            self.__cancelled.add(job_id)
+            if status == "queued":
+                self.__set_status(job_id,"cancelled","finished_at")
+                return "cancelled"
+        with self.__writer.locked():
+            run_id = self.__connection.execute("SELECT run_id FROM jobs WHERE id = ?",(job_id,)).fetchone()[0]
+        cancellation.cancel(run_id)
+        return "cancelling"
+
+    def resume(self,job_id:str,fused:bool = False,scheduled:bool = False,cached:bool = False):
+        """
+        Submit the config of a finished job again under its run_id, skipping the work it completed.
+
+        Returns:
+            job_id: str - Id of the new job.
+        """
+        self.__writer.flush()
+        with self.__writer.locked():
+            row = self.__connection.execute("SELECT run_id, status, config FROM jobs WHERE id = ?",(job_id,)).fetchone()
+        if row is None:
+            raise ValueError(f"Job {job_id} not found")
+        run_id, status, config = row
+        if status not in FINISHED_STATUSES:
+            raise ValueError(f"Job {job_id} is {status}, only finished jobs can be resumed")
+        return self.submit(run_id,json.loads(config),fused,scheduled,cached,True)
+
+    def cancel_run(self,run_id:str):
+        """
+        Cancel every unfinished job of a run, and the run itself when it was started outside of a job.
+
+        Returns:
+            jobs: dict - Status of each job after the request, keyed by job id.
+        """
+        with self.__writer.locked():
+            rows = self.__connection.execute(
+                "SELECT id FROM jobs WHERE run_id = ? AND status IN ('queued', 'running')",
+                (run_id,)
+            ).fetchall()
+        result = {job_id:self.cancel(job_id) for (job_id,) in rows}
+        cancellation.cancel(run_id)
+        return result
+
+    def get(self,job_id:str):
+        """
+        Get a job with the number of events and its last message.
+        """
+        self.__writer.flush()
+        with self.__writer.locked():
+            cursor = self.__connection.execute(
+                """SELECT id, run_id, status, error, created_at, started_at, finished_at,
+                    (SELECT COUNT(*) FROM job_events WHERE job_id = jobs.id) AS events,
+                    (SELECT message FROM job_events WHERE job_id = jobs.id ORDER BY seq DESC LIMIT 1) AS last_message
+                FROM jobs
+                WHERE id = ?""",
+                (job_id,)
+            )
+            row = cursor.fetchone()
+        if row is None:
+            raise ValueError(f"Job {job_id} not found")
+        return dict(zip([column[0] for column in cursor.description],row))
+
+    def list(self,status:str = "",limit:int = 50):
+        """
+        List the most recent jobs, optionally only those with the given status.
+        """
+        where = "WHERE status = ?" if status != "" else ""
+        params = [status] if status != "" else []
+        with self.__writer.locked():
+            cursor = self.__connection.execute(
+                f"""SELECT id, run_id, status, error, created_at, started_at, finished_at
+                FROM jobs {where}
+                ORDER BY created_at DESC
+                LIMIT ?""",
+                params + [limit]
+            )
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns,row)) for row in cursor.fetchall()]
+
+    def events(self,job_id:str,after:int = 0,coalesce:bool = True):
+        """
+        Follow the messages of a job, starting after the given sequence number.
+
+        Parameters:
+            job_id: str - Job to follow.
+            after: int - Sequence number of the last message already received.
+            coalesce: bool - When the reader has fallen behind, consecutive progress messages
+                are merged into the latest one. Other messages are always delivered.
+
+        Yields:
+            (seq, message): tuple - Persisted messages in order, until the job has finished.
+        """
+        while True:
+            # pending events of a running job are written out before they are read
+            self.__writer.flush()
+            # read the status first, a finished job has flushed all its events before its status
+            status = self.__status(job_id)
+            with self.__writer.locked():
+                rows = self.__connection.execute(
+                    "SELECT seq, message FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq",
+                    (job_id, after)
+                ).fetchall()
+            if coalesce:
+                rows = _coalesce(rows)
+            for seq, message in rows:
+                after = seq
+                yield seq, message
+            if len(rows) > 0:
+                continue
+            if status in FINISHED_STATUSES:
+                return
+            with self.__changed:
+                self.__changed.wait(timeout=1)
+
+    def shutdown(self):
+        self.__pool.shutdown(wait=False,cancel_futures=True)
@@ -0,0 +1,330 @@
+import numpy as np
+from scipy.ndimage import uniform_filter1d
+from skimage.metrics import structural_similarity
+
+# elements per chunk when summing squared integer differences, keeps the scratch buffer small
+SSE_CHUNK = 1 << 20
+
+# PSNR reported for identical images, where the formula diverges
+IDENTICAL_PSNR = 50
+
+
+def _check_shapes(img1:np.ndarray, img2:np.ndarray):
+    if img1.shape != img2.shape:
+        raise ValueError("Input images must have the same dimensions.")
+
+
+def squared_error_sum(img1:np.ndarray, img2:np.ndarray):
+    """
+    Sum of squared differences between two images in a single pass.
+
+    Integer images are differenced chunk by chunk into a reusable integer buffer and
+    squared in place, so no full size float64 copy is made. Other dtypes fall back
+    to float64 arithmetic.
+
+    Returns:
+        sse: float - Sum of squared differences.
+    """
+    _check_shapes(img1,img2)
+    a = np.ascontiguousarray(img1).reshape(-1)
+    b = np.ascontiguousarray(img2).reshape(-1)
+
+    if not (np.issubdtype(a.dtype,np.integer) and np.issubdtype(b.dtype,np.integer)) or max(a.dtype.itemsize,b.dtype.itemsize) > 2:
+        diff = a.astype(np.float64) - b
+        return float(np.dot(diff,diff))
+
+    # 8 bit squared differences fit in int32, 16 bit ones need int64
+    work = np.int32 if max(a.dtype.itemsize,b.dtype.itemsize) == 1 else np.int64
+    buffer = np.empty(min(SSE_CHUNK,a.size),dtype=work)
+    sse = 0
+    for start in range(0,a.size,SSE_CHUNK):
+        stop = min(start + SSE_CHUNK,a.size)
+        diff = buffer[:stop - start]
+        np.subtract(a[start:stop],b[start:stop],out=diff,dtype=work)
+        np.square(diff,out=diff)
+        sse += int(diff.sum(dtype=np.int64))
+    return float(sse)
+
+
+def mse_psnr(img1:np.ndarray, img2:np.ndarray, data_range:float = 255):
+    """
+    Compute MSE and PSNR from one squared error pass.
+
+    Returns:
+        (mse, psnr): tuple - PSNR is IDENTICAL_PSNR when the images are equal.
+    """
+    sse = squared_error_sum(img1,img2)
+    mse = sse / img1.size
+    if mse == 0:
+        return 0.0, IDENTICAL_PSNR
+    return mse, float(10 * np.log10((data_range ** 2) / mse))
+
+
+def ssim(img1:np.ndarray, img2:np.ndarray, win_size:int = 7):
+    """
+    Mean SSIM over the channels of two (H, W, C) integer images.
+
+    Matches skimage.metrics.structural_similarity(win_size=win_size, channel_axis=-1)
+    with uniform weights and sample covariance, but filters the five local moments of
+    all channels together with one separable box filter per spatial axis instead of
+    running a full 2D filter per moment and per channel. Other layouts and float
+    images are delegated to skimage.
+
+    Returns:
+        ssim_value: float - Mean SSIM.
+    """
+    _check_shapes(img1,img2)
+    if img1.ndim != 3 or not np.issubdtype(img1.dtype,np.integer) or img1.dtype != img2.dtype or img1.dtype == np.bool_:
+        return structural_similarity(img1, img2, win_size=win_size, channel_axis=-1)
+
+    if win_size > img1.shape[0] or win_size > img1.shape[1]:
+        raise ValueError("win_size exceeds image extent.")
+
+    info = np.iinfo(img1.dtype)
+    data_range = float(info.max) - float(info.min)
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+    count = win_size ** 2
+    cov_norm = count / (count - 1)
+
+    moments = np.empty((5,) + img1.shape,dtype=np.float64)
+    x, y, xx, yy, xy = moments
+    x[...] = img1
+    y[...] = img2
+    np.multiply(x,x,out=xx)
+    np.multiply(y,y,out=yy)
+    np.multiply(x,y,out=xy)
+    # separable box filter over the spatial axes of every moment and channel at once
+    uniform_filter1d(moments,win_size,axis=1,output=moments,mode="reflect")
+    uniform_filter1d(moments,win_size,axis=2,output=moments,mode="reflect")
+
+    ux, uy, uxx, uyy, uxy = moments
+    vx = cov_norm * (uxx - ux * ux)
+    vy = cov_norm * (uyy - uy * uy)
+    vxy = cov_norm * (uxy - ux * uy)
+
+    numerator = (2 * ux * uy + c1) * (2 * vxy + c2)
+    denominator = (ux * ux + uy * uy + c1) * (vx + vy + c2)
+    s = numerator / denominator
+
+    pad = (win_size - 1) // 2
+    s = s[pad:s.shape[0] - pad,pad:s.shape[1] - pad]
+    return float(s.reshape(-1,s.shape[-1]).mean(axis=0,dtype=np.float64).mean())
+
+
+# Cost classes, they decide where Evaluator runs a metric
+CHEAP = "cheap"      # computed inline while the decoded pair is in memory
+POOLED = "pooled"    # CPU heavy, sent to the shared process pool
+BATCHED = "batched"  # model based, evaluated by the Evaluator in batches
+
+
+class Metric:
+    """
+    Registry entry describing one evaluation metric.
+    """
+
+    def __init__(self,name:str,cost:str,description:str,compute=None):
+        self.name = name
+        self.cost = cost
+        self.description = description
+        # compute(img1, img2, cache) -> float, None for BATCHED metrics implemented by the Evaluator
+        self.compute = compute
+
+    def to_dict(self):
+        return {
+            "name":self.name,
+            "cost":self.cost,
+            "description":self.description
+        }
+
+
+METRICS = {}
+
+
+def register_metric(metric:Metric):
+    if metric.cost not in [CHEAP,POOLED,BATCHED]:
+        raise ValueError(f"Unknown cost class {metric.cost} for metric {metric.name}")
+    METRICS[metric.name] = metric
+    return metric
+
+
+def resolve_metrics(names = None):
+    """
+    Turn a list (or comma separated string) of metric names into registry entries.
+
+    Returns:
+        metrics: list - Requested metrics in registry order, every metric when names is empty.
+    """
+    if names is None or len(names) == 0:
+        return list(METRICS.values())
+    if isinstance(names,str):
+        names = [name.strip() for name in names.split(",") if name.strip() != ""]
+    unknown = [name for name in names if name not in METRICS]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown metrics {unknown}, expected any of {list(METRICS)}")
+    return [metric for name, metric in METRICS.items() if name in names]
+
+
+def compute_metrics(item:tuple,names:list):
+    """
+    Compute the named metrics for one (index, (img1, img2)) item, used by the process pool.
+
+    Returns:
+        values: dict - Metric values keyed by name.
+    """
+    _, (img1, img2) = item
+    cache = {}
+    return {name:METRICS[name].compute(img1,img2,cache) for name in names}
+
+
+def _squared_error(img1:np.ndarray, img2:np.ndarray, cache:dict):
+    # PSNR and MSE requested together share one squared error pass
+    if cache is None:
+        cache = {}
+    if "mse_psnr" not in cache:
+        cache["mse_psnr"] = mse_psnr(img1,img2,data_range=255)
+    return cache["mse_psnr"]
+
+
+def calculate_psnr(img1:np.ndarray, img2:np.ndarray, cache:dict = None):
+    """
+    Calculate the Peak Signal-to-Noise Ratio (PSNR) between two images.
+
+    PSNR is a metric used to measure the quality of reconstructed images compared to original images, 
+    particularly in image compression and video encoding applications. It is defined as the ratio 
+    between the maximum possible power of a signal (the original image) and the power of corrupting 
+    noise (the difference between the original and reconstructed images).
+
+    PSNR Formula:
+        PSNR = 10 * log10(MAX_I^2 / MSE)
+
+    Where:
+        - MAX_I: Maximum possible pixel value of the image (255 for 8-bit images).
+        - MSE: Mean Squared Error calculated as:
+            MSE = (1/N) * sum((I(i) - K(i))^2)
+            Where:
+            - I: Original image.
+            - K: Reconstructed image.
+            - N: Number of pixels in the image.
+
+    Interpreting PSNR Values:
+        - Higher values indicate better quality.
+        - Common thresholds:
+            - Below 20 dB: Poor quality; noticeable distortion.
+            - 20-30 dB: Fair to good quality; noticeable artifacts may be present.
+            - 30-40 dB: Good quality; generally acceptable for most applications.
+            - Above 40 dB: Excellent quality; often indistinguishable from the original image.
+
+    Limitations:
+        - PSNR may not correlate well with perceived visual quality.
+        - It does not account for how humans perceive images; two images with the same PSNR might look 
+            different to the human eye.
+
+    Parameters:
+        img1: np.ndarray - First image (original image).
+        img2: np.ndarray - Second image (compressed or decompressed image).
+
+    Returns:
+        psnr_value: float - PSNR value.
+    """
+    return _squared_error(img1,img2,cache)[1]
+
+
+def calculate_ssim(img1:np.ndarray, img2:np.ndarray, cache:dict = None):
+    """
+    Calculate the Structural Similarity Index (SSIM) between two images.
+
+    SSIM is a perceptual metric that quantifies the similarity between two images. 
+    It is based on the idea that the human visual system is highly sensitive to structural information 
+    in an image. SSIM considers changes in structural information, luminance, and contrast, 
+    providing a more accurate measure of perceived image quality than metrics like PSNR.
+
+    SSIM Formula:
+        SSIM(x, y) = (2 * μ_x * μ_y + C1) * (2 * σ_xy + C2) / ((μ_x^2 + μ_y^2 + C1) * (σ_x^2 + σ_y^2 + C2))
+
+    Where:
+        - μ_x and μ_y: Mean values of the two images.
+        - σ_x^2 and σ_y^2: Variances of the two images.
+        - σ_xy: Covariance between the two images.
+        - C1 and C2: Constants to stabilize the division; typically C1 = (K1 * L)^2 and C2 = (K2 * L)^2, where K1 and K2 are small constants, and L is the dynamic range of the pixel values.
+
+    Interpreting SSIM Values:
+        - SSIM values range from -1 to 1.
+        - A value of 1 indicates perfect structural similarity.
+        - Values closer to 1 indicate higher similarity, while values closer to -1 indicate lower similarity.
+        - Typical ranges:
+            - 0.9 to 1.0: Excellent quality; very similar images.
+            - 0.7 to 0.9: Good quality; noticeable but acceptable differences.
+            - 0.5 to 0.7: Fair quality; significant differences.
+            - Below 0.5: Poor quality; very different images.
+
+    Limitations:
+        - SSIM can be sensitive to alignment; images must be properly aligned to obtain accurate results.
+        - It may not capture all perceptual differences, especially for images with significant variations in lighting or content.
+
+    Parameters:
+    img1: np.ndarray - First image (original image).
+    img2: np.ndarray - Second image (compressed or decompressed image).
+
+    Returns:
+        ssim_value: float - SSIM value.
+    """
+    min_size = min(img1.shape[:2])  # Get the minimum dimension of the image (height or width)
+
+    # Set win_size to a smaller odd value if the image is too small
+    if min_size < 7:
+        win_size = min_size if min_size % 2 != 0 else min_size - 1  # Make sure win_size is odd
+        print(f"Image size is small. Using win_size = {win_size} for SSIM calculation.")
+    else:
+        win_size = 7  # Default win_size
+
+    return ssim(img1, img2, win_size=win_size)
+
+
+def calculate_mse(img1:np.ndarray, img2:np.ndarray, cache:dict = None):
+    """
+
+    Calculate the Mean Squared Error (MSE) between two images.
+
+    MSE is a measure of the average squared differences between the original and 
+    reconstructed images. It quantifies the error introduced by the compression or 
+    reconstruction process, providing a numerical value that indicates how closely 
+    the two images match.
+
+    MSE Formula:
+        MSE = (1/N) * sum((I(i) - K(i))^2)
+
+    Where:
+        - I(i): Pixel value of the original image at position i.
+        - K(i): Pixel value of the reconstructed/compressed image at position i.
+        - N: Total number of pixels in the image.
+
+    Interpreting MSE Values:
+        - Lower MSE values indicate better quality, as they represent less deviation 
+            from the original image.
+        - An MSE of 0 indicates perfect reconstruction, meaning the two images are identical.
+        - Common interpretation ranges:
+            - 0 to 10: Excellent quality; minimal differences.
+            - 10 to 20: Good quality; slight differences may be noticeable.
+            - 20 to 30: Fair quality; noticeable differences.
+            - Above 30: Poor quality; significant differences.
+
+    Limitations:
+        - MSE does not account for perceptual differences; it treats all pixel differences 
+            equally, which may not align with human visual perception.
+        - It can be overly sensitive to noise and outliers.
+
+    Parameters:
+        img1: np.ndarray - First image (original image).
+        img2: np.ndarray - Second image (compressed or decompressed image).
+
+    Returns:
+        mse_value: float - MSE value.
+    """
+    return _squared_error(img1,img2,cache)[0]
+
+
+register_metric(Metric("PSNR",CHEAP,"Peak signal-to-noise ratio in dB, higher is better.",calculate_psnr))
+register_metric(Metric("SSIM",POOLED,"Structural similarity index, 1 means identical structure.",calculate_ssim))
+register_metric(Metric("MSE",CHEAP,"Mean squared pixel error, lower is better.",calculate_mse))
+register_metric(Metric("LPIPS",BATCHED,"Learned perceptual similarity from a pretrained network, lower is better."))
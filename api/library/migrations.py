@@ -0,0 +1,35 @@
+# Ordered schema migrations, MIGRATIONS[i] upgrades the database from version i to i + 1.
+# The applied version is stored in PRAGMA user_version, so append new steps, never edit old ones.
+MIGRATIONS = [
+    [
+        "CREATE TABLE IF NOT EXISTS datasets (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, path TEXT)",
+        "CREATE TABLE IF NOT EXISTS extracted_datasets (id INTEGER PRIMARY KEY AUTOINCREMENT, zip_file_path TEXT, destination_folder TEXT)",
+        "CREATE TABLE IF NOT EXISTS image_data (id INTEGER PRIMARY KEY AUTOINCREMENT,run_id TEXT,height INT,width INT,input_image_path TEXT, compressed_image_path TEXT, noisy_image_path TEXT,decompressed_image_path TEXT, input_image_size INTEGER, compressed_image_size INTEGER, noisy_image_size INTEGER, decompressed_image_size INTEGER,compression_time REAL, decompression_time REAL,results TEXT)"
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS idx_image_data_run_input ON image_data (run_id, input_image_path)",
+        "CREATE INDEX IF NOT EXISTS idx_image_data_run_compressed ON image_data (run_id, compressed_image_path)",
+        "CREATE INDEX IF NOT EXISTS idx_image_data_run_noisy ON image_data (run_id, noisy_image_path)"
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS band_statistics (id INTEGER PRIMARY KEY AUTOINCREMENT, input_path TEXT NOT NULL, band INTEGER NOT NULL, dtype TEXT, file_count INTEGER, pixel_count INTEGER, minimum INTEGER, maximum INTEGER, low_percentile REAL, high_percentile REAL, low_value INTEGER, high_value INTEGER, histogram BLOB, UNIQUE (input_path, band))"
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS directory_index (path TEXT PRIMARY KEY, parent TEXT, mtime INTEGER)",
+        "CREATE INDEX IF NOT EXISTS idx_directory_index_parent ON directory_index (parent)",
+        "CREATE TABLE IF NOT EXISTS file_index (path TEXT PRIMARY KEY, folder TEXT NOT NULL, name TEXT NOT NULL, size INTEGER, mtime INTEGER, format TEXT)",
+        "CREATE INDEX IF NOT EXISTS idx_file_index_folder ON file_index (folder, name)"
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, run_id TEXT, status TEXT, config TEXT, error TEXT, created_at REAL, started_at REAL, finished_at REAL)",
+        "CREATE TABLE IF NOT EXISTS job_events (id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT NOT NULL, seq INTEGER NOT NULL, message TEXT, created_at REAL)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_job_events_job_seq ON job_events (job_id, seq)"
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS stage_cache (key TEXT PRIMARY KEY, stage TEXT, size INTEGER, hits INTEGER, created_at REAL, last_used REAL)",
+        "CREATE INDEX IF NOT EXISTS idx_stage_cache_last_used ON stage_cache (last_used)"
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS stage_checkpoints (run_id TEXT NOT NULL, stage TEXT NOT NULL, output_folder TEXT NOT NULL, input_path TEXT NOT NULL, output_path TEXT, completed_at REAL, PRIMARY KEY (run_id, stage, output_folder, input_path))"
+    ]
+]
@@ -0,0 +1,76 @@
+import os
+import threading
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of the Keras autoencoder models.
+
+    Models are keyed by their absolute path and the file mtime, so a model that is
+    re-exported to the same path is picked up on the next lookup while unchanged
+    models are only deserialised once per process.
+    """
+
+    def __init__(self):
+        self.__models = {}
+        self.__lock = threading.Lock()
+
+    def __key(self,path:str):
+        path = os.path.abspath(path)
+        return path, os.path.getmtime(path)
+
+    def get(self,path:str):
+        """
+        Return the model stored at path, loading it on first use.
+
+        Parameters:
+            path: str - Path of the saved Keras model (.h5).
+
+        Returns:
+            model: keras.Model - The loaded model.
+        """
+        key = self.__key(path)
+        with self.__lock:
+            model = self.__models.get(key)
+            if model is None:
+                # drop stale versions of the same file before loading the new one
+                for cached in [cached for cached in self.__models if cached[0] == key[0]]:
+                    del self.__models[cached]
+                # imported here so worker processes that unpickle pipeline functions never pull in tensorflow
+                from tensorflow import keras
+                model = keras.models.load_model(key[0])
+                self.__models[key] = model
+            return model
+
+    def warm_up(self,paths:list):
+        """
+        Load every model in paths that exists on disk, skipping missing files.
+
+        Returns:
+            loaded: list - Paths of the models now held by the registry.
+        """
+        loaded = []
+        for path in paths:
+            if os.path.isfile(path):
+                self.get(path)
+                loaded.append(path)
+        return loaded
+
+    def evict(self,path:str = None):
+        """
+        Drop a model (or every model when path is None) from the registry.
+        """
+        with self.__lock:
+            if path is None:
+                self.__models.clear()
+                return
+            path = os.path.abspath(path)
+            for cached in [cached for cached in self.__models if cached[0] == path]:
+                del self.__models[cached]
+
+    def loaded(self):
+        with self.__lock:
+            return [path for path, _ in self.__models]
+
+
+model_registry = ModelRegistry()
@@ -1,55 +1,408 @@
-import glob
 import numpy as np
 import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
 from PIL import Image
 import sqlite3
 import os
-from tqdm import tqdm
-import json
+import threading
+from . import sources
+from .image_data_writer import ImageDataWriter
+from .stage_runner import StageRunner
+
+
+OUTPUT_FORMATS = ["tiff","cog"]
+COG_COMPRESSIONS = ["deflate","lzw","zstd"]
+COG_BLOCK_SIZE = 512
+
+# per thread scratch buffers, reused across files so a conversion does not allocate per tile.
+# A worker with workers=1 runs inline in the thread of its job or scheduler step, so buffers
+# shared by the threads of a process would be overwritten by conversions running alongside.
+_BUFFERS = threading.local()
+
+
+def _buffer(name:str,shape:tuple,dtype):
+    """
+    Return a contiguous array of the given shape backed by the named buffer of the calling thread.
+
+    The buffer only grows, so files and blocks of the same or smaller size reuse it.
+    """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    buffers = getattr(_BUFFERS,"buffers",None)
+    if buffers is None:
+        buffers = _BUFFERS.buffers = {}
+    buffer = buffers.get(name)
+    if buffer is None or buffer.dtype != dtype or buffer.size < size:
+        buffer = np.empty(size,dtype=dtype)
+        buffers[name] = buffer
+    return buffer[:size].reshape(shape)
+
+
+def _read_bands(src,bands:list,window = None):
+    """
+    Read every requested band with one rasterio call into the raw buffer of the calling thread.
+    """
+    if window is None:
+        shape = (len(bands),src.height,src.width)
+    else:
+        shape = (len(bands),int(window.height),int(window.width))
+    raw = _buffer("raw",shape,src.dtypes[bands[0] - 1])
+    return src.read(bands,window=window,out=raw)
+
+
+def _normalize(raw:np.ndarray,minimum,maximum,out:np.ndarray):
+    """
+    Stretch raw from [minimum, maximum] to uint8 into out, using one float32 scratch buffer.
+
+    out may be band first like raw or a band last (height, width, bands) view for PIL.
+    """
+    work = _buffer("work",raw.shape,np.float32)
+    np.subtract(raw,minimum,out=work,dtype=np.float32)
+    # divide then scale, as the original (x - min) / (max - min) * 255 did, a premultiplied
+    # 255 / (max - min) rounds the brightest pixels down to 254 once truncated
+    if maximum > minimum:
+        work /= np.float32(float(maximum) - float(minimum))
+        work *= 255
+    else:
+        work[...] = 0
+    if out.shape != work.shape:
+        work = work.transpose(1,2,0)
+    np.copyto(out,work,casting="unsafe")
+    return out
+
+
+def _histogram_layout(dtype):
+    """
+    Describe the histogram of an integer raster dtype.
+
+    Returns:
+        bins: int - Number of possible values.
+        offset: int - Amount added to a value to get its histogram index.
+        view: np.dtype - Unsigned dtype of the same size, used to index with the raw bits.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind not in "ui" or dtype.itemsize > 2:
+        raise ValueError(f"Band statistics need 8 or 16 bit integer rasters, got {dtype}")
+    info = np.iinfo(dtype)
+    return int(info.max) - int(info.min) + 1, -int(info.min), np.dtype(f"u{dtype.itemsize}")
+
+
+def _band_histograms(input_path:str,bands:list):
+    """
+    Stream the blocks of a scene into one value histogram per requested band.
+
+    Histograms of the same dtype are merged by adding them, so a dataset is summarised
+    file by file without holding more than one block in memory.
+
+    Returns:
+        (dtype, histograms): tuple - Raster dtype name and a (bands, bins) int64 array.
+    """
+    with rasterio.open(input_path) as src:
+        dtype = np.dtype(src.dtypes[bands[0] - 1])
+        bins, offset, view = _histogram_layout(dtype)
+        histograms = np.zeros((len(bands),bins),dtype=np.int64)
+        for _, window in src.block_windows(bands[0]):
+            block = _read_bands(src,bands,window)
+            for index in range(len(bands)):
+                histograms[index] += np.bincount(block[index].view(view).ravel(),minlength=bins)
+    # bincount indexes by the raw bits, roll so index 0 is the smallest value of the dtype
+    return dtype.name, np.roll(histograms,offset,axis=1)
+
+
+def _band_luts(dtype:str,low_values:list,high_values:list):
+    """
+    Build the uint8 lookup table of every band, indexed by the raw bits of a pixel.
+    """
+    bins, offset, _ = _histogram_layout(dtype)
+    values = np.arange(bins,dtype=np.float32) - offset
+    luts = np.empty((len(low_values),bins),dtype=np.uint8)
+    for index, (low_value, high_value) in enumerate(zip(low_values,high_values)):
+        scale = 255 / (high_value - low_value) if high_value > low_value else 0
+        lut = np.clip((values - low_value) * scale,0,255)
+        luts[index] = np.roll(lut,-offset)
+    return luts
+
+
+def _apply_luts(raw:np.ndarray,luts:np.ndarray,out:np.ndarray):
+    """
+    Map every band of raw through its lookup table into out.
+
+    out may be band first like raw or a band last (height, width, bands) view for PIL.
+    """
+    _, _, view = _histogram_layout(raw.dtype)
+    if luts.shape[1] != np.iinfo(view).max + 1:
+        raise ValueError(f"Band statistics were computed for another dtype than {raw.dtype}")
+    for index in range(raw.shape[0]):
+        target = out[index] if out.shape[0] == raw.shape[0] else out[...,index]
+        target[...] = luts[index][raw[index].view(view)]
+    return out
+
+
+def _output_profile(src,count:int,output_format:str,compression:str):
+    """
+    Build the rasterio profile of a converted scene, keeping the georeferencing of src.
+
+    'tiff' writes plain strips, 'cog' writes the tiled, compressed intermediate that
+    _finish_cog turns into a Cloud-Optimized GeoTIFF.
+    """
+    profile = {
+        "driver":"GTiff",
+        "width":src.width,
+        "height":src.height,
+        "count":count,
+        "dtype":"uint8",
+        "interleave":"pixel",
+        "tiled":False
+    }
+    if count == 3:
+        profile["photometric"] = "RGB"
+    if src.crs is not None:
+        profile["crs"] = src.crs
+        profile["transform"] = src.transform
+    if output_format == "cog":
+        profile.update(tiled=True,blockxsize=COG_BLOCK_SIZE,blockysize=COG_BLOCK_SIZE,compress=compression)
+    return profile
+
+
+def _finish_cog(temp_path:str,output_path:str,compression:str):
+    """
+    Add overviews to the tiled intermediate and copy it to output_path with the overviews
+    stored after the full resolution tiles, as readers of a Cloud-Optimized GeoTIFF expect.
+    """
+    try:
+        with rasterio.open(temp_path,"r+") as dst:
+            factors = []
+            factor = 2
+            while min(dst.width,dst.height) / factor >= COG_BLOCK_SIZE / 2:
+                factors.append(factor)
+                factor *= 2
+            if len(factors) > 0:
+                dst.build_overviews(factors,Resampling.average)
+        rasterio.shutil.copy(
+            temp_path,
+            output_path,
+            driver="GTiff",
+            tiled=True,
+            blockxsize=COG_BLOCK_SIZE,
+            blockysize=COG_BLOCK_SIZE,
+            compress=compression,
+            predictor=2,
+            interleave="pixel",
+            copy_src_overviews=True
+        )
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _convert_ms_to_rgb(input_path:str, output_folder:str,bands:list,luts:np.ndarray = None,output_format:str = "tiff",compression:str = "deflate"):
+    file_name = input_path.split("/")[-1]
+    output_path = f"{output_folder}/{file_name}"
+    # Open the tiff file
+    with rasterio.open(input_path) as src:
+        composite = _read_bands(src,bands)
+        rgb = _buffer("rgb",(src.height,src.width,len(bands)),np.uint8)
+        if luts is None:
+            _normalize(composite,composite.min(),composite.max(),rgb)
+        else:
+            _apply_luts(composite,luts,rgb)
+        if output_format == "tiff":
+            image = Image.fromarray(rgb)
+            image.save(output_path, format='TIFF')
+            return {"output_image_path":output_path}
+        with rasterio.open(f"{output_path}.tmp","w",**_output_profile(src,len(bands),output_format,compression)) as dst:
+            dst.write(rgb.transpose(2,0,1))
+    _finish_cog(f"{output_path}.tmp",output_path,compression)
+    return {"output_image_path":output_path}
+
+
+def _convert_ms_to_rgb_windowed(input_path:str, output_folder:str,bands:list,luts:np.ndarray = None,output_format:str = "tiff",compression:str = "deflate"):
+    """
+    Convert a scene block by block so memory stays bounded by the block size of the source.
+
+    The first pass streams the blocks to find the global min/max, the second normalizes each
+    block with it and writes it to the output, giving the same pixels as _convert_ms_to_rgb.
+    With dataset lookup tables the first pass is skipped.
+    """
+    file_name = input_path.split("/")[-1]
+    output_path = f"{output_folder}/{file_name}"
+    with rasterio.open(input_path) as src:
+        windows = [window for _, window in src.block_windows(bands[0])]
+
+        # first pass: global min/max over every requested band
+        minimum, maximum = None, None
+        for window in windows if luts is None else []:
+            block = _read_bands(src,bands,window)
+            minimum = block.min() if minimum is None else min(minimum, block.min())
+            maximum = block.max() if maximum is None else max(maximum, block.max())
+
+        # second pass: normalize and write one block at a time
+        write_path = output_path if output_format == "tiff" else f"{output_path}.tmp"
+        with rasterio.open(write_path, "w", **_output_profile(src,len(bands),output_format,compression)) as dst:
+            for window in windows:
+                block = _read_bands(src,bands,window)
+                rgb = _buffer("rgb",block.shape,np.uint8)
+                if luts is None:
+                    _normalize(block,minimum,maximum,rgb)
+                else:
+                    _apply_luts(block,luts,rgb)
+                dst.write(rgb, window=window)
+    if output_format == "cog":
+        _finish_cog(write_path,output_path,compression)
+    return {"output_image_path":output_path}
+
 
 class PreProcessor:
 
-    def __init__(self):
-        pass
-
-    def __convert_ms_to_rgb(self, input_path:str, output_folder:str,bands:list):
-        file_name = input_path.split("/")[-1]
-        # Open the tiff file
-        with rasterio.open(input_path) as src:
-            data = [src.read(band) for band in bands]
-            composite = np.dstack(data)
-            composite = (composite - composite.min()) / (composite.max() - composite.min()) * 255
-            composite = composite.astype(np.uint8)
-            image = Image.fromarray(composite)
-            image.save(f"{output_folder}/{file_name}", format='TIFF')
-
-    def convert_ms_to_rgb(self, input_path:str, output_folder:str,bands:list = [3,2,1]):
-        
+    def __init__(self,connection:sqlite3.Connection,writer:ImageDataWriter):
+        self.__connection = connection
+        self.__writer = writer
+        self.__runner = StageRunner(connection,writer)
+
+    def __load_luts(self,statistics:str,bands:list):
+        """
+        Build the lookup tables of the requested bands from the stored dataset statistics.
+        """
+        with self.__writer.locked(), self.__connection:
+            cursor = self.__connection.cursor()
+            cursor.execute(
+                """SELECT band, dtype, low_value, high_value
+                FROM band_statistics
+                WHERE input_path = ?""",
+                (statistics,)
+            )
+            rows = {row[0]:row for row in cursor.fetchall()}
+            cursor.close()
+
+        missing = [band for band in bands if band not in rows]
+        if len(missing) > 0:
+            raise ValueError(f"No band statistics for bands {missing} of {statistics}, run compute_band_statistics first")
+        dtype = rows[bands[0]][1]
+        return _band_luts(dtype,[rows[band][2] for band in bands],[rows[band][3] for band in bands])
+
+    def __store_statistics(self,input_path:str,bands:list,dtype:str,histograms:np.ndarray,file_count:int,low:float,high:float):
+        _, offset, _ = _histogram_layout(dtype)
+        # the bands of a dataset are stored together or not at all
+        with self.__writer.transaction() as unit:
+            for band, histogram in zip(bands,histograms):
+                cumulative = np.cumsum(histogram)
+                total = int(cumulative[-1])
+                if total == 0:
+                    continue
+                present = np.nonzero(histogram)[0]
+                # smallest value whose cumulative count reaches the percentile
+                low_value = int(np.searchsorted(cumulative,max(1,total * low / 100))) - offset
+                high_value = int(np.searchsorted(cumulative,max(1,total * high / 100))) - offset
+                self.__writer.execute(
+                    """INSERT OR REPLACE INTO band_statistics
+                    (input_path, band, dtype, file_count, pixel_count, minimum, maximum, low_percentile, high_percentile, low_value, high_value, histogram)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (input_path,
+                    band,
+                    dtype,
+                    file_count,
+                    total,
+                    int(present[0]) - offset,
+                    int(present[-1]) - offset,
+                    low,
+                    high,
+                    low_value,
+                    high_value,
+                    histogram.astype(np.int64).tobytes())
+                )
+        self.__writer.commit(unit)
+
+    def compute_band_statistics(self, input_path:str,bands:list = [3,2,1],low:float = 2.0,high:float = 98.0,workers:int = 1,run_id:str = ""):
+        """
+        Compute per band percentile statistics over every tiff of a dataset.
+
+        Each file is reduced to one histogram per band and the histograms are merged, so
+        the percentiles describe the whole dataset. The result is stored in band_statistics
+        keyed by input_path, pass that path as statistics to convert_ms_to_rgb to use it.
+
+        Parameters:
+            input_path: str - Dataset folder or single tiff file.
+            bands: list - Bands to summarise.
+            low: float - Percentile mapped to 0.
+            high: float - Percentile mapped to 255.
+            workers: int - Number of processes, 0 uses every core.
+            run_id: str - Set by the pipeline, shares the file listing with the other stages of the run.
+        """
+        # if the input path is a file, summarise that file
+        if sources.is_file(input_path):
+            dtype, histograms = _band_histograms(input_path,bands)
+            self.__store_statistics(input_path,bands,dtype,histograms,1,low,high)
+            return
+
+        merged = {"dtype":None,"histograms":None,"file_count":0}
+
+        def merge(tiff_file, result):
+            if merged["dtype"] is not None and result[0] != merged["dtype"]:
+                raise ValueError(f"{tiff_file} is {result[0]}, the dataset is {merged['dtype']}")
+            merged["dtype"] = result[0]
+            merged["histograms"] = result[1] if merged["histograms"] is None else merged["histograms"] + result[1]
+            merged["file_count"] += 1
+
+        for res in self.__runner.run(_band_histograms,{"bands":bands},input_path,"tif",run_id,workers,log=merge):
+            yield res
+
+        if merged["histograms"] is not None:
+            self.__store_statistics(input_path,bands,merged["dtype"],merged["histograms"],merged["file_count"],low,high)
+
+    def get_band_statistics(self, input_path:str):
+        """
+        Get the stored band statistics of a dataset.
+
+        Returns:
+            statistics: list - One dictionary per band, without the histogram.
+        """
+        with self.__writer.locked(), self.__connection:
+            cursor = self.__connection.cursor()
+            cursor.execute(
+                """SELECT band, dtype, file_count, pixel_count, minimum, maximum, low_percentile, high_percentile, low_value, high_value
+                FROM band_statistics
+                WHERE input_path = ?
+                ORDER BY band""",
+                (input_path,)
+            )
+            columns = [column[0] for column in cursor.description]
+            statistics = [dict(zip(columns,row)) for row in cursor.fetchall()]
+            cursor.close()
+
+        if len(statistics) == 0:
+            raise ValueError("No band statistics found for the specified path.")
+        return statistics
+
+    def convert_ms_to_rgb(self, input_path:str, output_folder:str,bands:list = [3,2,1],workers:int = 1,windowed:bool = False,statistics:str = "",output_format:str = "tiff",compression:str = "deflate",run_id:str = ""):
+
+        # 'cog' writes tiled, compressed GeoTIFFs with overviews that keep the CRS and transform
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format {output_format}, expected one of {OUTPUT_FORMATS}")
+        if compression not in COG_COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression}, expected one of {COG_COMPRESSIONS}")
+
+        # windowed mode streams large scenes block by block instead of loading every band at once
+        worker = _convert_ms_to_rgb_windowed if windowed else _convert_ms_to_rgb
+
+        # statistics names a path given to compute_band_statistics, its percentiles replace the per file min/max
+        luts = None if statistics == "" else self.__load_luts(statistics,bands)
+
         # if the input path is a file, convert that file
-        if os.path.isfile(input_path):
-            self.__convert_ms_to_rgb(input_path,output_folder,bands)
+        if sources.is_file(input_path):
+            worker(input_path,output_folder,bands,luts,output_format,compression)
             return
 
-        # Get all tiff files in the folder even in subdirectories
-        tiff_files = glob.glob(f"{input_path}/**/*.tif", recursive=True)
-
-        # Create the output folder if it does not exist
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder, exist_ok=True)
-
-
-        to_return = {
-            "success":0,
-            "failed":0,
-            "total":len(tiff_files)
-        }
-
-        for tiff_file in tqdm(tiff_files):
-            try:
-                self.__convert_ms_to_rgb(tiff_file,output_folder,bands)
-                to_return["success"] += 1
-                yield json.dumps(to_return)
-            except Exception as e:
-                to_return["failed"] += 1
-                yield json.dumps(to_return)
-                continue
+        for res in self.__runner.run(
+            worker,
+            {"output_folder":output_folder,"bands":bands,"luts":luts,"output_format":output_format,"compression":compression},
+            input_path,
+            "tif",
+            run_id,
+            workers,
+            output_folder=output_folder,
+            stage="convert_ms_to_rgb",
+            output_of=lambda tiff_file, result: f"{output_folder}/{tiff_file.split('/')[-1]}",
+            cached=True
+        ):
+            yield res
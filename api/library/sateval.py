@@ -1,10 +1,14 @@
 from .dataset_loader import DatasetLoader
 from .configurables import Configurables
 from .preprocessor import PreProcessor
-from .compressor import Compressor
-from .decompressor import Decompressor
+from .compressor import Compressor, ENCODER_MODEL_PATH
+from .decompressor import Decompressor, DECODER_MODEL_PATH
 from .evaluator import Evaluator
 from .simulated_noise_injector import SimulatedNoiseInjector
+from .model_registry import model_registry
+from .image_data_writer import ImageDataWriter
+from .migrations import MIGRATIONS
+from .fusion import Fusion
 
 import sqlite3
 
@@ -20,28 +24,42 @@ class SatEval:
 
 
     __connection:sqlite3.Connection
+    __writer:ImageDataWriter
 
-    def __init__(self,dataset_dir:str):
-        self.__connection = sqlite3.connect('sateval.db',check_same_thread=False,autocommit=True)
-        self.dataset_loader = DatasetLoader(f"data/{dataset_dir}",self.__connection)
-        self.configurables = Configurables()
-        self.pre_processor = PreProcessor()
-        self.compressor = Compressor(self.__connection)
-        self.simulated_noise_injector = SimulatedNoiseInjector(self.__connection)
-        self.decompressor = Decompressor(self.__connection)
-        self.evaluator = Evaluator(self.__connection)
+    def __init__(self,dataset_dir:str,warm_up_models:bool = True):
+        # the job manager writes to the same database, wait for its lock instead of failing
+        self.__connection = sqlite3.connect('sateval.db',check_same_thread=False,autocommit=True,timeout=30)
+        # WAL lets the readers of job events and results run while a stage is writing
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__writer = ImageDataWriter(self.__connection)
+        self.dataset_loader = DatasetLoader(f"data/{dataset_dir}",self.__connection,self.__writer)
+        self.configurables = Configurables(Fusion(self.__connection,self.__writer))
+        self.pre_processor = PreProcessor(self.__connection,self.__writer)
+        self.compressor = Compressor(self.__connection,self.__writer)
+        self.simulated_noise_injector = SimulatedNoiseInjector(self.__connection,self.__writer)
+        self.decompressor = Decompressor(self.__connection,self.__writer)
+        self.evaluator = Evaluator(self.__connection,self.__writer)
         self.__migrate__()
+        if warm_up_models:
+            # load the autoencoder once so the first dl stage only pays for inference
+            model_registry.warm_up([ENCODER_MODEL_PATH,DECODER_MODEL_PATH])
 
     def __migrate__(self):
-        with self.__connection:   
-            self.__connection.execute(
-                "CREATE TABLE IF NOT EXISTS datasets (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, path TEXT)"
-            )
-            self.__connection.execute(
-                    "CREATE TABLE IF NOT EXISTS extracted_datasets (id INTEGER PRIMARY KEY AUTOINCREMENT, zip_file_path TEXT, destination_folder TEXT)"
-            )
-            self.__connection.execute(
-                    "CREATE TABLE IF NOT EXISTS image_data (id INTEGER PRIMARY KEY AUTOINCREMENT,run_id TEXT,height INT,width INT,input_image_path TEXT, compressed_image_path TEXT, noisy_image_path TEXT,decompressed_image_path TEXT, input_image_size INTEGER, compressed_image_size INTEGER, noisy_image_size INTEGER, decompressed_image_size INTEGER,compression_time REAL, decompression_time REAL,results TEXT)"
-            )
-            self.__connection.commit()
-
+        """
+        Apply every migration newer than the version recorded in the database.
+        """
+        version = self.__connection.execute("PRAGMA user_version").fetchone()[0]
+        for target, statements in enumerate(MIGRATIONS[version:],start=version + 1):
+            cursor = self.__connection.cursor()
+            try:
+                cursor.execute("BEGIN")
+                for statement in statements:
+                    cursor.execute(statement)
+                # PRAGMA does not accept bound parameters
+                cursor.execute(f"PRAGMA user_version = {int(target)}")
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            finally:
+                cursor.close()
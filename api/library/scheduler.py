@@ -0,0 +1,162 @@
+import os
+import queue
+import threading
+from .cancellation import Cancelled, cancellation
+from .streams import streams
+from . import sources
+
+# modules whose methods read an input folder and write an output folder file by file
+FILE_MODULES = ["compressor","decompressor","simulated_noise_injector"]
+FILE_METHODS = ["pre_processor:convert_ms_to_rgb"]
+ROW_METHODS = ["evaluator:evaluate","evaluator:evaluate_many"]
+
+# messages the stages may be ahead of the caller
+MESSAGE_QUEUE_SIZE = 256
+
+_DONE = object()
+
+
+def _kind(step:list):
+    """
+    'files' for file stages and fused chains, 'rows' for evaluations, 'other' for the rest.
+    """
+    if len(step) > 1:
+        return "files"
+    execution_path = step[0]["execution_path"]
+    params = step[0]["params"]
+    if execution_path in ROW_METHODS:
+        return "rows"
+    if (execution_path.split(":")[0] in FILE_MODULES or execution_path in FILE_METHODS) and "input_path" in params and "output_folder" in params:
+        return "files"
+    return "other"
+
+
+def _input(step:list):
+    return os.path.abspath(step[0]["params"]["input_path"])
+
+
+def _outputs(step:list):
+    return [os.path.abspath(item["params"]["output_folder"]) for item in step]
+
+
+class Scheduler:
+    """
+    Runs the steps of a pipeline as a DAG instead of one after another.
+
+    Consecutive file stages and evaluations form a phase whose steps run at the same time,
+    each on its own thread. A stage reading the output folder of an earlier stage of the
+    phase gets its files through a bounded stream as they are written, so tile k can be
+    decompressed or evaluated while tile k+1 is still being compressed, and evaluations
+    pick up rows as the stages fill them. Steps that are neither, such as downloads, run
+    alone, after everything before them and before everything after them.
+    """
+
+    def __conflicts(self,phase:list,step:list):
+        if any(_kind(other) == "rows" for other in phase):
+            # stages after an evaluation must not add rows it would then wait for
+            return True
+        folders = {_input(other) for other in phase} | {folder for other in phase for folder in _outputs(other)}
+        if any(folder in folders for folder in _outputs(step)):
+            return True
+        producers = [other for other in phase if _input(step) in _outputs(other)]
+        # a stage reading a single file publishes nothing, its reader walks the folder afterwards
+        return any(sources.is_file(other[0]["params"]["input_path"]) for other in producers)
+
+    def phases(self,steps:list):
+        """
+        Group steps into phases whose steps can run at the same time.
+        """
+        phases = []
+        phase = []
+        for step in steps:
+            kind = _kind(step)
+            if kind == "other" or (kind == "files" and len(phase) > 0 and self.__conflicts(phase,step)):
+                if len(phase) > 0:
+                    phases.append(phase)
+                phase = []
+            phase.append(step)
+            if kind == "other":
+                phases.append(phase)
+                phase = []
+        if len(phase) > 0:
+            phases.append(phase)
+        return phases
+
+    def __run_step(self,run_id:str,step:list,run_step,messages:queue.Queue,failures:list):
+        kind = _kind(step)
+        try:
+            for res in run_step(step):
+                messages.put(res)
+        except Cancelled as e:
+            failures.append(e)
+        except Exception as e:
+            messages.put(str(ValueError("Error running step: {}".format(str(e)))))
+        finally:
+            if kind == "files":
+                streams.leave(run_id,_input(step))
+                streams.close(run_id,_outputs(step)[-1])
+                streams.finish(run_id)
+            messages.put(_DONE)
+
+    def __run_phase(self,run_id:str,phase:list,run_step):
+        files = [step for step in phase if _kind(step) == "files"]
+        for step in files:
+            readers = len([other for other in files if other is not step and _input(other) == _outputs(step)[-1]])
+            if readers > 0:
+                streams.open(run_id,_outputs(step)[-1],readers)
+            streams.start(run_id)
+
+        messages = queue.Queue(maxsize=MESSAGE_QUEUE_SIZE)
+        failures = []
+        threads = [
+            threading.Thread(target=self.__run_step,args=(run_id,step,run_step,messages,failures),daemon=True)
+            for step in phase
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            running = len(threads)
+            while running > 0:
+                message = messages.get()
+                if message is _DONE:
+                    running -= 1
+                    continue
+                yield message
+        finally:
+            if running > 0:
+                # the caller stopped listening, stop the stages instead of leaving them running unobserved
+                cancellation.cancel(run_id)
+                while running > 0:
+                    if messages.get() is _DONE:
+                        running -= 1
+            for thread in threads:
+                thread.join()
+
+        if len(failures) > 0:
+            raise failures[0]
+
+    def run(self,run_id:str,steps:list,run_step):
+        """
+        Run the steps of a pipeline phase by phase.
+
+        Parameters:
+            run_id: str - Unique identifier for the current run.
+            steps: list - Lists of config items, a list with several items is a fused chain.
+            run_step: callable - Returns the message generator of a step.
+
+        Yields:
+            message: str - Messages of the steps in the order they are produced.
+        """
+        token = cancellation.token(run_id)
+        for phase in self.phases(steps):
+            token.check()
+            if len(phase) == 1:
+                for res in run_step(phase[0]):
+                    yield res
+                continue
+            for res in self.__run_phase(run_id,phase,run_step):
+                yield res
+
+
+scheduler = Scheduler()
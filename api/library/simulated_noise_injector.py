@@ -1,5 +1,3 @@
-import glob
-import json
 import os
 import sqlite3
 import numpy as np
@@ -7,532 +5,271 @@ import cv2
 from PIL import Image
 import time
 
-from tqdm import tqdm
+from .image_data_writer import ImageDataWriter
+from .stage_runner import StageRunner
 
 
-class SimulatedNoiseInjector:
+def _add_gaussian_noise(image, mean=0, var=0.01):
+    """
+    Add Gaussian noise to an image.
 
-    def __init__(self,connection:sqlite3.Connection):
-        self.__connection = connection
+    Parameters:
+    image (numpy array): The input image.
+    mean (float): Mean of the Gaussian noise.
+    var (float): Variance of the Gaussian noise.
 
-    def __add_gaussian_noise(self,image, mean=0, var=0.01):
-        """
-        Add Gaussian noise to an image.
-        
-        Parameters:
-        image (numpy array): The input image.
-        mean (float): Mean of the Gaussian noise.
-        var (float): Variance of the Gaussian noise.
-        
-        Returns:
-        numpy array: Image with added Gaussian noise.
-        """
-        sigma = var ** 0.5
-        gauss = np.random.normal(mean, sigma, image.shape).astype('float32')
-        noisy_image = cv2.addWeighted(image.astype('float32'), 1.0, gauss, 1.0, 0)
-        return np.clip(noisy_image, 0, 255).astype('uint8')
-
-    def __add_salt_and_pepper_noise(self,image, salt_prob=0.01, pepper_prob=0.01):
-        """
-        Add salt and pepper noise to an image.
-        
-        Parameters:
-        image (numpy array): The input image.
-        salt_prob (float): Probability of salt noise (white pixels).
-        pepper_prob (float): Probability of pepper noise (black pixels).
-        
-        Returns:
-        numpy array: Image with added salt and pepper noise.
-        """
-        noisy_image = np.copy(image)
-        total_pixels = image.size
-        
-        # Salt noise
-        num_salt = int(salt_prob * total_pixels)
-        coords = [np.random.randint(0, i - 1, num_salt) for i in image.shape]
-        noisy_image[coords[0], coords[1], ...] = 255
-        
-        # Pepper noise
-        num_pepper = int(pepper_prob * total_pixels)
-        coords = [np.random.randint(0, i - 1, num_pepper) for i in image.shape]
-        noisy_image[coords[0], coords[1], ...] = 0
-        
-        return noisy_image
-
-    def __add_poisson_noise(self,image):
-        """
-        Add Poisson noise to an image.
-        
-        Parameters:
-        image (numpy array): The input image.
-        
-        Returns:
-        numpy array: Image with added Poisson noise.
-        """
-        # Normalize image to range 0-1 for Poisson noise
-        noisy_image = np.random.poisson(image / 255.0 * 100) / 100 * 255
-        return np.clip(noisy_image, 0, 255).astype('uint8')
-
-    def __add_speckle_noise(self,image, mean=0, var=0.01):
-        """
-        Add speckle noise to an image.
-        
-        Parameters:
-        image (numpy array): The input image.
-        mean (float): Mean of the speckle noise.
-        var (float): Variance of the speckle noise.
-        
-        Returns:
-        numpy array: Image with added speckle noise.
-        """
-        sigma = var ** 0.5
-        speckle = np.random.normal(mean, sigma, image.shape)
-        noisy_image = image + image * speckle
-        return np.clip(noisy_image, 0, 255).astype('uint8')
-
-    def __add_uniform_noise(self,image, low=-10, high=10):
-        """
-        Add uniform noise to an image.
-        
-        Parameters:
-        image (numpy array): The input image.
-        low (int): Lower bound of the noise.
-        high (int): Upper bound of the noise.
-        
-        Returns:
-        numpy array: Image with added uniform noise.
-        """
-        uniform_noise = np.random.uniform(low, high, image.shape)
-        noisy_image = image + uniform_noise
-        return np.clip(noisy_image, 0, 255).astype('uint8')
-
-    def __add_periodic_noise(self,image, frequency=10, amplitude=20):
-        """
-        Add periodic noise to an image.
-        
-        Parameters:
-        image (numpy array): The input image.
-        frequency (int): Frequency of the periodic noise.
-        amplitude (int): Amplitude of the noise.
-        
-        Returns:
-        numpy array: Image with added periodic noise.
-        """
-        rows, cols = image.shape[:2]
-        x = np.arange(cols)
-        y = np.sin(2 * np.pi * frequency * x / cols) * amplitude
-        periodic_noise = np.tile(y, (rows, 1))
-        
-        if len(image.shape) == 3:
-            periodic_noise = np.repeat(periodic_noise[..., np.newaxis], 3, axis=2)
-            
-        noisy_image = image.astype('float32') + periodic_noise
-        return np.clip(noisy_image, 0, 255).astype('uint8')
-
-    def __add_impulse_noise(self,image, prob=0.01):
-        """
-        Add impulse noise to an image.
-        
-        Parameters:
-        image (numpy array): The input image.
-        prob (float): Probability of an impulse noise (randomly changing a pixel).
-        
-        Returns:
-        numpy array: Image with added impulse noise.
-        """
-        noisy_image = np.copy(image)
-        impulse_mask = np.random.choice([0, 255], size=image.shape, p=[1 - prob, prob])
-        noisy_image[impulse_mask == 255] = np.random.choice([0, 255], size=(impulse_mask == 255).sum())
-        
-        return noisy_image
-    
-    def __log(self,path:str,size:int,duration:float,run_id:str,input_path:str):
-        with self.__connection:   
-                self.__connection.execute(
-                """UPDATE image_data 
-                SET noisy_image_path = ?, 
-                    noisy_image_size = ?
-                WHERE run_id = ? 
-                AND (compressed_image_path = ? OR noisy_image_path = ?)""",
-                (f"{path}", 
-                size, 
-                run_id, 
-                input_path, 
-                input_path)
-            )
-                
-    def __cv2pil(self,opencv_image):
-        """
-        Convert an OpenCV image to a PIL image.
-        
-        Parameters:
-        opencv_image (numpy array): The OpenCV image.
-        
-        Returns:
-        PIL image: The converted PIL image.
-        """
-        return Image.fromarray(cv2.cvtColor(opencv_image, cv2.COLOR_BGR2RGB))
-    
-    def __pil2cv(self,pil_image):
-        """
-        Convert a PIL image to an OpenCV image.
-        
-        Parameters:
-        pil_image (PIL image): The PIL image.
-        
-        Returns:
-        numpy array: The converted OpenCV image.
-        """
-        return cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
-                
-    def add_gaussian_noise(self, input_path:str, file_type:str,output_folder:str,mean:int,var:float,run_id:str):
-        
-        # if the input path is a file, convert that file
-        if os.path.isfile(input_path):
-            file_name = input_path.split("/")[-1]
-            start_time = time.perf_counter()
-            with Image.open(input_path) as img:
-                opencv_image = self.__pil2cv(img)
-                noisy_image = self.__add_gaussian_noise(opencv_image,mean=mean,var=var)
-                noisy_image = self.__cv2pil(noisy_image)
-                noisy_image.save(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}")
-                start_time = time.perf_counter()
-                self.__log(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}",os.path.getsize(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}"),(start_time - time.perf_counter()),run_id,input_path)
-            return
+    Returns:
+    numpy array: Image with added Gaussian noise.
+    """
+    sigma = var ** 0.5
+    gauss = np.random.normal(mean, sigma, image.shape).astype('float32')
+    noisy_image = cv2.addWeighted(image.astype('float32'), 1.0, gauss, 1.0, 0)
+    return np.clip(noisy_image, 0, 255).astype('uint8')
 
-        # Get all tiff files in the folder even in subdirectories
-        tiff_files = glob.glob(f"{input_path}/**/*.{file_type}", recursive=True)
 
-        # Create the output folder if it does not exist
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder, exist_ok=True)
+def _add_salt_and_pepper_noise(image, salt_prob=0.01, pepper_prob=0.01):
+    """
+    Add salt and pepper noise to an image.
 
-        to_return = {
-            "success":0,
-            "failed":0,
-            "total":len(tiff_files)
-        }
+    Parameters:
+    image (numpy array): The input image.
+    salt_prob (float): Probability of salt noise (white pixels).
+    pepper_prob (float): Probability of pepper noise (black pixels).
 
-        for tiff_file in tqdm(tiff_files):
-            try:
-                file_name = tiff_file.split("/")[-1]
-                start_time = time.perf_counter()
-                with Image.open(tiff_file) as img:
-                    opencv_image = np.array(img)
-
-                    # Convert RGB to BGR format, as OpenCV uses BGR
-                    opencv_image = self.__pil2cv(img)
-                    noisy_image = self.__add_gaussian_noise(opencv_image,mean=mean,var=var)
-                    noisy_image = self.__cv2pil(noisy_image)
-                    noisy_image.save(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}")
-                    start_time = time.perf_counter()
-                    self.__log(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}",os.path.getsize(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}"),(start_time - time.perf_counter()),run_id,tiff_file)
-
-                    to_return["success"] += 1
-                    yield json.dumps(to_return)
-            except Exception as e:
-                to_return["failed"] += 1
-                yield json.dumps(to_return)
-                continue
-
-    def add_salt_and_pepper_noise(self, input_path:str, file_type:str,output_folder:str,salt_prob:float,pepper_prob:float,run_id:str):
-        
-        # if the input path is a file, convert that file
-        if os.path.isfile(input_path):
-            file_name = input_path.split("/")[-1]
-            start_time = time.perf_counter()
-            with Image.open(input_path) as img:
-                opencv_image = self.__pil2cv(img)
-                noisy_image = self.__add_salt_and_pepper_noise(opencv_image,salt_prob=salt_prob,pepper_prob=pepper_prob)
-                noisy_image = self.__cv2pil(noisy_image)
-                noisy_image.save(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}")
-                start_time = time.perf_counter()
-                self.__log(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}",os.path.getsize(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}"),(start_time - time.perf_counter()),run_id,input_path)
-            return
+    Returns:
+    numpy array: Image with added salt and pepper noise.
+    """
+    noisy_image = np.copy(image)
+    total_pixels = image.size
 
-        # Get all tiff files in the folder even in subdirectories
-        tiff_files = glob.glob(f"{input_path}/**/*.{file_type}", recursive=True)
+    # Salt noise
+    num_salt = int(salt_prob * total_pixels)
+    coords = [np.random.randint(0, i - 1, num_salt) for i in image.shape]
+    noisy_image[coords[0], coords[1], ...] = 255
 
-        # Create the output folder if it does not exist
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder, exist_ok=True)
+    # Pepper noise
+    num_pepper = int(pepper_prob * total_pixels)
+    coords = [np.random.randint(0, i - 1, num_pepper) for i in image.shape]
+    noisy_image[coords[0], coords[1], ...] = 0
 
-        to_return = {
-            "success":0,
-            "failed":0,
-            "total":len(tiff_files)
-        }
+    return noisy_image
 
-        for tiff_file in tqdm(tiff_files):
-            try:
-                file_name = tiff_file.split("/")[-1]
-                start_time = time.perf_counter()
-                with Image.open(tiff_file) as img:
-                    opencv_image = np.array(img)
-
-                    # Convert RGB to BGR format, as OpenCV uses BGR
-                    opencv_image = self.__pil2cv(img)
-                    noisy_image = self.__add_salt_and_pepper_noise(opencv_image,salt_prob=salt_prob,pepper_prob=pepper_prob)
-                    noisy_image = self.__cv2pil(noisy_image)
-                    noisy_image.save(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}")
-                    start_time = time.perf_counter()
-                    self.__log(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}",os.path.getsize(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}"),(start_time - time.perf_counter()),run_id,tiff_file)
-
-                    to_return["success"] += 1
-                    yield json.dumps(to_return)
-            except Exception as e:
-                to_return["failed"] += 1
-                yield json.dumps(to_return)
-                continue
-
-    def add_poisson_noise(self, input_path:str, file_type:str,output_folder:str,run_id:str):
-        
-        # if the input path is a file, convert that file
-        if os.path.isfile(input_path):
-            file_name = input_path.split("/")[-1]
-            start_time = time.perf_counter()
-            with Image.open(input_path) as img:
-                opencv_image = self.__pil2cv(img)
-                noisy_image = self.__add_poisson_noise(opencv_image)
-                noisy_image = self.__cv2pil(noisy_image)
-                noisy_image.save(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}")
-                start_time = time.perf_counter()
-                self.__log(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}",os.path.getsize(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}"),(start_time - time.perf_counter()),run_id,input_path)
-            return
 
-        # Get all tiff files in the folder even in subdirectories
-        tiff_files = glob.glob(f"{input_path}/**/*.{file_type}", recursive=True)
+def _add_poisson_noise(image):
+    """
+    Add Poisson noise to an image.
 
-        # Create the output folder if it does not exist
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder, exist_ok=True)
+    Parameters:
+    image (numpy array): The input image.
 
-        to_return = {
-            "success":0,
-            "failed":0,
-            "total":len(tiff_files)
-        }
+    Returns:
+    numpy array: Image with added Poisson noise.
+    """
+    # Normalize image to range 0-1 for Poisson noise
+    noisy_image = np.random.poisson(image / 255.0 * 100) / 100 * 255
+    return np.clip(noisy_image, 0, 255).astype('uint8')
 
-        for tiff_file in tqdm(tiff_files):
-            try:
-                file_name = tiff_file.split("/")[-1]
-                start_time = time.perf_counter()
-                with Image.open(tiff_file) as img:
-                    opencv_image = np.array(img)
-
-                    # Convert RGB to BGR format, as OpenCV uses BGR
-                    opencv_image = self.__pil2cv(img)
-                    noisy_image = self.__add_poisson_noise(opencv_image)
-                    noisy_image = self.__cv2pil(noisy_image)
-                    noisy_image.save(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}")
-                    start_time = time.perf_counter()
-                    self.__log(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}",os.path.getsize(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}"),(start_time - time.perf_counter()),run_id,tiff_file)
-
-                    to_return["success"] += 1
-                    yield json.dumps(to_return)
-            except Exception as e:
-                to_return["failed"] += 1
-                yield json.dumps(to_return)
-                continue
-
-    def add_speckle_noise(self, input_path:str, file_type:str,output_folder:str,mean:float, var:float,run_id:str):
-        
-        # if the input path is a file, convert that file
-        if os.path.isfile(input_path):
-            file_name = input_path.split("/")[-1]
-            start_time = time.perf_counter()
-            with Image.open(input_path) as img:
-                opencv_image = self.__pil2cv(img)
-                noisy_image = self.__add_speckle_noise(opencv_image,mean=mean,var=var)
-                noisy_image = self.__cv2pil(noisy_image)
-                noisy_image.save(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}")
-                start_time = time.perf_counter()
-                self.__log(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}",os.path.getsize(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}"),(start_time - time.perf_counter()),run_id,input_path)
-            return
 
-        # Get all tiff files in the folder even in subdirectories
-        tiff_files = glob.glob(f"{input_path}/**/*.{file_type}", recursive=True)
+def _add_speckle_noise(image, mean=0, var=0.01):
+    """
+    Add speckle noise to an image.
 
-        # Create the output folder if it does not exist
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder, exist_ok=True)
+    Parameters:
+    image (numpy array): The input image.
+    mean (float): Mean of the speckle noise.
+    var (float): Variance of the speckle noise.
 
-        to_return = {
-            "success":0,
-            "failed":0,
-            "total":len(tiff_files)
-        }
+    Returns:
+    numpy array: Image with added speckle noise.
+    """
+    sigma = var ** 0.5
+    speckle = np.random.normal(mean, sigma, image.shape)
+    noisy_image = image + image * speckle
+    return np.clip(noisy_image, 0, 255).astype('uint8')
 
-        for tiff_file in tqdm(tiff_files):
-            try:
-                file_name = tiff_file.split("/")[-1]
-                start_time = time.perf_counter()
-                with Image.open(tiff_file) as img:
-                    opencv_image = np.array(img)
-
-                    # Convert RGB to BGR format, as OpenCV uses BGR
-                    opencv_image = self.__pil2cv(img)
-                    noisy_image = self.__add_speckle_noise(opencv_image,mean=mean,var=var)
-                    noisy_image = self.__cv2pil(noisy_image)
-                    noisy_image.save(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}")
-                    start_time = time.perf_counter()
-                    self.__log(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}",os.path.getsize(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}"),(start_time - time.perf_counter()),run_id,tiff_file)
-
-                    to_return["success"] += 1
-                    yield json.dumps(to_return)
-            except Exception as e:
-                to_return["failed"] += 1
-                yield json.dumps(to_return)
-                continue
-
-    def add_uniform_noise(self, input_path:str, file_type:str,output_folder:str,low:float, high:float,run_id:str):
-        
-        # if the input path is a file, convert that file
-        if os.path.isfile(input_path):
-            file_name = input_path.split("/")[-1]
-            start_time = time.perf_counter()
-            with Image.open(input_path) as img:
-                opencv_image = self.__pil2cv(img)
-                noisy_image = self.__add_uniform_noise(opencv_image,low=low,high=high)
-                noisy_image = self.__cv2pil(noisy_image)
-                noisy_image.save(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}")
-                start_time = time.perf_counter()
-                self.__log(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}",os.path.getsize(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}"),(start_time - time.perf_counter()),run_id,input_path)
-            return
 
-        # Get all tiff files in the folder even in subdirectories
-        tiff_files = glob.glob(f"{input_path}/**/*.{file_type}", recursive=True)
+def _add_uniform_noise(image, low=-10, high=10):
+    """
+    Add uniform noise to an image.
 
-        # Create the output folder if it does not exist
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder, exist_ok=True)
+    Parameters:
+    image (numpy array): The input image.
+    low (int): Lower bound of the noise.
+    high (int): Upper bound of the noise.
 
-        to_return = {
-            "success":0,
-            "failed":0,
-            "total":len(tiff_files)
+    Returns:
+    numpy array: Image with added uniform noise.
+    """
+    uniform_noise = np.random.uniform(low, high, image.shape)
+    noisy_image = image + uniform_noise
+    return np.clip(noisy_image, 0, 255).astype('uint8')
+
+
+def _add_periodic_noise(image, frequency=10, amplitude=20):
+    """
+    Add periodic noise to an image.
+
+    Parameters:
+    image (numpy array): The input image.
+    frequency (int): Frequency of the periodic noise.
+    amplitude (int): Amplitude of the noise.
+
+    Returns:
+    numpy array: Image with added periodic noise.
+    """
+    rows, cols = image.shape[:2]
+    x = np.arange(cols)
+    y = np.sin(2 * np.pi * frequency * x / cols) * amplitude
+    periodic_noise = np.tile(y, (rows, 1))
+
+    if len(image.shape) == 3:
+        periodic_noise = np.repeat(periodic_noise[..., np.newaxis], 3, axis=2)
+
+    noisy_image = image.astype('float32') + periodic_noise
+    return np.clip(noisy_image, 0, 255).astype('uint8')
+
+
+def _add_impulse_noise(image, prob=0.01):
+    """
+    Add impulse noise to an image.
+
+    Parameters:
+    image (numpy array): The input image.
+    prob (float): Probability of an impulse noise (randomly changing a pixel).
+
+    Returns:
+    numpy array: Image with added impulse noise.
+    """
+    noisy_image = np.copy(image)
+    impulse_mask = np.random.choice([0, 255], size=image.shape, p=[1 - prob, prob])
+    noisy_image[impulse_mask == 255] = np.random.choice([0, 255], size=(impulse_mask == 255).sum())
+
+    return noisy_image
+
+
+def _cv2pil(opencv_image):
+    """
+    Convert an OpenCV image to a PIL image.
+
+    Parameters:
+    opencv_image (numpy array): The OpenCV image.
+
+    Returns:
+    PIL image: The converted PIL image.
+    """
+    return Image.fromarray(cv2.cvtColor(opencv_image, cv2.COLOR_BGR2RGB))
+
+
+def _pil2cv(pil_image):
+    """
+    Convert a PIL image to an OpenCV image.
+
+    Parameters:
+    pil_image (PIL image): The PIL image.
+
+    Returns:
+    numpy array: The converted OpenCV image.
+    """
+    return cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
+
+
+NOISE_KERNELS = {
+    "gaussian":_add_gaussian_noise,
+    "salt_and_pepper":_add_salt_and_pepper_noise,
+    "poisson":_add_poisson_noise,
+    "speckle":_add_speckle_noise,
+    "uniform":_add_uniform_noise,
+    "periodic":_add_periodic_noise,
+    "impulse":_add_impulse_noise
+}
+
+
+def _add_noise(input_path:str, output_folder:str, file_type:str, noise:str, params:dict):
+    """
+    Apply one of the NOISE_KERNELS to the image at input_path and save it to output_folder.
+
+    Returns:
+        result: dict - Path and size of the noisy image.
+    """
+    file_name = input_path.split("/")[-1]
+    output_path = f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}"
+    start_time = time.perf_counter()
+    with Image.open(input_path) as img:
+        # Convert RGB to BGR format, as OpenCV uses BGR
+        opencv_image = _pil2cv(img)
+        noisy_image = NOISE_KERNELS[noise](opencv_image,**params)
+        noisy_image = _cv2pil(noisy_image)
+        noisy_image.save(output_path)
+        end_time = time.perf_counter()
+        return {
+            "noisy_image_path":output_path,
+            "noisy_image_size":os.path.getsize(output_path),
+            "duration":end_time - start_time
         }
 
-        for tiff_file in tqdm(tiff_files):
-            try:
-                file_name = tiff_file.split("/")[-1]
-                start_time = time.perf_counter()
-                with Image.open(tiff_file) as img:
-                    opencv_image = np.array(img)
-
-                    # Convert RGB to BGR format, as OpenCV uses BGR
-                    opencv_image = self.__pil2cv(img)
-                    noisy_image = self.__add_uniform_noise(opencv_image,low=low,high=high)
-                    noisy_image = self.__cv2pil(noisy_image)
-                    noisy_image.save(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}")
-                    start_time = time.perf_counter()
-                    self.__log(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}",os.path.getsize(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}"),(start_time - time.perf_counter()),run_id,tiff_file)
-
-                    to_return["success"] += 1
-                    yield json.dumps(to_return)
-            except Exception as e:
-                to_return["failed"] += 1
-                yield json.dumps(to_return)
-                continue
-
-    def add_periodic_noise(self, input_path:str, file_type:str,output_folder:str,frequency:int, amplitude:int,run_id:str):
-        
-        # if the input path is a file, convert that file
-        if os.path.isfile(input_path):
-            file_name = input_path.split("/")[-1]
-            start_time = time.perf_counter()
-            with Image.open(input_path) as img:
-                opencv_image = self.__pil2cv(img)
-                noisy_image = self.__add_periodic_noise(opencv_image,frequency=frequency,amplitude=amplitude)
-                noisy_image = self.__cv2pil(noisy_image)
-                noisy_image.save(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}")
-                start_time = time.perf_counter()
-                self.__log(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}",os.path.getsize(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}"),(start_time - time.perf_counter()),run_id,input_path)
-            return
 
-        # Get all tiff files in the folder even in subdirectories
-        tiff_files = glob.glob(f"{input_path}/**/*.{file_type}", recursive=True)
+class SimulatedNoiseInjector:
 
-        # Create the output folder if it does not exist
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder, exist_ok=True)
+    def __init__(self,connection:sqlite3.Connection,writer:ImageDataWriter):
+        self.__connection = connection
+        self.__writer = writer
+        self.__runner = StageRunner(connection,writer)
 
-        to_return = {
-            "success":0,
-            "failed":0,
-            "total":len(tiff_files)
-        }
+    def __log(self,path:str,size:int,duration:float,run_id:str,input_path:str):
+        self.__writer.execute(
+            """UPDATE image_data 
+            SET noisy_image_path = ?, 
+                noisy_image_size = ?
+            WHERE run_id = ? 
+            AND (compressed_image_path = ? OR noisy_image_path = ?)""",
+            (f"{path}", 
+            size, 
+            run_id, 
+            input_path, 
+            input_path)
+        )
+
+    def __add_noise(self, input_path:str, file_type:str, output_folder:str, noise:str, params:dict, run_id:str, workers:int):
 
-        for tiff_file in tqdm(tiff_files):
-            try:
-                file_name = tiff_file.split("/")[-1]
-                start_time = time.perf_counter()
-                with Image.open(tiff_file) as img:
-                    opencv_image = np.array(img)
-
-                    # Convert RGB to BGR format, as OpenCV uses BGR
-                    opencv_image = self.__pil2cv(img)
-                    noisy_image = self.__add_periodic_noise(opencv_image,frequency=frequency,amplitude=amplitude)
-                    noisy_image = self.__cv2pil(noisy_image)
-                    noisy_image.save(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}")
-                    start_time = time.perf_counter()
-                    self.__log(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}",os.path.getsize(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}"),(start_time - time.perf_counter()),run_id,tiff_file)
-
-                    to_return["success"] += 1
-                    yield json.dumps(to_return)
-            except Exception as e:
-                to_return["failed"] += 1
-                yield json.dumps(to_return)
-                continue
-
-    def add_impulse_noise(self, input_path:str, file_type:str,output_folder:str,prob:float,run_id:str):
-        
         # if the input path is a file, convert that file
         if os.path.isfile(input_path):
-            file_name = input_path.split("/")[-1]
-            start_time = time.perf_counter()
-            with Image.open(input_path) as img:
-                opencv_image = self.__pil2cv(img)
-                noisy_image = self.__add_impulse_noise(opencv_image,prob=prob)
-                noisy_image = self.__cv2pil(noisy_image)
-                noisy_image.save(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}")
-                start_time = time.perf_counter()
-                self.__log(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}",os.path.getsize(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}"),(start_time - time.perf_counter()),run_id,input_path)
+            result = _add_noise(input_path,output_folder,file_type,noise,params)
+            with self.__writer.transaction() as unit:
+                self.__log(result["noisy_image_path"],result["noisy_image_size"],result["duration"],run_id,input_path)
+            self.__writer.commit(unit)
             return
 
-        # Get all tiff files in the folder even in subdirectories
-        tiff_files = glob.glob(f"{input_path}/**/*.{file_type}", recursive=True)
+        for res in self.__runner.run(
+            _add_noise,
+            {"output_folder":output_folder,"file_type":file_type,"noise":noise,"params":params},
+            input_path,
+            file_type,
+            run_id,
+            workers,
+            output_folder=output_folder,
+            stage=f"add_{noise}_noise",
+            log=lambda path, result: self.__log(result["noisy_image_path"],result["noisy_image_size"],result["duration"],run_id,path),
+            output_of=lambda path, result: result["noisy_image_path"]
+        ):
+            yield res
 
-        # Create the output folder if it does not exist
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder, exist_ok=True)
+    def add_gaussian_noise(self, input_path:str, file_type:str,output_folder:str,mean:int,var:float,run_id:str,workers:int = 1):
+        return self.__add_noise(input_path,file_type,output_folder,"gaussian",{"mean":mean,"var":var},run_id,workers)
 
-        to_return = {
-            "success":0,
-            "failed":0,
-            "total":len(tiff_files)
-        }
+    def add_salt_and_pepper_noise(self, input_path:str, file_type:str,output_folder:str,salt_prob:float,pepper_prob:float,run_id:str,workers:int = 1):
+        return self.__add_noise(input_path,file_type,output_folder,"salt_and_pepper",{"salt_prob":salt_prob,"pepper_prob":pepper_prob},run_id,workers)
+
+    def add_poisson_noise(self, input_path:str, file_type:str,output_folder:str,run_id:str,workers:int = 1):
+        return self.__add_noise(input_path,file_type,output_folder,"poisson",{},run_id,workers)
+
+    def add_speckle_noise(self, input_path:str, file_type:str,output_folder:str,mean:float, var:float,run_id:str,workers:int = 1):
+        return self.__add_noise(input_path,file_type,output_folder,"speckle",{"mean":mean,"var":var},run_id,workers)
+
+    def add_uniform_noise(self, input_path:str, file_type:str,output_folder:str,low:float, high:float,run_id:str,workers:int = 1):
+        return self.__add_noise(input_path,file_type,output_folder,"uniform",{"low":low,"high":high},run_id,workers)
+
+    def add_periodic_noise(self, input_path:str, file_type:str,output_folder:str,frequency:int, amplitude:int,run_id:str,workers:int = 1):
+        return self.__add_noise(input_path,file_type,output_folder,"periodic",{"frequency":frequency,"amplitude":amplitude},run_id,workers)
 
-        for tiff_file in tqdm(tiff_files):
-            try:
-                file_name = tiff_file.split("/")[-1]
-                start_time = time.perf_counter()
-                with Image.open(tiff_file) as img:
-                    opencv_image = np.array(img)
-
-                    # Convert RGB to BGR format, as OpenCV uses BGR
-                    opencv_image = self.__pil2cv(img)
-                    noisy_image = self.__add_impulse_noise(opencv_image,prob=prob)
-                    noisy_image = self.__cv2pil(noisy_image)
-                    noisy_image.save(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}")
-                    start_time = time.perf_counter()
-                    self.__log(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}",os.path.getsize(f"{output_folder}/{file_name.replace(f'.{file_type}','')}.{file_type}"),(start_time - time.perf_counter()),run_id,tiff_file)
-
-                    to_return["success"] += 1
-                    yield json.dumps(to_return)
-            except Exception as e:
-                to_return["failed"] += 1
-                yield json.dumps(to_return)
-                continue
-
-        
\ No newline at end of file
+    def add_impulse_noise(self, input_path:str, file_type:str,output_folder:str,prob:float,run_id:str,workers:int = 1):
+        return self.__add_noise(input_path,file_type,output_folder,"impulse",{"prob":prob},run_id,workers)
@@ -0,0 +1,140 @@
+import os
+import threading
+import zipfile
+from io import BytesIO
+from PIL import Image
+
+# Members of an archive are addressed with GDAL's virtual zip paths, /vsizip//abs/path/data.zip/scene/tile.tif,
+# so rasterio opens them as is and the same string is recorded as the input path of the image_data rows.
+ZIP_PREFIX = "/vsizip/"
+
+# per process ZipFile handles, so a worker opens an archive once for all the members it reads
+_ZIP_HANDLES = {}
+_ZIP_LOCK = threading.Lock()
+MAX_ZIP_HANDLES = 4
+
+
+def _reset_archives():
+    # a forked worker must not read through the parent's handles, they share one file offset
+    global _ZIP_HANDLES, _ZIP_LOCK
+    _ZIP_HANDLES = {}
+    _ZIP_LOCK = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_archives)
+
+
+def open_archive(zip_file_path:str):
+    """
+    Return the cached ZipFile of this process for the archive, reopening it when the file changed.
+    """
+    key = (zip_file_path, os.path.getmtime(zip_file_path))
+    with _ZIP_LOCK:
+        if key not in _ZIP_HANDLES:
+            while len(_ZIP_HANDLES) >= MAX_ZIP_HANDLES:
+                # evicted handles are not closed, a thread may still be reading through one,
+                # they close once the last member opened from them is released
+                _ZIP_HANDLES.pop(next(iter(_ZIP_HANDLES)))
+            _ZIP_HANDLES[key] = zipfile.ZipFile(zip_file_path, 'r')
+        return _ZIP_HANDLES[key]
+
+
+def split_archive_path(path:str):
+    """
+    Split a virtual zip path, or an archive path optionally followed by a folder inside it.
+
+    Returns:
+        (archive, member): tuple - Archive file path and the path inside it, or (None, None)
+            when path does not point into an archive.
+    """
+    if path.startswith(ZIP_PREFIX):
+        path = path[len(ZIP_PREFIX):]
+    lowered = path.lower()
+    end = 0
+    while True:
+        end = lowered.find(".zip", end)
+        if end == -1:
+            return None, None
+        end += len(".zip")
+        if end == len(path) or path[end] == "/":
+            archive = path[:end]
+            if os.path.isfile(archive):
+                return archive, path[end + 1:].strip("/")
+
+
+def is_archive(path:str):
+    """
+    True when path is an archive, or a folder inside one, whose members are read in place.
+    """
+    if path.startswith(ZIP_PREFIX):
+        return False
+    archive, _ = split_archive_path(path)
+    return archive is not None
+
+
+def is_member(path:str):
+    """
+    True when path is a virtual zip path to a file inside an archive.
+    """
+    if not path.startswith(ZIP_PREFIX):
+        return False
+    archive, member = split_archive_path(path)
+    if archive is None or member == "":
+        return False
+    try:
+        open_archive(archive).getinfo(member)
+        return True
+    except KeyError:
+        return False
+
+
+def is_file(path:str):
+    """
+    True when path is a single image, on disk or inside an archive. Archives themselves are not files here.
+    """
+    if is_archive(path):
+        return False
+    return os.path.isfile(path) or is_member(path)
+
+
+def list_members(input_path:str):
+    """
+    List the files of an archive, or of a folder inside it, as virtual zip paths.
+    """
+    archive, prefix = split_archive_path(input_path)
+    archive = os.path.abspath(archive)
+    prefix = f"{prefix}/" if prefix != "" else ""
+    return [
+        f"{ZIP_PREFIX}{archive}/{name}"
+        for name in open_archive(archive).namelist()
+        if name.startswith(prefix) and not name.endswith("/")
+    ]
+
+
+def get_size(path:str):
+    """
+    Size in bytes of a file, uncompressed size for an archive member.
+    """
+    if path.startswith(ZIP_PREFIX):
+        archive, member = split_archive_path(path)
+        return open_archive(archive).getinfo(member).file_size
+    return os.path.getsize(path)
+
+
+def open_file(path:str):
+    """
+    Open a file for binary reading, archive members are read into memory.
+    """
+    if path.startswith(ZIP_PREFIX):
+        archive, member = split_archive_path(path)
+        return BytesIO(open_archive(archive).read(member))
+    return open(path, 'rb')
+
+
+def open_image(path:str):
+    """
+    Open an image with PIL, from disk or from inside an archive.
+    """
+    if path.startswith(ZIP_PREFIX):
+        return Image.open(open_file(path))
+    return Image.open(path)
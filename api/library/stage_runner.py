@@ -0,0 +1,163 @@
+import itertools
+import json
+from collections import deque
+import os
+import sqlite3
+from tqdm import tqdm
+from .image_data_writer import ImageDataWriter
+from .executor import executor
+from .cache import stage_cache
+from .checkpoints import checkpoints
+from .discovery import discovery
+from .streams import streams
+from . import sources
+
+
+def _batches(worker,files,batch_size:int,**params):
+    """
+    Call a batch worker on consecutive batches of files in this process.
+
+    Yields:
+        (item, result, error): tuple - As executor.map, one per file of every batch.
+    """
+    while True:
+        batch = list(itertools.islice(files,batch_size))
+        if len(batch) == 0:
+            return
+        try:
+            results, errors = worker(batch,**params)
+        except Exception as e:
+            results, errors = {}, {path:e for path in batch}
+        for path in batch:
+            if path in errors:
+                yield path, None, errors[path]
+            else:
+                yield path, results[path], None
+
+
+def _discovery_message(to_return:dict,complete:bool):
+    # its own message type, so the progress messages keep their success, failed and total fields
+    return json.dumps({"discovery":{"total":to_return["total"],"complete":complete}})
+
+
+class StageRunner:
+    """
+    The per file loop shared by the folder level stages.
+
+    The files of the input folder are streamed in as they are found, skipped when a resumed
+    run already finished them, and sent through the worker on the shared process pool, the
+    stage cache or in batches. For every result the stage's statements and the checkpoint
+    of the file are queued in one writer transaction. Once the writer committed them the file
+    counts as a success and its output is published to the readers of output_folder, a file
+    whose statements the writer dropped fails with their error. A progress message is yielded
+    per file, followed by the error of a file that failed. Files are counted into the total as
+    they are discovered, separate discovery messages mark where the total is provisional: one
+    with complete false when the stage starts and one with the final total once the input is
+    fully walked.
+    """
+
+    def __init__(self,connection:sqlite3.Connection,writer:ImageDataWriter):
+        self.__connection = connection
+        self.__writer = writer
+
+    def __settle(self,unsettled:deque,to_return:dict,run_id:str,output_folder:str):
+        """
+        Report the files at the head of unsettled whose writer transaction is committed or dropped.
+        """
+        while len(unsettled) > 0 and self.__writer.settled(unsettled[0][0]):
+            unit, output_path = unsettled.popleft()
+            error = self.__writer.error(unit)
+            if error is not None:
+                to_return["failed"] += 1
+                yield json.dumps(to_return)
+                yield str(error)
+                continue
+            if output_path is not None:
+                streams.publish(run_id,output_folder,output_path)
+            to_return["success"] += 1
+            yield json.dumps(to_return)
+
+    def run(self,worker,params:dict,input_path:str,file_type:str,run_id:str,workers:int = 1,output_folder:str = None,stage:str = None,log = None,output_of = None,cached:bool = False,batch_size:int = 0):
+        """
+        Run a stage over every file_type file of input_path.
+
+        Parameters:
+            worker: callable - Module level worker(input_path, **params) returning the result of a file,
+                or with batch_size a worker(input_paths, **params) returning (results, errors) dicts
+                keyed by input path.
+            params: dict - Keyword arguments of the worker.
+            input_path: str - Folder, archive or single file to process.
+            file_type: str - Extension of the files to process.
+            run_id: str - Unique identifier for the current run.
+            workers: int - Number of processes, 1 runs inline, 0 uses every core.
+            output_folder: str - Folder the worker writes to, None for stages that write no files.
+            stage: str - Name the files are checkpointed under, None for stages that are not resumed.
+            log: callable - log(input_path, result) queues the statements of a file, raising fails the file.
+            output_of: callable - output_of(input_path, result) gives the file written for input_path.
+            cached: bool - Go through the stage cache, only for deterministic workers.
+            batch_size: int - Call the worker in this process on batches of that many files.
+
+        Yields:
+            message: str - Progress as json, followed by the error message of a failed file.
+                {"discovery":{"total","complete"}} json messages are sent when the stage starts
+                and once every file is found.
+        """
+        if output_folder is not None:
+            os.makedirs(output_folder, exist_ok=True)
+            discovery.invalidate(output_folder)
+
+        to_return = {
+            "success":0,
+            "failed":0,
+            "total":0
+        }
+
+        if sources.is_file(input_path):
+            files = [input_path]
+        else:
+            # files are streamed in as they are found, so total grows until the folder is fully walked
+            files = discovery.files(input_path,file_type,run_id=run_id)
+            if stage is not None:
+                # a resumed run skips the files this stage already finished
+                files = checkpoints.pending(self.__connection,self.__writer,run_id,stage,output_folder,files)
+        discovered = {}
+        files = discovery.counted(files,to_return,discovered)
+
+        if batch_size > 0:
+            results = _batches(worker,files,batch_size,**params)
+        elif cached:
+            results = stage_cache.map(worker,files,workers,self.__connection,self.__writer,run_id,**params)
+        else:
+            results = executor.map(worker,files,workers,**params)
+
+        # files whose statements are still queued in the writer, in queue order
+        unsettled = deque()
+        try:
+            yield _discovery_message(to_return,False)
+            for path, result, error in tqdm(results):
+                try:
+                    if error is not None:
+                        raise error
+                    output_path = None if output_of is None else output_of(path,result)
+                    with self.__writer.transaction() as unit:
+                        if log is not None:
+                            log(path,result)
+                        if stage is not None:
+                            checkpoints.record(self.__writer,run_id,stage,output_folder,path,output_path)
+                    unsettled.append((unit,output_path))
+                except Exception as e:
+                    to_return["failed"] += 1
+                    yield json.dumps(to_return)
+                    yield str(e)
+                for message in self.__settle(unsettled,to_return,run_id,output_folder):
+                    yield message
+                if discovered["complete"] and not discovered.get("announced"):
+                    discovered["announced"] = True
+                    yield _discovery_message(to_return,True)
+            self.__writer.flush()
+            for message in self.__settle(unsettled,to_return,run_id,output_folder):
+                yield message
+            if not discovered.get("announced"):
+                yield _discovery_message(to_return,True)
+        finally:
+            self.__writer.flush()
@@ -0,0 +1,144 @@
+import os
+import queue
+import threading
+
+# files a stage may be ahead of each of its consumers
+STREAM_SIZE = 64
+
+_END = object()
+
+
+class Streams:
+    """
+    Hand-off of files between the stages of a run scheduled as a DAG.
+
+    A stage whose output folder is read by later stages of the same run publishes every
+    file it writes, and discovery.files yields those files to the readers as they arrive
+    instead of walking the folder once the stage is done. Each reader has its own bounded
+    queue, so a producer that gets too far ahead waits for its slowest reader.
+    """
+
+    def __init__(self):
+        self.__streams = {}
+        self.__producers = {}
+        self.__lock = threading.Lock()
+        self.__changed = threading.Condition(self.__lock)
+
+    def open(self,run_id:str,folder:str,readers:int):
+        """
+        Open the stream of a folder before its producer and readers start.
+        """
+        with self.__lock:
+            self.__streams[(run_id,os.path.abspath(folder))] = {
+                "queues":[queue.Queue(maxsize=STREAM_SIZE) for _ in range(readers)],
+                "readers":{},
+                "abandoned":set()
+            }
+
+    def close(self,run_id:str,folder:str):
+        """
+        Mark the end of a folder's stream, called when its producer finished, failed or was cancelled.
+        """
+        with self.__lock:
+            stream = self.__streams.pop((run_id,os.path.abspath(folder)),None)
+        if stream is None:
+            return
+        for index in range(len(stream["queues"])):
+            self.__put(stream,index,_END)
+        with self.__changed:
+            self.__changed.notify_all()
+
+    def __put(self,stream:dict,index:int,item):
+        # a reader that stopped early no longer drains its queue
+        while index not in stream["abandoned"]:
+            try:
+                stream["queues"][index].put(item,timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def publish(self,run_id:str,folder:str,path:str):
+        """
+        Hand a file written to folder to its readers, a no-op when nothing reads the folder.
+        """
+        with self.__lock:
+            stream = self.__streams.get((run_id,os.path.abspath(folder)))
+        if stream is None:
+            return
+        for index in range(len(stream["queues"])):
+            self.__put(stream,index,path)
+        with self.__changed:
+            self.__changed.notify_all()
+
+    def subscribe(self,run_id:str,folder:str):
+        """
+        Claim a reader queue of the folder's stream.
+
+        Returns:
+            files: generator - Published paths until the producer closes the stream, or None
+                when no stream is open for the folder.
+        """
+        if run_id == "":
+            return None
+        with self.__lock:
+            stream = self.__streams.get((run_id,os.path.abspath(folder)))
+            if stream is None or len(stream["readers"]) >= len(stream["queues"]):
+                return None
+            index = len(stream["readers"])
+            stream["readers"][threading.get_ident()] = index
+        return self.__follow(stream,index)
+
+    def leave(self,run_id:str,folder:str):
+        """
+        Called by the scheduler when a reader stage ends. A reader that failed before it
+        subscribed gives up its queue, so the producer does not wait for it.
+        """
+        with self.__lock:
+            stream = self.__streams.get((run_id,os.path.abspath(folder)))
+            if stream is None or threading.get_ident() in stream["readers"] or len(stream["readers"]) >= len(stream["queues"]):
+                return
+            index = len(stream["readers"])
+            stream["readers"][threading.get_ident()] = index
+            stream["abandoned"].add(index)
+
+    def __follow(self,stream:dict,index:int):
+        files = stream["queues"][index]
+        try:
+            while True:
+                path = files.get()
+                if path is _END:
+                    return
+                yield path
+        finally:
+            stream["abandoned"].add(index)
+
+    def start(self,run_id:str):
+        """
+        Count a stage of the run that is producing image_data rows.
+        """
+        with self.__changed:
+            self.__producers[run_id] = self.__producers.get(run_id,0) + 1
+
+    def finish(self,run_id:str):
+        with self.__changed:
+            self.__producers[run_id] -= 1
+            if self.__producers[run_id] <= 0:
+                del self.__producers[run_id]
+            self.__changed.notify_all()
+
+    def producing(self,run_id:str):
+        """
+        True while a stage of the run may still add or fill image_data rows.
+        """
+        with self.__lock:
+            return run_id in self.__producers
+
+    def wait(self,timeout:float = 1):
+        """
+        Wait until a file is published or a producing stage finishes.
+        """
+        with self.__changed:
+            self.__changed.wait(timeout=timeout)
+
+
+streams = Streams()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the api modules import the library package relative to the api folder, as app.py does
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
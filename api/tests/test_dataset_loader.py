@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import zipfile
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from library.dataset_loader import DatasetLoader
+from library.image_data_writer import ImageDataWriter
+from library.migrations import MIGRATIONS
+
+
+@pytest.fixture
+def loader(tmp_path):
+    connection = sqlite3.connect(str(tmp_path / "sateval.db"),check_same_thread=False,isolation_level=None)
+    for statements in MIGRATIONS:
+        for statement in statements:
+            connection.execute(statement)
+    base_dir = tmp_path / "dataset"
+    base_dir.mkdir()
+    yield DatasetLoader(str(base_dir),connection,ImageDataWriter(connection))
+    connection.close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # serves server.content, honouring single byte ranges unless server.ranges is False
+
+    def log_message(self, *args):
+        pass
+
+    def __headers(self, status:int, length:int, extra:dict = None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        for name, value in (extra or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.__headers(200, len(self.server.content))
+
+    def do_GET(self):
+        content = self.server.content
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if not self.server.ranges or match is None:
+            self.server.requests.append(None)
+            self.__headers(200, len(content))
+            self.wfile.write(content)
+            return
+        start, end = int(match.group(1)), int(match.group(2))
+        self.server.requests.append((start, end))
+        self.__headers(206, end - start + 1, {"Content-Range":f"bytes {start}-{end}/{len(content)}"})
+        self.wfile.write(content[start:end + 1])
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.content = os.urandom(3 * 1024 * 1024 + 17)
+    server.ranges = True
+    server.requests = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/data.zip"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _downloaded(loader:DatasetLoader, file_name:str):
+    with open(os.path.join(loader.base_dir, file_name), "rb") as f:
+        return f.read()
+
+
+def _progress(messages:list):
+    return [json.loads(message) for message in messages if message.startswith("{")]
+
+
+def test_unzip_nested_archive_in_parallel(loader):
+    members = {f"scene/{folder}/band_{band}.tif":os.urandom(1024 + band) for folder in ["a","b","c/d"] for band in range(6)}
+    with zipfile.ZipFile(os.path.join(loader.base_dir,"data.zip"),"w") as zip_ref:
+        zip_ref.writestr("scene/",b"")
+        zip_ref.writestr("scene/empty/",b"")
+        for name, data in members.items():
+            zip_ref.writestr(name,data)
+
+    messages = list(loader.unzip_file("data.zip","out",workers=4))
+    assert messages[-1].startswith("Unzipped"), messages
+    assert _progress(messages)[-1] == {"success":len(members),"failed":0,"skipped":0,"total":len(members)}
+    destination = os.path.join(loader.base_dir,"out")
+    assert os.path.isdir(os.path.join(destination,"scene","empty"))
+    for name, data in members.items():
+        with open(os.path.join(destination,name),"rb") as f:
+            assert f.read() == data
+
+    # a second run finds every member on disk
+    messages = list(loader.unzip_file("data.zip","out",workers=4))
+    assert _progress(messages)[-1]["skipped"] == len(members)
+
+
+def test_download_in_parallel_ranges(loader,server):
+    messages = list(loader.load_by_url(server.url,"data.zip",connections=4,checksum=hashlib.sha256(server.content).hexdigest()))
+    assert messages[-1] == "data.zip File Downloaded", messages
+    assert _downloaded(loader,"data.zip") == server.content
+    assert len([request for request in server.requests if request is not None]) == 4
+    assert not os.path.exists(os.path.join(loader.base_dir,"data.zip.part"))
+    assert not os.path.exists(os.path.join(loader.base_dir,"data.zip.part.json"))
+
+
+def test_download_resumes_a_partial_file(loader,server):
+    prefix = 1024 * 1024
+    with open(os.path.join(loader.base_dir,"data.zip.part"),"wb") as f:
+        f.write(server.content[:prefix])
+
+    messages = list(loader.load_by_url(server.url,"data.zip"))
+    assert messages[-1] == "data.zip File Downloaded", messages
+    assert _progress(messages)[0]["success"] == prefix
+    assert server.requests == [(prefix, len(server.content) - 1)]
+    assert _downloaded(loader,"data.zip") == server.content
+
+
+def test_download_resumes_the_recorded_ranges(loader,server):
+    size = len(server.content)
+    half = size // 2
+    part_path = os.path.join(loader.base_dir,"data.zip.part")
+    # the first range stopped after 1000 bytes, the second one completed
+    with open(part_path,"wb") as f:
+        f.write(server.content[:1000] + bytes(half - 1000) + server.content[half:])
+    with open(f"{part_path}.json","w") as f:
+        json.dump({"url":server.url,"size":size,"segments":[{"start":0,"end":half,"done":1000},{"start":half,"end":size,"done":size - half}]},f)
+
+    messages = list(loader.load_by_url(server.url,"data.zip",connections=2))
+    assert messages[-1] == "data.zip File Downloaded", messages
+    assert server.requests == [(1000, half - 1)]
+    assert _downloaded(loader,"data.zip") == server.content
+
+
+def test_download_without_range_support(loader,server):
+    server.ranges = False
+    messages = list(loader.load_by_url(server.url,"data.zip",connections=4))
+    assert messages[-1] == "data.zip File Downloaded", messages
+    assert server.requests == [None]
+    assert _downloaded(loader,"data.zip") == server.content
+
+
+def test_download_with_a_wrong_checksum(loader,server):
+    messages = list(loader.load_by_url(server.url,"data.zip",connections=2,checksum="0" * 64))
+    assert messages[-1] == "Error in downloading file. Checksum mismatch for data.zip"
+    assert os.listdir(loader.base_dir) == []
@@ -0,0 +1,35 @@
+import os
+from concurrent.futures.process import BrokenProcessPool
+from library.executor import Executor
+
+
+def _double(item:int):
+    if item < 0:
+        # dies the way an OOM killed worker does, without raising
+        os._exit(1)
+    return item * 2
+
+
+def test_map_runs_on_a_new_pool_after_a_worker_died():
+    executor = Executor()
+    try:
+        results = list(executor.map(_double,[1,2,-1],workers=2))
+        errors = [error for item, _, error in results if item == -1]
+        assert isinstance(errors[0],BrokenProcessPool)
+
+        results = list(executor.map(_double,range(8),workers=2))
+        assert sorted(result for _, result, _ in results) == [item * 2 for item in range(8)]
+        assert all(error is None for _, _, error in results)
+    finally:
+        executor.shutdown()
+
+
+def test_items_after_a_dead_worker_still_run():
+    executor = Executor()
+    try:
+        # items submitted after the pool broke run on its replacement
+        results = {item:(result, error) for item, result, error in executor.map(_double,[-1] + list(range(20)),workers=2)}
+        assert isinstance(results[-1][1],BrokenProcessPool)
+        assert results[19] == (38, None)
+    finally:
+        executor.shutdown()
@@ -0,0 +1,78 @@
+import sqlite3
+import pytest
+from library.image_data_writer import ImageDataWriter
+
+INSERT = "INSERT INTO items (name, value) VALUES (?, ?)"
+
+
+@pytest.fixture
+def connection(tmp_path):
+    connection = sqlite3.connect(str(tmp_path / "sateval.db"),check_same_thread=False,isolation_level=None,timeout=0)
+    connection.execute("CREATE TABLE items (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    yield connection
+    connection.close()
+
+
+def _names(connection:sqlite3.Connection):
+    return sorted(name for name, in connection.execute("SELECT name FROM items"))
+
+
+def test_a_bad_statement_does_not_block_the_batch(connection):
+    writer = ImageDataWriter(connection,max_rows=1000,max_delay_ms=60000)
+    units = [writer.execute(INSERT,("a",1)),writer.execute(INSERT,("b",None)),writer.execute(INSERT,("c",3))]
+    errors = writer.flush()
+    assert list(errors) == [units[1]]
+    assert isinstance(errors[units[1]],sqlite3.IntegrityError)
+    assert _names(connection) == ["a","c"]
+    assert isinstance(writer.error(units[1]),sqlite3.IntegrityError)
+    assert writer.error(units[1]) is None
+
+    # the bad statement was dropped, the next flush only writes the new rows
+    writer.execute(INSERT,("d",4))
+    assert writer.flush() == {}
+    assert _names(connection) == ["a","c","d"]
+
+
+def test_a_failing_transaction_is_dropped_as_a_whole(connection):
+    writer = ImageDataWriter(connection,max_rows=1000,max_delay_ms=60000)
+    writer.execute(INSERT,("a",1))
+    with writer.transaction() as unit:
+        writer.execute(INSERT,("b",2))
+        writer.execute(INSERT,("a",3))
+    writer.execute(INSERT,("c",3))
+    with pytest.raises(sqlite3.IntegrityError):
+        writer.commit(unit)
+    assert _names(connection) == ["a","c"]
+
+
+def test_the_error_of_a_dropped_transaction_stays_with_its_unit(connection):
+    writer = ImageDataWriter(connection,max_rows=3,max_delay_ms=60000)
+    with writer.transaction() as a:
+        writer.execute(INSERT,("a",None))
+    with writer.transaction() as b:
+        writer.execute(INSERT,("b",2))
+    assert not writer.settled(a)
+    # the third row reaches max_rows, the flush it triggers does not raise a's error into c
+    with writer.transaction() as c:
+        writer.execute(INSERT,("c",3))
+    assert all(writer.settled(unit) for unit in [a,b,c])
+    assert _names(connection) == ["b","c"]
+    assert isinstance(writer.error(a),sqlite3.IntegrityError)
+    assert writer.error(b) is None
+    assert writer.error(c) is None
+    writer.commit(c)
+
+
+def test_a_locked_database_keeps_the_statements_queued(connection,tmp_path):
+    writer = ImageDataWriter(connection,max_rows=1000,max_delay_ms=60000)
+    writer.execute(INSERT,("a",1))
+    other = sqlite3.connect(str(tmp_path / "sateval.db"),isolation_level=None)
+    other.execute("BEGIN EXCLUSIVE")
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            writer.flush()
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+    writer.flush()
+    assert _names(connection) == ["a"]
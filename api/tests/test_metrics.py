@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from skimage.metrics import peak_signal_noise_ratio, structural_similarity
+from sklearn.metrics import mean_squared_error
+from library.metrics import IDENTICAL_PSNR, calculate_mse, calculate_psnr, calculate_ssim, mse_psnr, ssim
+
+
+def _pair(shape:tuple,dtype,seed:int = 0):
+    rng = np.random.default_rng(seed)
+    high = np.iinfo(dtype).max
+    img1 = rng.integers(0,high,shape,endpoint=True).astype(dtype)
+    # a noisy copy, so the pair is similar but not identical
+    noise = rng.integers(-high // 10,high // 10,shape,endpoint=True)
+    img2 = np.clip(img1.astype(np.int64) + noise,0,high).astype(dtype)
+    return img1, img2
+
+
+@pytest.mark.parametrize("dtype",[np.uint8,np.uint16])
+@pytest.mark.parametrize("shape",[(64,48,3),(33,65,4),(40,40)])
+def test_mse_psnr_matches_sklearn_and_skimage(dtype,shape):
+    img1, img2 = _pair(shape,dtype)
+    data_range = float(np.iinfo(dtype).max)
+    mse, psnr = mse_psnr(img1,img2,data_range=data_range)
+    assert mse == pytest.approx(mean_squared_error(img1.flatten(),img2.flatten()),rel=1e-12)
+    assert psnr == pytest.approx(peak_signal_noise_ratio(img1,img2,data_range=data_range),rel=1e-12)
+
+
+@pytest.mark.parametrize("dtype",[np.uint8,np.uint16])
+@pytest.mark.parametrize("shape,win_size",[((64,48,3),7),((33,65,4),7),((9,12,3),3),((7,9,3),7)])
+def test_ssim_matches_skimage(dtype,shape,win_size):
+    img1, img2 = _pair(shape,dtype)
+    expected = structural_similarity(img1,img2,win_size=win_size,channel_axis=-1,data_range=float(np.iinfo(dtype).max))
+    assert ssim(img1,img2,win_size=win_size) == pytest.approx(expected,abs=1e-12)
+
+
+def test_ssim_of_2d_images_matches_skimage():
+    img1, img2 = _pair((40,32),np.uint8)
+    # channel_axis=-1 treats the last axis as channels, as the evaluator always has done
+    expected = structural_similarity(img1,img2,win_size=7,channel_axis=-1)
+    assert ssim(img1,img2) == pytest.approx(expected,abs=1e-12)
+
+
+def test_ssim_rejects_a_window_larger_than_the_image():
+    img1, img2 = _pair((5,9,3),np.uint8)
+    with pytest.raises(ValueError):
+        ssim(img1,img2,win_size=7)
+
+
+@pytest.mark.parametrize("dtype",[np.uint8,np.uint16])
+def test_identical_images(dtype):
+    img1, _ = _pair((32,32,3),dtype)
+    assert mse_psnr(img1,img1.copy()) == (0.0, IDENTICAL_PSNR)
+    assert ssim(img1,img1.copy()) == pytest.approx(1.0,abs=1e-12)
+
+
+def test_calculate_functions_match_references():
+    img1, img2 = _pair((48,40,3),np.uint8)
+    cache = {}
+    assert calculate_mse(img1,img2,cache) == pytest.approx(mean_squared_error(img1.flatten(),img2.flatten()),rel=1e-12)
+    assert calculate_psnr(img1,img2,cache) == pytest.approx(peak_signal_noise_ratio(img1,img2,data_range=255),rel=1e-12)
+    assert calculate_ssim(img1,img2) == pytest.approx(structural_similarity(img1,img2,win_size=7,channel_axis=-1),abs=1e-12)
+    # PSNR and MSE share the squared error pass through the cache
+    assert "mse_psnr" in cache
+
+
+def test_calculate_ssim_shrinks_the_window_of_small_images():
+    img1, img2 = _pair((6,10,3),np.uint8)
+    expected = structural_similarity(img1,img2,win_size=5,channel_axis=-1)
+    assert calculate_ssim(img1,img2) == pytest.approx(expected,abs=1e-12)
+
+
+def test_mismatched_shapes_raise():
+    img1, _ = _pair((16,16,3),np.uint8)
+    with pytest.raises(ValueError):
+        mse_psnr(img1,img1[:8])
+    with pytest.raises(ValueError):
+        ssim(img1,img1[:8])